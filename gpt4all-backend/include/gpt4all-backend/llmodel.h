@@ -139,6 +139,7 @@ public:
         float   repeat_penalty = 1.10f;
         int32_t repeat_last_n = 64;     // last n tokens to penalize
         float   contextErase = 0.5f;    // percent of context to erase if we exceed the context window
+        std::string grammar;            // GBNF grammar the response must match, or empty for none
     };
 
     explicit LLModel() {}
@@ -154,6 +155,8 @@ public:
     virtual size_t stateSize() const = 0;
     virtual size_t saveState(std::span<uint8_t> stateOut, std::vector<Token> &inputTokensOut) const = 0;
     virtual size_t restoreState(std::span<const uint8_t> state, std::span<const Token> inputTokens) = 0;
+    // forget the tokens in the context, so that the next prompt is processed from the start
+    virtual void resetContext() { setModelInputPosition(0); }
 
     // This method requires the model to return true from supportsCompletion otherwise it will throw
     // an error
@@ -161,8 +164,33 @@ public:
                         const PromptCallback   &promptCallback,
                         const ResponseCallback &responseCallback,
                         const PromptContext    &ctx);
+    // the same as prompt(), with a prompt that is already tokenized, e.g. by tokenizePrompt
+    void promptTokens(std::span<const Token> tokens,
+                      const PromptCallback   &promptCallback,
+                      const ResponseCallback &responseCallback,
+                      const PromptContext    &ctx);
 
     virtual int32_t countPromptTokens(std::string_view prompt) const;
+    // tokenize a prompt the same way as prompt() does, and convert tokens back to text
+    std::vector<Token> tokenizePrompt(std::string_view prompt) const;
+    std::string detokenize(std::span<const Token> tokens) const;
+    // whether a token is a control or user-defined token, which prompt() only checks against whole stop sequences
+    bool isSpecial(Token id) const { return isSpecialToken(id); }
+
+    // Token-level generation, e.g. for speculative decoding. resetSampler sets the sampling parameters and clears the
+    // repetition penalty history. acceptSampled feeds the sampler tokens as if it had sampled them, to restore the
+    // repetition penalty history and grammar state of a response that is resumed. decodeAndSample evaluates the tokens
+    // not already in the context, then samples the token after each of the last nSample tokens, stopping after one
+    // that differs from the next input token or ends the response. Returns the number of tokens sampled. Unlike
+    // prompt(), it does not shift the context when full. sampledLogprob returns the log-probability of tok at the
+    // index'th position sampled by the last decodeAndSample, before temperature, penalties, etc. are applied.
+    // sampledTopLogprobs writes the most likely tokens at that position and their log-probabilities, most likely
+    // first, and returns how many it wrote.
+    void resetSampler(const PromptContext &ctx) { initSampler(ctx); }
+    void acceptSampled(std::span<const Token> tokens) { for (auto tok : tokens) acceptToken(tok); }
+    int32_t decodeAndSample(std::span<const Token> tokens, int32_t nSample, std::span<Token> sampledOut, bool *endOut);
+    float sampledLogprob(int32_t index, Token tok) const;
+    int32_t sampledTopLogprobs(int32_t index, std::span<Token> tokensOut, std::span<float> logprobsOut) const;
 
     virtual size_t embeddingSize() const {
         throw std::logic_error(std::string(implementation().modelType()) + " does not support embeddings");
@@ -228,6 +256,41 @@ protected:
     virtual const std::vector<Token> &endTokens() const = 0;
     virtual bool shouldAddBOS() const = 0;
 
+    // These are only needed for decodeAndSample
+    virtual bool evalTokensAllLogits(int32_t nPast, std::span<const Token> tokens) const
+    {
+        (void)nPast;
+        (void)tokens;
+        throw std::logic_error("This model does not support token-level decoding");
+    }
+
+    virtual Token sampleTokenAt(int32_t index) const
+    {
+        (void)index;
+        throw std::logic_error("This model does not support token-level decoding");
+    }
+
+    virtual void acceptToken(Token tok)
+    {
+        (void)tok;
+        throw std::logic_error("This model does not support token-level decoding");
+    }
+
+    virtual float tokenLogprob(int32_t index, Token tok) const
+    {
+        (void)index;
+        (void)tok;
+        throw std::logic_error("This model does not support token-level decoding");
+    }
+
+    virtual int32_t topLogprobs(int32_t index, std::span<Token> tokensOut, std::span<float> logprobsOut) const
+    {
+        (void)index;
+        (void)tokensOut;
+        (void)logprobsOut;
+        throw std::logic_error("This model does not support token-level decoding");
+    }
+
     virtual int32_t maxContextLength(std::string const &modelPath) const
     {
         (void)modelPath;
@@ -257,12 +320,17 @@ protected:
         return true;
     }
 
+    // check that the model can be prompted, then decode the prompt and generate a response
+    void promptImpl(std::vector<Token>      embd_inp,
+                    const PromptCallback   &promptCallback,
+                    const ResponseCallback &responseCallback,
+                    const PromptContext    &promptCtx);
     // prefill context with prompt
     auto decodePrompt(const PromptCallback &promptCallback,
                       const PromptContext  &promptCtx,
                       std::vector<Token>    embd_inp)
         -> std::optional<int32_t>;
-    // generate a response
+    // generate a response with the sampler promptImpl has built
     void generateResponse(const ResponseCallback &responseCallback,
                           const PromptContext    &promptCtx,
                           int32_t                 nPast);
@@ -44,6 +44,7 @@ struct llmodel_prompt_context {
     float   repeat_penalty; // penalty factor for repeated tokens
     int32_t repeat_last_n;  // last n tokens to penalize
     float   context_erase;  // percent of context to erase if we exceed the context window
+    const char *grammar;    // GBNF grammar with a "root" rule that the response must match, or NULL for none
 };
 
 struct llmodel_gpu_device {
@@ -182,6 +183,13 @@ void llmodel_state_free_input_tokens(token_t *input_tokens);
 uint64_t llmodel_state_set_data(llmodel_model model, const uint8_t *state, uint64_t state_size,
                                 const token_t *input_tokens, uint64_t n_input_tokens);
 
+/**
+ * Clear the model's context, so that the next prompt is processed from the start instead of reusing the tokens of
+ * previous prompts.
+ * @param model A pointer to the llmodel_model instance.
+ */
+void llmodel_reset_context(llmodel_model model);
+
 /**
  * Generate a response using the model.
  * @param model A pointer to the llmodel_model instance.
@@ -198,6 +206,24 @@ bool llmodel_prompt(llmodel_model               model,
                     llmodel_prompt_context     *ctx,
                     const char                **error);
 
+/**
+ * Generate a response to a prompt that is already tokenized, e.g. with llmodel_tokenize.
+ * @param model A pointer to the llmodel_model instance.
+ * @param tokens The token ids of the prompt, which are used as they are.
+ * @param n_tokens The number of tokens.
+ * @param prompt_callback A callback function for handling the processing of prompt.
+ * @param response_callback A callback function for handling the generated response.
+ * @param ctx A pointer to the llmodel_prompt_context structure.
+ * @param error A pointer to a string; will only be set on error.
+ */
+bool llmodel_prompt_tokens(llmodel_model               model,
+                           const token_t              *tokens,
+                           size_t                      n_tokens,
+                           llmodel_prompt_callback     prompt_callback,
+                           llmodel_response_callback   response_callback,
+                           llmodel_prompt_context     *ctx,
+                           const char                **error);
+
 /**
  * Generate an embedding using the model.
  * NOTE: If given NULL pointers for the model or text, or an empty text, a NULL pointer will be
@@ -310,6 +336,128 @@ const char *llmodel_model_gpu_device_name(llmodel_model model);
 
 int32_t llmodel_count_prompt_tokens(llmodel_model model, const char *prompt, const char **error);
 
+/**
+ * Count the tokens of several prompts in one call.
+ * @param model A pointer to the llmodel_model instance.
+ * @param prompts The prompts to count the tokens of.
+ * @param n_prompts The number of prompts.
+ * @param counts Receives the number of tokens of each prompt. Must have room for n_prompts counts.
+ * @param error A pointer to a string; will only be set on error.
+ * @return 0 on success, or -1 on error.
+ */
+int32_t llmodel_count_prompt_tokens_batch(llmodel_model model, const char **prompts, int32_t n_prompts,
+                                          int32_t *counts, const char **error);
+
+/**
+ * Tokenize a prompt the same way as llmodel_prompt does.
+ * @param model A pointer to the llmodel_model instance.
+ * @param prompt A string representing the prompt.
+ * @param tokens_out Where to store the address of the tokens. This is dynamically allocated and must be freed with
+ * llmodel_free_tokens.
+ * @param error A pointer to a string; will only be set on error.
+ * @return The number of tokens, or -1 on error.
+ */
+int32_t llmodel_tokenize(llmodel_model model, const char *prompt, token_t **tokens_out, const char **error);
+
+/**
+ * Frees the memory allocated by the llmodel_tokenize function.
+ * @param tokens The tokens as returned from llmodel_tokenize.
+ */
+void llmodel_free_tokens(token_t *tokens);
+
+/**
+ * Convert tokens to text.
+ * @param model A pointer to the llmodel_model instance.
+ * @param tokens An array of token ids.
+ * @param n_tokens The number of tokens in the array.
+ * @param text_size Where to store the size of the text in bytes, not including the terminating NUL.
+ * @param error A pointer to a string; will only be set on error.
+ * @return The UTF-8 text, which must be freed with llmodel_free_text, or NULL on error.
+ */
+char *llmodel_detokenize(llmodel_model model, const token_t *tokens, size_t n_tokens, size_t *text_size,
+                         const char **error);
+
+/**
+ * Check whether a token is a special token, such as a control token. llmodel_prompt only stops at a special token if
+ * its text is a whole stop sequence, and does not look for stop sequences in the text around it.
+ * @param model A pointer to the llmodel_model instance.
+ * @param token The token id.
+ * @return True if the token is a special token.
+ */
+bool llmodel_is_special_token(llmodel_model model, token_t token);
+
+/**
+ * Set the sampling parameters used by llmodel_decode_sample, and forget the tokens it sampled before, which are used
+ * for the repetition penalty.
+ * @param model A pointer to the llmodel_model instance.
+ * @param ctx A pointer to the llmodel_prompt_context structure. Only the sampling parameters are used.
+ * @param error A pointer to a string; will only be set on error, such as a grammar that fails to parse.
+ * @return True on success.
+ */
+bool llmodel_init_sampler(llmodel_model model, const llmodel_prompt_context *ctx, const char **error);
+
+/**
+ * Feed tokens to the sampler as if llmodel_decode_sample had sampled them, to restore the repetition penalty history
+ * and grammar state of a response that is resumed after llmodel_init_sampler.
+ * @param model A pointer to the llmodel_model instance.
+ * @param tokens An array of token ids.
+ * @param n_tokens The number of tokens in the array.
+ * @param error A pointer to a string; will only be set on error.
+ * @return True on success.
+ */
+bool llmodel_sampler_accept(llmodel_model model, const token_t *tokens, size_t n_tokens, const char **error);
+
+/**
+ * Evaluate a sequence of tokens and sample the tokens that follow, for token-level generation such as speculative
+ * decoding.
+ * The longest prefix of the tokens that is already in the model's context is reused. Then the token after each of the
+ * last n_sample tokens is sampled, in order, stopping early after a sampled token that differs from the next token of
+ * the sequence, or that ends the response. Unlike llmodel_prompt, this does not make room when the context is full.
+ * @param model A pointer to the llmodel_model instance.
+ * @param tokens An array of token ids.
+ * @param n_tokens The number of tokens in the array. Must not exceed the context length.
+ * @param n_sample The number of tokens to sample after, at most 128.
+ * @param sampled_out Where to store the sampled tokens. Must have room for n_sample tokens.
+ * @param end_out Where to store whether the last sampled token ends the response.
+ * @param error A pointer to a string; will only be set on error.
+ * @return The number of tokens sampled, or -1 on error.
+ */
+int32_t llmodel_decode_sample(llmodel_model model, const token_t *tokens, size_t n_tokens, int32_t n_sample,
+                              token_t *sampled_out, bool *end_out, const char **error);
+
+/**
+ * Get the log-probability of a token at one of the positions sampled by the last call to llmodel_decode_sample, under
+ * the model's own distribution, i.e. before the temperature, repetition penalty, grammar, etc. are applied.
+ * @param model A pointer to the llmodel_model instance.
+ * @param index The position, from 0 for the first token sampled.
+ * @param token The token id, usually the token that was sampled at that position.
+ * @param logprob_out Where to store the log-probability.
+ * @param error A pointer to a string; will only be set on error.
+ * @return True on success.
+ */
+bool llmodel_sampled_logprob(llmodel_model model, int32_t index, token_t token, float *logprob_out,
+                             const char **error);
+
+/**
+ * Get the most likely tokens at one of the positions sampled by the last call to llmodel_decode_sample, and their
+ * log-probabilities as for llmodel_sampled_logprob, most likely first.
+ * @param model A pointer to the llmodel_model instance.
+ * @param index The position, from 0 for the first token sampled.
+ * @param n_top The number of tokens to get.
+ * @param tokens_out Where to store the token ids. Must have room for n_top tokens.
+ * @param logprobs_out Where to store the log-probabilities. Must have room for n_top values.
+ * @param error A pointer to a string; will only be set on error.
+ * @return The number of tokens stored, which is less than n_top only if the vocabulary is smaller, or -1 on error.
+ */
+int32_t llmodel_sampled_top_logprobs(llmodel_model model, int32_t index, int32_t n_top, token_t *tokens_out,
+                                     float *logprobs_out, const char **error);
+
+/**
+ * Frees the memory allocated by the llmodel_detokenize function.
+ * @param text The text as returned from llmodel_detokenize.
+ */
+void llmodel_free_text(char *text);
+
 void llmodel_model_foreach_special_token(llmodel_model model, llmodel_special_token_callback callback);
 
 #ifdef __cplusplus
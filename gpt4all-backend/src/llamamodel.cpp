@@ -521,6 +521,12 @@ size_t LLamaModel::restoreState(std::span<const uint8_t> state, std::span<const
     return bytesRead;
 }
 
+void LLamaModel::resetContext()
+{
+    llama_kv_cache_seq_rm(d_ptr->ctx, 0, 0, -1);
+    d_ptr->inputTokens.clear();
+}
+
 std::vector<LLModel::Token> LLamaModel::tokenize(std::string_view str) const
 {
     std::vector<LLModel::Token> fres(str.length() + 4);
@@ -579,6 +585,13 @@ void LLamaModel::initSampler(const PromptContext &promptCtx)
             /*ignore_eos*/      false
         )
     );
+    if (!promptCtx.grammar.empty()) {
+        // masks the tokens that cannot continue the grammar, and allows the end of text only once it is complete
+        auto *grammar = llama_sampler_init_grammar(model, promptCtx.grammar.c_str(), "root");
+        if (!grammar)
+            throw std::invalid_argument("failed to parse grammar");
+        llama_sampler_chain_add(chain, grammar);
+    }
     if (promptCtx.temp == 0.0f) {
         llama_sampler_chain_add(chain, llama_sampler_init_greedy());
     } else {
@@ -600,6 +613,58 @@ LLModel::Token LLamaModel::sampleToken() const
     return llama_sampler_sample(d_ptr->sampler_chain, d_ptr->ctx, -1);
 }
 
+LLModel::Token LLamaModel::sampleTokenAt(int32_t index) const
+{
+    return llama_sampler_sample(d_ptr->sampler_chain, d_ptr->ctx, index);
+}
+
+void LLamaModel::acceptToken(Token tok)
+{
+    llama_sampler_accept(d_ptr->sampler_chain, tok);
+}
+
+// the amount to subtract from a logit to get a log-probability, shifted by the largest logit to avoid overflow
+static float log_softmax_offset(const float *logits, int32_t n_vocab)
+{
+    float maxLogit = *std::max_element(logits, logits + n_vocab);
+    double sum = 0.0;
+    for (int32_t i = 0; i < n_vocab; i++)
+        sum += std::exp(double(logits[i] - maxLogit));
+    return maxLogit + float(std::log(sum));
+}
+
+float LLamaModel::tokenLogprob(int32_t index, Token tok) const
+{
+    const float *logits = llama_get_logits_ith(d_ptr->ctx, index);
+    if (!logits)
+        throw std::out_of_range("No logits at this sampling position.");
+    int32_t nVocab = llama_n_vocab(d_ptr->model);
+    if (tok < 0 || tok >= nVocab)
+        throw std::out_of_range("Invalid token id.");
+    return logits[tok] - log_softmax_offset(logits, nVocab);
+}
+
+int32_t LLamaModel::topLogprobs(int32_t index, std::span<Token> tokensOut, std::span<float> logprobsOut) const
+{
+    const float *logits = llama_get_logits_ith(d_ptr->ctx, index);
+    if (!logits)
+        throw std::out_of_range("No logits at this sampling position.");
+    int32_t nVocab = llama_n_vocab(d_ptr->model);
+    auto n = int32_t(std::min(tokensOut.size(), size_t(nVocab)));
+
+    std::vector<Token> ids(nVocab);
+    std::iota(ids.begin(), ids.end(), 0);
+    std::partial_sort(ids.begin(), ids.begin() + n, ids.end(), [logits](Token a, Token b) {
+        return logits[a] > logits[b];
+    });
+    float offset = log_softmax_offset(logits, nVocab);
+    for (int32_t i = 0; i < n; i++) {
+        tokensOut[i] = ids[i];
+        logprobsOut[i] = logits[ids[i]] - offset;
+    }
+    return n;
+}
+
 bool LLamaModel::evalTokens(int32_t nPast, std::span<const Token> tokens) const
 {
     assert(!tokens.empty());
@@ -626,6 +691,29 @@ bool LLamaModel::evalTokens(int32_t nPast, std::span<const Token> tokens) const
     return res == 0;
 }
 
+bool LLamaModel::evalTokensAllLogits(int32_t nPast, std::span<const Token> tokens) const
+{
+    assert(!tokens.empty());
+
+    llama_kv_cache_seq_rm(d_ptr->ctx, 0, nPast, -1);
+
+    llama_batch batch = llama_batch_init(tokens.size(), 0, 1);
+
+    batch.n_tokens = tokens.size();
+
+    for (int32_t i = 0; i < batch.n_tokens; i++) {
+        batch.token   [i] = tokens[i];
+        batch.pos     [i] = nPast + i;
+        batch.n_seq_id[i] = 1;
+        batch.seq_id  [i][0] = 0;
+        batch.logits  [i] = true; // so that the token after each one can be sampled
+    }
+
+    int res = llama_decode(d_ptr->ctx, batch);
+    llama_batch_free(batch);
+    return res == 0;
+}
+
 void LLamaModel::shiftContext(const PromptContext &promptCtx, int32_t *nPast)
 {
     // infinite text generation via context shifting
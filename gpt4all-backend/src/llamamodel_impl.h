@@ -31,6 +31,7 @@ public:
     size_t stateSize() const override;
     size_t saveState(std::span<uint8_t> stateOut, std::vector<Token> &inputTokensOut) const override;
     size_t restoreState(std::span<const uint8_t> state, std::span<const Token> inputTokens) override;
+    void resetContext() override;
     void setThreadCount(int32_t n_threads) override;
     int32_t threadCount() const override;
     std::vector<GPUDevice> availableGPUDevices(size_t memoryRequired = 0) const override;
@@ -59,6 +60,11 @@ protected:
     void initSampler(const PromptContext &ctx) override;
     Token sampleToken() const override;
     bool evalTokens(int32_t nPast, std::span<const Token> tokens) const override;
+    bool evalTokensAllLogits(int32_t nPast, std::span<const Token> tokens) const override;
+    Token sampleTokenAt(int32_t index) const override;
+    void acceptToken(Token tok) override;
+    float tokenLogprob(int32_t index, Token tok) const override;
+    int32_t topLogprobs(int32_t index, std::span<Token> tokensOut, std::span<float> logprobsOut) const override;
     void shiftContext(const PromptContext &promptCtx, int32_t *nPast) override;
     int32_t inputLength() const override;
     int32_t computeModelInputPosition(std::span<const Token> input) const override;
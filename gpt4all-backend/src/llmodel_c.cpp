@@ -43,6 +43,22 @@ static void llmodel_set_error(const char **errptr, const char *message)
     }
 }
 
+static LLModel::PromptContext promptContextFromC(const llmodel_prompt_context *ctx)
+{
+    return {
+        .n_predict      = ctx->n_predict,
+        .top_k          = ctx->top_k,
+        .top_p          = ctx->top_p,
+        .min_p          = ctx->min_p,
+        .temp           = ctx->temp,
+        .n_batch        = ctx->n_batch,
+        .repeat_penalty = ctx->repeat_penalty,
+        .repeat_last_n  = ctx->repeat_last_n,
+        .contextErase   = ctx->context_erase,
+        .grammar        = ctx->grammar ? ctx->grammar : "",
+    };
+}
+
 llmodel_model llmodel_model_create2(const char *model_path, const char *backend, const char **error)
 {
     LLModel *llModel;
@@ -124,38 +140,33 @@ uint64_t llmodel_state_set_data(llmodel_model model, const uint8_t *state, uint6
     return wrapper->llModel->restoreState({state, size_t(state_size)}, {input_tokens, size_t(n_input_tokens)});
 }
 
-bool llmodel_prompt(llmodel_model               model,
-                    const char                 *prompt,
-                    llmodel_prompt_callback     prompt_callback,
-                    llmodel_response_callback   response_callback,
-                    llmodel_prompt_context     *ctx,
-                    const char                **error)
+void llmodel_reset_context(llmodel_model model)
 {
     auto *wrapper = static_cast<LLModelWrapper *>(model);
+    wrapper->llModel->resetContext();
+}
 
+// Run a prompt with C callbacks and prompt context, converted for LLModel::prompt or LLModel::promptTokens
+template <typename PromptFunc>
+static bool promptWithCallbacks(llmodel_prompt_callback     prompt_callback,
+                                llmodel_response_callback   response_callback,
+                                llmodel_prompt_context     *ctx,
+                                const char                **error,
+                                const PromptFunc           &promptFunc)
+{
     // Copy the C prompt context
-    LLModel::PromptContext promptContext {
-        .n_predict      = ctx->n_predict,
-        .top_k          = ctx->top_k,
-        .top_p          = ctx->top_p,
-        .min_p          = ctx->min_p,
-        .temp           = ctx->temp,
-        .n_batch        = ctx->n_batch,
-        .repeat_penalty = ctx->repeat_penalty,
-        .repeat_last_n  = ctx->repeat_last_n,
-        .contextErase   = ctx->context_erase,
-    };
+    auto promptContext = promptContextFromC(ctx);
 
-    auto prompt_func = [prompt_callback](std::span<const LLModel::Token> token_ids, bool cached) {
+    LLModel::PromptCallback prompt_func = [prompt_callback](std::span<const LLModel::Token> token_ids, bool cached) {
         return prompt_callback(token_ids.data(), token_ids.size(), cached);
     };
-    auto response_func = [response_callback](LLModel::Token token_id, std::string_view piece) {
+    LLModel::ResponseCallback response_func = [response_callback](LLModel::Token token_id, std::string_view piece) {
         return response_callback(token_id, piece.data());
     };
 
     // Call the C++ prompt method
     try {
-        wrapper->llModel->prompt(prompt, prompt_func, response_func, promptContext);
+        promptFunc(prompt_func, response_func, promptContext);
     } catch (std::exception const &e) {
         llmodel_set_error(error, e.what());
         return false;
@@ -164,6 +175,35 @@ bool llmodel_prompt(llmodel_model               model,
     return true;
 }
 
+bool llmodel_prompt(llmodel_model               model,
+                    const char                 *prompt,
+                    llmodel_prompt_callback     prompt_callback,
+                    llmodel_response_callback   response_callback,
+                    llmodel_prompt_context     *ctx,
+                    const char                **error)
+{
+    auto *wrapper = static_cast<LLModelWrapper *>(model);
+    return promptWithCallbacks(prompt_callback, response_callback, ctx, error,
+        [&](const auto &prompt_func, const auto &response_func, const auto &promptContext) {
+            wrapper->llModel->prompt(prompt, prompt_func, response_func, promptContext);
+        });
+}
+
+bool llmodel_prompt_tokens(llmodel_model               model,
+                           const token_t              *tokens,
+                           size_t                      n_tokens,
+                           llmodel_prompt_callback     prompt_callback,
+                           llmodel_response_callback   response_callback,
+                           llmodel_prompt_context     *ctx,
+                           const char                **error)
+{
+    auto *wrapper = static_cast<LLModelWrapper *>(model);
+    return promptWithCallbacks(prompt_callback, response_callback, ctx, error,
+        [&](const auto &prompt_func, const auto &response_func, const auto &promptContext) {
+            wrapper->llModel->promptTokens({tokens, n_tokens}, prompt_func, response_func, promptContext);
+        });
+}
+
 float *llmodel_embed(
     llmodel_model model, const char **texts, size_t *embedding_size, const char *prefix, int dimensionality,
     size_t *token_count, bool do_mean, bool atlas, llmodel_emb_cancel_callback cancel_cb, const char **error
@@ -312,6 +352,135 @@ int32_t llmodel_count_prompt_tokens(llmodel_model model, const char *prompt, con
     }
 }
 
+int32_t llmodel_count_prompt_tokens_batch(llmodel_model model, const char **prompts, int32_t n_prompts,
+                                          int32_t *counts, const char **error)
+{
+    auto *wrapper = static_cast<const LLModelWrapper *>(model);
+    try {
+        for (int32_t i = 0; i < n_prompts; i++)
+            counts[i] = wrapper->llModel->countPromptTokens(prompts[i]);
+    } catch (const std::exception& e) {
+        llmodel_set_error(error, e.what());
+        return -1;
+    }
+    return 0;
+}
+
+int32_t llmodel_tokenize(llmodel_model model, const char *prompt, token_t **tokens_out, const char **error)
+{
+    auto *wrapper = static_cast<const LLModelWrapper *>(model);
+    std::vector<LLModel::Token> tokens;
+    try {
+        tokens = wrapper->llModel->tokenizePrompt(prompt);
+    } catch (const std::exception& e) {
+        llmodel_set_error(error, e.what());
+        return -1;
+    }
+    *tokens_out = new token_t[tokens.size()];
+    ranges::copy(tokens, *tokens_out);
+    return int32_t(tokens.size());
+}
+
+void llmodel_free_tokens(token_t *tokens)
+{
+    delete[] tokens;
+}
+
+char *llmodel_detokenize(llmodel_model model, const token_t *tokens, size_t n_tokens, size_t *text_size,
+                         const char **error)
+{
+    auto *wrapper = static_cast<const LLModelWrapper *>(model);
+    std::string text;
+    try {
+        text = wrapper->llModel->detokenize({ tokens, n_tokens });
+    } catch (const std::exception& e) {
+        llmodel_set_error(error, e.what());
+        return nullptr;
+    }
+    auto *text_out = new char[text.size() + 1];
+    ranges::copy(text, text_out);
+    text_out[text.size()] = '\0';
+    *text_size = text.size();
+    return text_out;
+}
+
+bool llmodel_is_special_token(llmodel_model model, token_t token)
+{
+    auto *wrapper = static_cast<const LLModelWrapper *>(model);
+    return wrapper->llModel->isSpecial(token);
+}
+
+void llmodel_free_text(char *text)
+{
+    delete[] text;
+}
+
+bool llmodel_init_sampler(llmodel_model model, const llmodel_prompt_context *ctx, const char **error)
+{
+    auto *wrapper = static_cast<LLModelWrapper *>(model);
+
+    try {
+        wrapper->llModel->resetSampler(promptContextFromC(ctx));
+    } catch (const std::exception &e) {
+        llmodel_set_error(error, e.what());
+        return false;
+    }
+    return true;
+}
+
+bool llmodel_sampler_accept(llmodel_model model, const token_t *tokens, size_t n_tokens, const char **error)
+{
+    auto *wrapper = static_cast<LLModelWrapper *>(model);
+    try {
+        wrapper->llModel->acceptSampled({ tokens, n_tokens });
+    } catch (const std::exception &e) {
+        llmodel_set_error(error, e.what());
+        return false;
+    }
+    return true;
+}
+
+int32_t llmodel_decode_sample(llmodel_model model, const token_t *tokens, size_t n_tokens, int32_t n_sample,
+                              token_t *sampled_out, bool *end_out, const char **error)
+{
+    auto *wrapper = static_cast<LLModelWrapper *>(model);
+    try {
+        return wrapper->llModel->decodeAndSample({ tokens, n_tokens }, n_sample, { sampled_out, size_t(n_sample) },
+                                                 end_out);
+    } catch (const std::exception& e) {
+        llmodel_set_error(error, e.what());
+        return -1;
+    }
+}
+
+bool llmodel_sampled_logprob(llmodel_model model, int32_t index, token_t token, float *logprob_out,
+                             const char **error)
+{
+    auto *wrapper = static_cast<const LLModelWrapper *>(model);
+    try {
+        *logprob_out = wrapper->llModel->sampledLogprob(index, token);
+    } catch (const std::exception &e) {
+        llmodel_set_error(error, e.what());
+        return false;
+    }
+    return true;
+}
+
+int32_t llmodel_sampled_top_logprobs(llmodel_model model, int32_t index, int32_t n_top, token_t *tokens_out,
+                                     float *logprobs_out, const char **error)
+{
+    auto *wrapper = static_cast<const LLModelWrapper *>(model);
+    try {
+        if (n_top < 0)
+            throw std::invalid_argument("n_top must not be negative.");
+        return wrapper->llModel->sampledTopLogprobs(index, { tokens_out, size_t(n_top) },
+                                                    { logprobs_out, size_t(n_top) });
+    } catch (const std::exception &e) {
+        llmodel_set_error(error, e.what());
+        return -1;
+    }
+}
+
 void llmodel_model_foreach_special_token(llmodel_model model, llmodel_special_token_callback callback)
 {
     auto *wrapper = static_cast<const LLModelWrapper *>(model);
@@ -21,6 +21,26 @@ void LLModel::prompt(
     const PromptCallback   &promptCallback,
     const ResponseCallback &responseCallback,
     const PromptContext    &promptCtx
+) {
+    if (!isModelLoaded())
+        throw std::invalid_argument("Attempted to prompt an unloaded model.");
+    promptImpl(tokenize(prompt), promptCallback, responseCallback, promptCtx);
+}
+
+void LLModel::promptTokens(
+    std::span<const Token>  tokens,
+    const PromptCallback   &promptCallback,
+    const ResponseCallback &responseCallback,
+    const PromptContext    &promptCtx
+) {
+    promptImpl({ tokens.begin(), tokens.end() }, promptCallback, responseCallback, promptCtx);
+}
+
+void LLModel::promptImpl(
+    std::vector<Token>      embd_inp,
+    const PromptCallback   &promptCallback,
+    const ResponseCallback &responseCallback,
+    const PromptContext    &promptCtx
 ) {
     if (!isModelLoaded())
         throw std::invalid_argument("Attempted to prompt an unloaded model.");
@@ -30,11 +50,12 @@ void LLModel::prompt(
         throw std::invalid_argument("Batch size cannot be zero.");
     if (!promptCtx.n_predict)
         return; // nothing requested
-
-    auto embd_inp = tokenize(prompt);
     if (embd_inp.empty())
         throw std::invalid_argument("Prompt tokenized to zero tokens.");
 
+    // build the sampler before processing the prompt, so that an invalid grammar is reported without decoding anything
+    initSampler(promptCtx);
+
     if (auto res = decodePrompt(promptCallback, promptCtx, std::move(embd_inp)))
         generateResponse(responseCallback, promptCtx, /*n_past*/ *res);
 }
@@ -46,6 +67,87 @@ int32_t LLModel::countPromptTokens(std::string_view prompt) const
     return int32_t(tokenize(prompt).size());
 }
 
+auto LLModel::tokenizePrompt(std::string_view prompt) const -> std::vector<Token>
+{
+    if (!isModelLoaded())
+        throw std::invalid_argument("Attempted to tokenize with an unloaded model.");
+    return tokenize(prompt);
+}
+
+std::string LLModel::detokenize(std::span<const Token> tokens) const
+{
+    if (!isModelLoaded())
+        throw std::invalid_argument("Attempted to detokenize with an unloaded model.");
+    std::string text;
+    for (auto tok : tokens)
+        text += tokenToString(tok);
+    return text;
+}
+
+int32_t LLModel::decodeAndSample(
+    std::span<const Token> tokens, int32_t nSample, std::span<Token> sampledOut, bool *endOut
+) {
+    if (!isModelLoaded())
+        throw std::invalid_argument("Attempted to decode with an unloaded model.");
+    if (!supportsCompletion())
+        throw std::invalid_argument("Not a text completion model.");
+    auto nTokens = int32_t(tokens.size());
+    if (nSample < 1 || nSample > nTokens || nSample > LLMODEL_MAX_PROMPT_BATCH || sampledOut.size() < size_t(nSample))
+        throw std::invalid_argument("Invalid number of tokens to sample.");
+    if (nTokens > contextLength())
+        throw std::length_error("The tokens do not fit in the context window.");
+
+    // reuse the tokens already in the context, except those to sample after, which need fresh logits
+    int32_t nPast = std::min(computeModelInputPosition(tokens), nTokens - nSample);
+    setModelInputPosition(nPast);
+    while (nPast < nTokens) {
+        bool last = nPast >= nTokens - nSample;
+        int32_t end = last ? nTokens : std::min(nPast + LLMODEL_MAX_PROMPT_BATCH, nTokens - nSample);
+        auto batch = tokens.subspan(nPast, end - nPast);
+        if (!(last ? evalTokensAllLogits(nPast, batch) : evalTokens(nPast, batch)))
+            throw std::runtime_error("An internal error was encountered during prompt processing.");
+        for (auto tok : batch)
+            appendInputToken(tok);
+        nPast = end;
+    }
+
+    *endOut = false;
+    int32_t nSampled = 0;
+    while (nSampled < nSample) {
+        Token tok = sampleTokenAt(nSampled);
+        sampledOut[nSampled++] = tok;
+        if (ranges::find(endTokens(), tok) != endTokens().end()) {
+            *endOut = true;
+            break;
+        }
+        if (nSampled < nSample && tok != tokens[nTokens - nSample + nSampled])
+            break; // the rest of the input is not what the model would generate
+    }
+    return nSampled;
+}
+
+float LLModel::sampledLogprob(int32_t index, Token tok) const
+{
+    if (!isModelLoaded())
+        throw std::invalid_argument("Attempted to decode with an unloaded model.");
+    if (index < 0 || index >= LLMODEL_MAX_PROMPT_BATCH)
+        throw std::out_of_range("Invalid sampling position.");
+    return tokenLogprob(index, tok);
+}
+
+int32_t LLModel::sampledTopLogprobs(int32_t index, std::span<Token> tokensOut, std::span<float> logprobsOut) const
+{
+    if (!isModelLoaded())
+        throw std::invalid_argument("Attempted to decode with an unloaded model.");
+    if (index < 0 || index >= LLMODEL_MAX_PROMPT_BATCH)
+        throw std::out_of_range("Invalid sampling position.");
+    if (logprobsOut.size() < tokensOut.size())
+        throw std::invalid_argument("Not enough room for the log-probabilities.");
+    if (tokensOut.empty())
+        return 0;
+    return topLogprobs(index, tokensOut, logprobsOut);
+}
+
 auto LLModel::decodePrompt(
     const PromptCallback &promptCallback,
     const PromptContext  &promptCtx,
@@ -149,8 +251,6 @@ void LLModel::generateResponse(
         "<|im_start|>", "<|im_end|>", "<|endoftext|>",
     };
 
-    initSampler(promptCtx);
-
     std::string cachedResponse;
     std::vector<Token> cachedTokens;
     int n_predicted = 0;
@@ -1 +1,7 @@
-from .gpt4all import CancellationError as CancellationError, Embed4All as Embed4All, GPT4All as GPT4All
+from .gpt4all import (CancellationError as CancellationError, DeadlineExceededError as DeadlineExceededError,
+                      Embed4All as Embed4All, Embed4AllPool as Embed4AllPool, EmbeddingCache as EmbeddingCache,
+                      GPT4All as GPT4All, HistoryPolicy as HistoryPolicy, KeepLastTurns as KeepLastTurns,
+                      ModelRegistry as ModelRegistry, PrefixCache as PrefixCache, Scheduler as Scheduler,
+                      SchemaValidationError as SchemaValidationError, SlidingWindow as SlidingWindow,
+                      SummarizeOlderTurns as SummarizeOlderTurns, TokenLogprobs as TokenLogprobs,
+                      json_schema_to_grammar as json_schema_to_grammar, validate_json as validate_json)
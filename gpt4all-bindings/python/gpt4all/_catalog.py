@@ -0,0 +1,95 @@
+"""
+Local cache of the model list, revalidated with conditional requests.
+"""
+from __future__ import annotations
+
+import json
+import os
+import time
+import warnings
+from pathlib import Path
+from typing import Any
+
+
+def read_cached_models(cache_path: str | os.PathLike[str], url: str) -> list[dict[str, Any]] | None:
+    """Return the cached model list fetched from url, regardless of its age, or None if there is none."""
+    entry = _read_entry(Path(cache_path), url)
+    return None if entry is None else entry["models"]
+
+
+def fetch_models(cache_path: str | os.PathLike[str], url: str, max_age: float) -> list[dict[str, Any]]:
+    """
+    Return the model list, using the cached copy if it is younger than max_age seconds.
+
+    An older copy is revalidated with If-None-Match/If-Modified-Since, so an unchanged list is not downloaded again.
+    If the request fails, a cached copy of any age is used instead, with a warning.
+    """
+    cache_path = Path(cache_path)
+    entry = _read_entry(cache_path, url)
+    now = time.time()
+    if entry is not None and 0 <= now - entry["fetched_at"] < max_age:
+        return entry["models"]
+
+    import requests
+
+    headers = {}
+    if entry is not None:
+        if entry.get("etag") is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified") is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        resp = requests.get(url, headers=headers, timeout=30)
+    except requests.RequestException as e:
+        if entry is None:
+            raise
+        warnings.warn(f"Failed to refresh the model list, using a cached copy: {e}")
+        return entry["models"]
+
+    if resp.status_code == 304 and entry is not None:
+        models = entry["models"]
+    elif resp.status_code == 200:
+        models = resp.json()
+    elif entry is not None:
+        warnings.warn(
+            f"Failed to refresh the model list, using a cached copy: HTTP {resp.status_code} {resp.reason}"
+        )
+        return entry["models"]
+    else:
+        raise ValueError(f"Request failed: HTTP {resp.status_code} {resp.reason}")
+
+    _write_entry(cache_path, {
+        "url"          : url,
+        "etag"         : resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "fetched_at"   : now,
+        "models"       : models,
+    })
+    return models
+
+
+def _read_entry(path: Path, url: str) -> dict[str, Any] | None:
+    try:
+        with open(path, encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get("url") != url or "models" not in entry or "fetched_at" not in entry:
+        return None
+    return entry
+
+
+def _write_entry(path: Path, entry: dict[str, Any]) -> None:
+    # the cache is an optimization, so failing to write it is not an error
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        os.makedirs(path.parent, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
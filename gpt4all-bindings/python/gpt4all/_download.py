@@ -0,0 +1,251 @@
+"""
+Segmented, parallel, resumable downloads using HTTP range requests.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, NamedTuple, Protocol
+
+import requests
+from tqdm import tqdm
+
+if sys.platform == "darwin":
+    import fcntl
+
+_BLOCK_SIZE = 2**20  # 1 MB
+_SEGMENT_SIZE = 32 * 2**20
+_MAX_RETRIES = 5
+_MANIFEST_VERSION = 1
+
+
+class RemoteFile(NamedTuple):
+    size: int
+    """The size of the file, in bytes."""
+    validator: str | None
+    """A strong ETag or Last-Modified date, used to detect a file that changes on the server mid-download."""
+
+
+def probe_range_support(url: str) -> RemoteFile | None:
+    """
+    Check whether a server supports range requests for a file.
+
+    Returns:
+        The size and validator of the file, or None if range requests are not supported.
+    """
+    headers = {"Range": "bytes=0-0", "Accept-Encoding": "identity"}
+    with requests.get(url, stream=True, headers=headers, timeout=60) as response:
+        if response.status_code != 206 or "Content-Encoding" in response.headers:
+            return None
+        _, _, total = response.headers.get("Content-Range", "").rpartition("/")
+        if not total.isdigit():
+            return None  # unknown size
+        validator = response.headers.get("ETag")
+        if validator is None or validator.startswith("W/"):
+            # weak ETags cannot be used with If-Range
+            validator = response.headers.get("Last-Modified")
+        return RemoteFile(int(total), validator)
+
+
+def download_segmented(
+    url: str,
+    partial_path: str | os.PathLike[str],
+    remote: RemoteFile,
+    connections: int,
+    expected_md5: str | None = None,
+    segment_size: int | None = None,
+    verbose: bool = False,
+) -> None:
+    """
+    Download a file into a preallocated partial file, in segments fetched over several connections at once.
+
+    Completed segments are recorded in a JSON manifest next to the partial file, so an interrupted download is resumed
+    by a later call, from any process. The MD5 hash is computed as segments complete in order, overlapping with the
+    rest of the download. The manifest is removed once the download is complete and verified.
+
+    Raises:
+        ValueError: If the file changed on the server, or does not match the expected hash. The partial file is
+            removed, so the next attempt starts over.
+    """
+    if segment_size is None:
+        segment_size = _SEGMENT_SIZE
+    partial_path = Path(partial_path)
+    manifest_path = partial_path.with_name(partial_path.name + ".json")
+    identity = {
+        "version": _MANIFEST_VERSION, "url": url, "size": remote.size, "validator": remote.validator,
+        "segment_size": segment_size,
+    }
+    n_segments = max(1, -(-remote.size // segment_size))
+
+    done: set[int] = set()
+    manifest = _read_manifest(manifest_path)
+    try:
+        resumable = manifest is not None and manifest["identity"] == identity \
+            and partial_path.stat().st_size == remote.size
+    except (KeyError, OSError):
+        resumable = False
+    if resumable:
+        assert manifest is not None
+        done.update(manifest["done"])
+        if verbose:
+            print(f"Resuming download with {len(done)} of {n_segments} segments complete", file=sys.stderr)
+    else:
+        with open(partial_path, "wb") as f:
+            _preallocate(f, remote.size)
+        _write_manifest(manifest_path, identity, done)
+
+    def segment_bounds(index: int) -> tuple[int, int]:
+        start = index * segment_size
+        return start, min(start + segment_size, remote.size)
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    bytes_done = sum(end - start for start, end in map(segment_bounds, done))
+
+    with tqdm(desc="Downloading", total=remote.size, initial=bytes_done, unit="iB", unit_scale=True) as progress_bar:
+        def on_progress(n: int) -> None:
+            with lock:
+                progress_bar.update(n)
+
+        def fetch(index: int) -> None:
+            start, end = segment_bounds(index)
+            if _fetch_range(url, partial_path, start, end, remote.validator, stop, on_progress):
+                with lock:
+                    done.add(index)
+                    _write_manifest(manifest_path, identity, done)
+
+        executor = ThreadPoolExecutor(max_workers=connections, thread_name_prefix="download")
+        futures: dict[int, Future[None]] = {
+            i: executor.submit(fetch, i) for i in range(n_segments) if i not in done
+        }
+        try:
+            hsh = None if expected_md5 is None else hashlib.md5()
+            with open(partial_path, "rb") as reader:
+                for i in range(n_segments):
+                    if i in futures:
+                        futures[i].result()
+                    if hsh is not None:
+                        # hash each segment once it and all the segments before it are complete
+                        start, end = segment_bounds(i)
+                        reader.seek(start)
+                        remaining = end - start
+                        while remaining and (chunk := reader.read(min(_BLOCK_SIZE, remaining))):
+                            hsh.update(chunk)
+                            remaining -= len(chunk)
+        except BaseException as e:
+            stop.set()
+            for future in futures.values():
+                future.cancel()
+            executor.shutdown()
+            if isinstance(e, _RemoteChanged):
+                _remove(partial_path, manifest_path)
+                raise ValueError(str(e)) from None
+            if verbose:
+                print(f"Download interrupted, {len(done)} of {n_segments} segments will be reused", file=sys.stderr)
+            raise
+        executor.shutdown()
+
+    if hsh is not None and hsh.hexdigest() != expected_md5.lower():  # type: ignore[union-attr]
+        _remove(partial_path, manifest_path)
+        raise ValueError(f"Expected MD5 hash of {expected_md5!r}, got {hsh.hexdigest()!r}")
+
+    with open(partial_path, "r+b") as f:
+        _fsync(f)
+    _remove(manifest_path)
+
+
+class _RemoteChanged(Exception):
+    pass
+
+
+def _fetch_range(
+    url: str, path: Path, start: int, end: int, validator: str | None, stop: threading.Event,
+    on_progress: Any,
+) -> bool:
+    # Download bytes [start, end) of the file into the same range of path. Returns False if stopped early.
+    pos = start
+    failures = 0
+    with open(path, "r+b") as f:
+        while pos < end:
+            headers = {"Range": f"bytes={pos}-{end - 1}", "Accept-Encoding": "identity"}
+            if validator is not None:
+                headers["If-Range"] = validator
+            last_pos = pos
+            try:
+                with requests.get(url, stream=True, headers=headers, timeout=60) as response:
+                    if response.status_code == 200 and validator is not None:
+                        raise _RemoteChanged("The file changed on the server during the download")
+                    if response.status_code != 206:
+                        raise ValueError(f"Request failed: HTTP {response.status_code} {response.reason}")
+                    f.seek(pos)
+                    for data in response.iter_content(_BLOCK_SIZE):
+                        if stop.is_set():
+                            return False
+                        data = data[:end - pos]
+                        f.write(data)
+                        pos += len(data)
+                        on_progress(len(data))
+                        if pos >= end:
+                            break
+            except requests.RequestException:
+                pass  # the connection was interrupted - retry
+            if pos < end:
+                failures = 0 if pos > last_pos else failures + 1
+                if failures > _MAX_RETRIES:
+                    raise RuntimeError("Download not making progress, aborting.")
+        f.flush()
+        _fsync(f)
+    return True
+
+
+def _preallocate(f: Any, size: int) -> None:
+    f.truncate(size)
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass  # not supported by the filesystem, the file is sparse
+
+
+def _read_manifest(path: Path) -> dict[str, Any] | None:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(path: Path, identity: dict[str, Any], done: set[int]) -> None:
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"identity": identity, "done": sorted(done)}, f)
+    os.replace(tmp_path, path)
+
+
+def _remove(*paths: Path) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class _HasFileno(Protocol):
+    def fileno(self) -> int: ...
+
+
+def _fsync(fd: int | _HasFileno) -> None:
+    if sys.platform == "darwin":
+        # Apple's fsync does not flush the drive write cache
+        try:
+            fcntl.fcntl(fd, fcntl.F_FULLFSYNC)
+        except OSError:
+            pass  # fall back to fsync
+        else:
+            return
+    os.fsync(fd)
@@ -0,0 +1,152 @@
+"""
+Content-addressed cache of embeddings, with an in-memory LRU tier and an optional SQLite tier on disk.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Iterable
+
+if TYPE_CHECKING:
+    import sqlite3
+
+
+class EmbeddingCache:
+    """
+    A cache of embeddings keyed by the model, the embedding options, and the text itself.
+
+    Recently used embeddings are kept in memory. If a path is given, all embeddings are also stored in an SQLite
+    database there, so they are reused across runs and may be shared between processes.
+    """
+
+    def __init__(self, path: str | os.PathLike[str] | None = None, max_memory_entries: int = 100_000):
+        """
+        Constructor
+
+        Args:
+            path: Path to an SQLite database to use as a persistent tier, created if it does not exist. Default is None,
+                in which case embeddings are only cached in memory.
+            max_memory_entries: The maximum number of embeddings to keep in memory.
+        """
+        if max_memory_entries < 0:
+            raise ValueError(f"max_memory_entries must not be negative, got {max_memory_entries}")
+        self.max_memory_entries = max_memory_entries
+        self.hits = 0
+        """The number of embeddings found in the cache."""
+        self.misses = 0
+        """The number of embeddings that had to be generated by the model."""
+
+        self._memory: OrderedDict[bytes, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        if path is not None:
+            import sqlite3
+
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+            self._db.commit()
+
+    def close(self) -> None:
+        """Close the database, if any."""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    @staticmethod
+    def model_id(model_path: str | os.PathLike[str], md5sum: str | None = None) -> str:
+        """
+        Identify a model file by its contents.
+
+        Args:
+            model_path: Path to the model file.
+            md5sum: The MD5 hash of the file, if known, e.g. from the model list. Otherwise, a fingerprint is computed
+                from the size of the file and its first and last MiB, which is much faster than hashing all of it.
+        """
+        if md5sum is not None:
+            return f"md5:{md5sum.lower()}"
+        chunk = 2**20
+        hsh = hashlib.sha256()
+        with open(model_path, "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            hsh.update(str(size).encode())
+            f.seek(0)
+            hsh.update(f.read(chunk))
+            f.seek(max(0, size - chunk))
+            hsh.update(f.read(chunk))
+        return f"fp:{hsh.hexdigest()}"
+
+    @staticmethod
+    def key(
+        model_id: str, prefix: str | None, dimensionality: int, do_mean: bool, atlas: bool, text: str,
+    ) -> bytes:
+        """Compute the cache key for the embedding of a text."""
+        hsh = hashlib.sha256()
+        # atlas is included because it changes which texts are rejected as too long
+        long_text_mode = "mean" if do_mean else "truncate"
+        for part in (model_id, "\0" if prefix is None else prefix, str(dimensionality), long_text_mode, str(atlas)):
+            hsh.update(part.encode())
+            hsh.update(b"\0")
+        hsh.update(text.encode())
+        return hsh.digest()
+
+    def get(self, keys: Iterable[bytes]) -> dict[bytes, bytes]:
+        """
+        Look up embeddings, updating the hit and miss counters.
+
+        Returns:
+            A dict mapping each key that was found to its embedding, as float32 bytes.
+        """
+        keys = list(dict.fromkeys(keys))
+        found: dict[bytes, bytes] = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                if (vector := self._memory.get(key)) is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector
+                else:
+                    missing.append(key)
+
+            if missing and self._db is not None:
+                # stay well under SQLite's limit on the number of host parameters
+                for i in range(0, len(missing), 500):
+                    part = missing[i:i + 500]
+                    rows = self._db.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part,
+                    )
+                    for key, vector in rows:
+                        found[key] = vector
+                        self._remember(key, vector)
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, items: dict[bytes, bytes]) -> None:
+        """Store embeddings, given as float32 bytes."""
+        with self._lock:
+            for key, vector in items.items():
+                self._remember(key, vector)
+            if self._db is not None:
+                self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)", items.items())
+                self._db.commit()
+
+    def _remember(self, key: bytes, vector: bytes) -> None:
+        if not self.max_memory_entries:
+            return
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all cached embeddings. The hit and miss counters are not reset."""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
@@ -0,0 +1,388 @@
+"""
+Constrained generation: converting JSON schemas to GBNF grammars, and validating responses against them.
+"""
+from __future__ import annotations
+
+import json
+import math
+import re
+from fractions import Fraction
+from typing import Any
+
+# Whitespace is limited so that the model cannot keep generating it forever
+_PRIMITIVE_RULES = {
+    "space":         '| " " | "\\n" [ \\t]{0,20}',
+    "boolean":       '("true" | "false") space',
+    "null":          '"null" space',
+    "integral-part": '[0] | [1-9] [0-9]{0,15}',
+    "decimal-part":  '[0-9]{1,16}',
+    "integer":       '("-"? integral-part) space',
+    "number":        '("-"? integral-part) ("." decimal-part)? ([eE] [-+]? integral-part)? space',
+    "char":          '[^"\\\\\\x7F\\x00-\\x1F] | [\\\\] (["\\\\bfnrt] | "u" [0-9a-fA-F]{4})',
+    "string":        '"\\"" char* "\\"" space',
+    "array":         '"[" space (value ("," space value)*)? "]" space',
+    "object":        '"{" space (string ":" space value ("," space string ":" space value)*)? "}" space',
+    "value":         'object | array | string | number | boolean | null',
+}
+
+_PRIMITIVE_DEPENDENCIES = {
+    "boolean":       ["space"],
+    "null":          ["space"],
+    "integer":       ["integral-part", "space"],
+    "number":        ["integral-part", "decimal-part", "space"],
+    "string":        ["char", "space"],
+    "array":         ["value"],
+    "object":        ["string", "value"],
+    "value":         ["object", "array", "string", "number", "boolean", "null"],
+}
+
+# These only narrow down the values of a type, so the grammar allows any value of the type and validate_json checks them
+_VALUE_KEYWORDS = frozenset((
+    "minimum", "maximum", "exclusiveMinimum", "exclusiveMaximum", "multipleOf", "pattern", "format", "uniqueItems",
+    "additionalProperties",
+))
+_ANNOTATION_KEYWORDS = frozenset((
+    "$schema", "$id", "$comment", "title", "description", "default", "examples", "$defs", "definitions", "readOnly",
+    "writeOnly", "deprecated",
+))
+_SUPPORTED_KEYWORDS = _VALUE_KEYWORDS | _ANNOTATION_KEYWORDS | {
+    "type", "enum", "const", "anyOf", "oneOf", "$ref", "properties", "required", "items", "minItems", "maxItems",
+    "minLength", "maxLength",
+}
+
+_JSON_TYPES = ("object", "array", "string", "number", "integer", "boolean", "null")
+
+
+class SchemaValidationError(ValueError):
+    """Raised by `validate_json` if a response is not valid JSON or does not match the schema."""
+
+    def __init__(self, path: str, message: str):
+        super().__init__(f"{path}: {message}")
+        self.path = path
+        """The location of the invalid value, such as `$.items[2].name`."""
+
+
+def json_schema_to_grammar(schema: dict[str, Any] | bool) -> str:
+    """
+    Convert a JSON schema to a GBNF grammar that matches JSON documents of that shape.
+
+    Objects are generated with their properties in the order the schema lists them, required properties first, and
+    without additional properties. Keywords that only narrow down the values of a type, such as `minimum` or `pattern`,
+    are not part of the grammar; use `validate_json` to check them.
+
+    Args:
+        schema: The JSON schema. References are supported to `#/$defs/...` and `#/definitions/...`.
+
+    Returns:
+        The grammar, whose `root` rule matches the whole document.
+
+    Raises:
+        ValueError: If the schema uses a keyword that cannot be expressed as a grammar, such as `allOf`.
+    """
+    return _SchemaConverter(schema).convert()
+
+
+def validate_json(text: str, schema: dict[str, Any] | bool) -> Any:
+    """
+    Parse a response as JSON and check it against a JSON schema.
+
+    Args:
+        text: The response.
+        schema: The JSON schema, with the keywords supported by `json_schema_to_grammar` as well as `minimum`,
+            `maximum`, `exclusiveMinimum`, `exclusiveMaximum`, `multipleOf`, `pattern`, `uniqueItems`,
+            `additionalProperties`, and `allOf`.
+
+    Returns:
+        The parsed document.
+
+    Raises:
+        SchemaValidationError: If the response is not valid JSON or does not match the schema.
+    """
+    try:
+        document = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise SchemaValidationError("$", f"not valid JSON: {e}") from e
+    _validate(document, schema, schema, "$")
+    return document
+
+
+class _SchemaConverter:
+    def __init__(self, schema: dict[str, Any] | bool):
+        self.schema = schema
+        self.rules: dict[str, str] = {}
+        self._refs: dict[str, str] = {}  # the rule name of each referenced definition
+
+    def convert(self) -> str:
+        self.rules["root"] = ""  # reserve the name
+        self.rules["root"] = self._visit(self.schema, "root")
+        return "".join(f"{name} ::= {body}\n" for name, body in self.rules.items())
+
+    def _add_rule(self, name: str, body: str) -> str:
+        name = re.sub(r"[^a-zA-Z0-9-]+", "-", name)
+        unique = name
+        i = 0
+        while unique in self.rules and (not body or self.rules[unique] != body):
+            i += 1
+            unique = f"{name}{i}"
+        self.rules[unique] = body
+        return unique
+
+    def _primitive(self, name: str) -> str:
+        if name not in self.rules:
+            self.rules[name] = _PRIMITIVE_RULES[name]
+            for dep in _PRIMITIVE_DEPENDENCIES.get(name, ()):
+                self._primitive(dep)
+        return name
+
+    def _visit(self, schema: dict[str, Any] | bool, name: str) -> str:
+        # Returns the body of a rule matching the schema
+        if schema is True or schema == {}:
+            return self._primitive("value")
+        if schema is False:
+            raise ValueError(f"{name}: a schema of false matches nothing")
+        if not isinstance(schema, dict):
+            raise ValueError(f"{name}: expected a schema, got {schema!r}")
+        unsupported = sorted(set(schema) - _SUPPORTED_KEYWORDS)
+        if unsupported:
+            raise ValueError(f"{name}: unsupported keywords in schema: {', '.join(unsupported)}")
+
+        if "$ref" in schema:
+            return self._ref(schema["$ref"])
+        if "const" in schema:
+            return f"{_literal(json.dumps(schema['const'], ensure_ascii=False))} {self._primitive('space')}"
+        if "enum" in schema:
+            alternatives = " | ".join(_literal(json.dumps(v, ensure_ascii=False)) for v in schema["enum"])
+            return f"({alternatives}) {self._primitive('space')}"
+        for key in ("anyOf", "oneOf"):
+            if key in schema:
+                return " | ".join(
+                    self._add_rule(f"{name}-{i}", self._visit(alt, f"{name}-{i}")) for i, alt in enumerate(schema[key])
+                )
+
+        types = schema.get("type")
+        if types is None:
+            if "properties" in schema:
+                types = "object"
+            elif "items" in schema:
+                types = "array"
+            else:
+                return self._primitive("value")
+        if isinstance(types, list):
+            return " | ".join(
+                self._add_rule(f"{name}-{t}", self._visit({**schema, "type": t}, f"{name}-{t}")) for t in types
+            )
+        if types == "object":
+            return self._object(schema, name)
+        if types == "array":
+            return self._array(schema, name)
+        if types == "string" and ("minLength" in schema or "maxLength" in schema):
+            repeat = _repetition(schema.get("minLength", 0), schema.get("maxLength"))
+            return f'"\\"" {self._primitive("char")}{repeat} "\\"" {self._primitive("space")}'
+        if types not in _JSON_TYPES:
+            raise ValueError(f"{name}: unknown type {types!r}")
+        return self._primitive(types)
+
+    def _ref(self, ref: str) -> str:
+        if ref not in self._refs:
+            match = re.fullmatch(r"#/(\$defs|definitions)/(.+)", ref)
+            if match is None or not isinstance(self.schema, dict):
+                raise ValueError(f"unsupported reference {ref!r}, only #/$defs/... and #/definitions/... are supported")
+            try:
+                target = self.schema[match[1]][match[2]]
+            except KeyError:
+                raise ValueError(f"unresolved reference {ref!r}") from None
+            # name the rule before visiting the definition, which may refer to itself, with an empty body that is never
+            # shared with another rule
+            rule = self._add_rule(match[2], "")
+            self._refs[ref] = rule
+            self.rules[rule] = self._visit(target, rule)
+        return self._refs[ref]
+
+    def _object(self, schema: dict[str, Any], name: str) -> str:
+        properties: dict[str, Any] = schema.get("properties", {})
+        if not properties:
+            return self._primitive("object")
+        required = set(schema.get("required", ()))
+        missing = sorted(required - set(properties))
+        if missing:
+            raise ValueError(f"{name}: required properties are not in properties: {', '.join(missing)}")
+
+        space = self._primitive("space")
+        pairs = {}
+        for key, prop in properties.items():
+            value = self._add_rule(f"{name}-{key}", self._visit(prop, f"{name}-{key}"))
+            literal = _literal(json.dumps(key, ensure_ascii=False))
+            pairs[key] = self._add_rule(f"{name}-{key}-kv", f'{literal} {space} ":" {space} {value}')
+
+        required_pairs = [pairs[key] for key in properties if key in required]
+        optional_pairs = [pairs[key] for key in properties if key not in required]
+        body = f' "," {space} '.join(required_pairs)
+        if required_pairs:
+            body += "".join(f' ("," {space} {pair})?' for pair in optional_pairs)
+        elif optional_pairs:
+            # the first property present is not preceded by a comma
+            alternatives = []
+            for i, pair in enumerate(optional_pairs):
+                alternatives.append(pair + "".join(f' ("," {space} {rest})?' for rest in optional_pairs[i + 1:]))
+            body = "(" + " | ".join(alternatives) + ")?"
+        return f'"{{" {space} {body} "}}" {space}'
+
+    def _array(self, schema: dict[str, Any], name: str) -> str:
+        items = schema.get("items", True)
+        if not isinstance(items, (dict, bool)):
+            raise ValueError(f"{name}: only a single schema is supported for items")
+        item = self._add_rule(f"{name}-item", self._visit(items, f"{name}-item"))
+        space = self._primitive("space")
+        min_items = schema.get("minItems", 0)
+        max_items = schema.get("maxItems")
+        if max_items == 0:
+            return f'"[" {space} "]" {space}'
+        rest = _repetition(max(0, min_items - 1), None if max_items is None else max_items - 1)
+        elements = f'{item} ("," {space} {item}){rest}'
+        if min_items == 0:
+            elements = f"({elements})?"
+        return f'"[" {space} {elements} "]" {space}'
+
+
+def _literal(text: str) -> str:
+    # a GBNF string literal
+    escaped = text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r")
+    return f'"{escaped}"'
+
+
+def _repetition(min_count: int, max_count: int | None) -> str:
+    if max_count is None:
+        return "*" if min_count == 0 else f"{{{min_count},}}"
+    if max_count < min_count:
+        raise ValueError(f"the maximum count {max_count} is less than the minimum count {min_count}")
+    return f"{{{min_count},{max_count}}}"
+
+
+def _type_of(value: Any) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, list):
+        return "array"
+    return "object"
+
+
+def _is_type(value: Any, type_: str) -> bool:
+    actual = _type_of(value)
+    if type_ == "number":
+        return actual in ("integer", "number")
+    if type_ == "integer" and actual == "number":
+        return math.isfinite(value) and value.is_integer()
+    return actual == type_
+
+
+def _matches(value: Any, schema: Any, root: Any, path: str) -> bool:
+    try:
+        _validate(value, schema, root, path)
+    except SchemaValidationError:
+        return False
+    return True
+
+
+def _validate(value: Any, schema: Any, root: Any, path: str) -> None:
+    if schema is True:
+        return
+    if schema is False:
+        raise SchemaValidationError(path, "no value is allowed here")
+
+    if "$ref" in schema:
+        match = re.fullmatch(r"#/(\$defs|definitions)/(.+)", schema["$ref"])
+        if match is None:
+            raise ValueError(f"unsupported reference {schema['$ref']!r}")
+        _validate(value, root[match[1]][match[2]], root, path)
+    if "const" in schema and not _equal(value, schema["const"]):
+        raise SchemaValidationError(path, f"expected {json.dumps(schema['const'], ensure_ascii=False)}")
+    if "enum" in schema and not any(_equal(value, v) for v in schema["enum"]):
+        raise SchemaValidationError(path, f"expected one of {json.dumps(schema['enum'])}")
+    if "anyOf" in schema and not any(_matches(value, alt, root, path) for alt in schema["anyOf"]):
+        raise SchemaValidationError(path, "does not match any schema in anyOf")
+    if "oneOf" in schema and sum(_matches(value, alt, root, path) for alt in schema["oneOf"]) != 1:
+        raise SchemaValidationError(path, "does not match exactly one schema in oneOf")
+    for sub in schema.get("allOf", ()):
+        _validate(value, sub, root, path)
+
+    if "type" in schema:
+        types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+        if not any(_is_type(value, t) for t in types):
+            raise SchemaValidationError(path, f"expected {' or '.join(types)}, got {_type_of(value)}")
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        _validate_number(value, schema, path)
+    elif isinstance(value, str):
+        if len(value) < schema.get("minLength", 0):
+            raise SchemaValidationError(path, f"shorter than {schema['minLength']} characters")
+        if "maxLength" in schema and len(value) > schema["maxLength"]:
+            raise SchemaValidationError(path, f"longer than {schema['maxLength']} characters")
+        if "pattern" in schema and re.search(schema["pattern"], value) is None:
+            raise SchemaValidationError(path, f"does not match the pattern {schema['pattern']!r}")
+    elif isinstance(value, list):
+        if len(value) < schema.get("minItems", 0):
+            raise SchemaValidationError(path, f"fewer than {schema['minItems']} items")
+        if "maxItems" in schema and len(value) > schema["maxItems"]:
+            raise SchemaValidationError(path, f"more than {schema['maxItems']} items")
+        if schema.get("uniqueItems"):
+            seen = [json.dumps(v, sort_keys=True) for v in value]
+            if len(set(seen)) != len(seen):
+                raise SchemaValidationError(path, "items are not unique")
+        if "items" in schema:
+            for i, item in enumerate(value):
+                _validate(item, schema["items"], root, f"{path}[{i}]")
+    elif isinstance(value, dict):
+        properties = schema.get("properties", {})
+        for key in schema.get("required", ()):
+            if key not in value:
+                raise SchemaValidationError(path, f"missing required property {key!r}")
+        additional = schema.get("additionalProperties", True)
+        for key, item in value.items():
+            item_path = f"{path}.{key}"
+            if key in properties:
+                _validate(item, properties[key], root, item_path)
+            elif additional is False:
+                raise SchemaValidationError(path, f"unexpected property {key!r}")
+            else:
+                _validate(item, additional, root, item_path)
+
+
+def _validate_number(value: float, schema: dict[str, Any], path: str) -> None:
+    if "minimum" in schema and value < schema["minimum"]:
+        raise SchemaValidationError(path, f"less than the minimum {schema['minimum']}")
+    if "maximum" in schema and value > schema["maximum"]:
+        raise SchemaValidationError(path, f"greater than the maximum {schema['maximum']}")
+    if "exclusiveMinimum" in schema and value <= schema["exclusiveMinimum"]:
+        raise SchemaValidationError(path, f"not greater than {schema['exclusiveMinimum']}")
+    if "exclusiveMaximum" in schema and value >= schema["exclusiveMaximum"]:
+        raise SchemaValidationError(path, f"not less than {schema['exclusiveMaximum']}")
+    if "multipleOf" in schema and not _is_multiple(value, schema["multipleOf"]):
+        raise SchemaValidationError(path, f"not a multiple of {schema['multipleOf']}")
+
+
+def _is_multiple(value: float, divisor: float) -> bool:
+    # Compares the numbers as written in JSON, which are decimal, so that e.g. 0.3 is a multiple of 0.1 even though the
+    # floats nearest to them do not divide evenly
+    if not (math.isfinite(value) and math.isfinite(divisor)):
+        return False
+    return (_as_decimal(value) / _as_decimal(divisor)).denominator == 1
+
+
+def _as_decimal(number: float) -> Fraction:
+    # the shortest decimal that parses back to the float, which is how it appears in the JSON
+    return Fraction(repr(number)) if isinstance(number, float) else Fraction(number)
+
+
+def _equal(a: Any, b: Any) -> bool:
+    # unlike ==, does not treat True as equal to 1
+    if isinstance(a, bool) or isinstance(b, bool):
+        return type(a) is type(b) and a == b
+    return a == b
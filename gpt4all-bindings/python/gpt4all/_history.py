@@ -0,0 +1,171 @@
+"""
+Policies for keeping the history of a chat session within the model's context window.
+"""
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from .gpt4all import MessageType
+
+TokenCounterType = Callable[["MessageType"], int]
+
+
+class HistoryPolicy(ABC):
+    """
+    Decides which messages of a chat session to keep once the history no longer fits in the context window.
+
+    A policy is copied for each chat session it is used with, so subclasses may keep per-session state in attributes.
+    """
+
+    @abstractmethod
+    def trim(self, messages: list[MessageType], n_tokens: TokenCounterType, budget: int) -> list[MessageType]:
+        """
+        Shorten a history that is over budget.
+
+        Args:
+            messages: The history, ending with the new user message.
+            n_tokens: Returns the number of tokens a message takes up in the context. The counts are cached, so this
+                is cheap to call for messages that were counted before.
+            budget: The number of tokens available to the history.
+
+        Returns:
+            The messages to keep, which must end with the new user message.
+        """
+
+
+class SlidingWindow(HistoryPolicy):
+    """
+    Keep the system message and the most recent turns that fit in a fraction of the context window.
+
+    Trimming below the budget leaves room for the next few turns, during which the model reuses the part of its
+    context it has already processed instead of processing the history again.
+    """
+
+    def __init__(self, target: float = 0.5):
+        """
+        Constructor
+
+        Args:
+            target: The fraction of the budget to trim the history down to. Default is 0.5.
+        """
+        _check_target(target)
+        self.target = target
+
+    def trim(self, messages: list[MessageType], n_tokens: TokenCounterType, budget: int) -> list[MessageType]:
+        head, turns = _split_system(messages)
+        limit = int(budget * self.target) - sum(map(n_tokens, head))
+        return head + turns[_first_turn_within(turns, n_tokens, limit):]
+
+
+class KeepLastTurns(HistoryPolicy):
+    """
+    Keep the system message and the last few turns, each starting with a user message.
+
+    Older turns are dropped too if the last turns alone do not fit.
+    """
+
+    def __init__(self, n_turns: int):
+        """
+        Constructor
+
+        Args:
+            n_turns: The number of turns to keep, including the new user message.
+        """
+        if n_turns < 1:
+            raise ValueError(f"n_turns must be a positive integer, got {n_turns}")
+        self.n_turns = n_turns
+
+    def trim(self, messages: list[MessageType], n_tokens: TokenCounterType, budget: int) -> list[MessageType]:
+        head, turns = _split_system(messages)
+        starts = _turn_starts(turns)
+        turns = turns[starts[max(0, len(starts) - self.n_turns)]:]
+        return head + turns[_first_turn_within(turns, n_tokens, budget - sum(map(n_tokens, head))):]
+
+
+class SummarizeOlderTurns(HistoryPolicy):
+    """
+    Replace the oldest turns with a summary, which is appended to the system message.
+
+    Each time the history is trimmed, the previous summary and the turns being dropped are summarized together.
+    """
+
+    def __init__(
+        self,
+        summarize: Callable[[list[MessageType]], str],
+        target: float = 0.5,
+        header: str = "Summary of the earlier conversation:",
+    ):
+        """
+        Constructor
+
+        Args:
+            summarize: A function that returns a summary of a list of messages. If there is a previous summary, it is
+                passed first, as a system message. This may call another GPT4All instance, but not the one whose
+                history is being trimmed.
+            target: The fraction of the budget to trim the history down to, before adding the summary. Default is
+                0.5.
+            header: The text placed before the summary in the system message.
+        """
+        _check_target(target)
+        self.summarize = summarize
+        self.target = target
+        self.header = header
+        self._system: str | None = None
+        self._summary: str | None = None
+
+    def _system_content(self) -> str:
+        summary = f"{self.header}\n{self._summary}"
+        return summary if self._system is None else f"{self._system}\n\n{summary}"
+
+    def trim(self, messages: list[MessageType], n_tokens: TokenCounterType, budget: int) -> list[MessageType]:
+        head, turns = _split_system(messages)
+        if self._summary is None or not head or head[0]["content"] != self._system_content():
+            # not a history this policy summarized before
+            self._system = head[0]["content"] if head else None
+            self._summary = None
+
+        limit = int(budget * self.target) - sum(map(n_tokens, head))
+        first = _first_turn_within(turns, n_tokens, limit)
+        if not first:
+            return messages
+
+        dropped = turns[:first]
+        if self._summary is not None:
+            dropped.insert(0, {"role": "system", "content": self._summary})
+        self._summary = self.summarize(dropped)
+        system: MessageType = {"role": "system", "content": self._system_content()}
+
+        # in case the summary is too long, drop more turns to stay within the budget
+        turns = turns[first:]
+        return [system] + turns[_first_turn_within(turns, n_tokens, budget - n_tokens(system)):]
+
+
+def _check_target(target: float) -> None:
+    if not 0 < target <= 1:
+        raise ValueError(f"target must be in the range (0, 1], got {target}")
+
+
+def _split_system(messages: list[MessageType]) -> tuple[list[MessageType], list[MessageType]]:
+    n = 1 if messages and messages[0]["role"] == "system" else 0
+    return messages[:n], messages[n:]
+
+
+def _turn_starts(turns: list[MessageType]) -> list[int]:
+    # the history ends with a user message, so there is at least one turn
+    return [i for i, msg in enumerate(turns) if msg["role"] == "user"]
+
+
+def _first_turn_within(turns: list[MessageType], n_tokens: TokenCounterType, limit: int) -> int:
+    # Return the index of the oldest turn from which the rest of the history fits in limit tokens, keeping at least the
+    # last turn. Turns are dropped whole, so the kept history starts with a user message.
+    total = sum(map(n_tokens, turns))
+    prev = 0
+    starts = _turn_starts(turns)
+    for start in starts:
+        total -= sum(map(n_tokens, turns[prev:start]))
+        prev = start
+        if total <= limit:
+            return start
+    return starts[-1]
@@ -0,0 +1,111 @@
+"""
+Token log-probabilities of generated or given text, for confidence checks and perplexity scoring.
+"""
+from __future__ import annotations
+
+import math
+from array import array
+from typing import TYPE_CHECKING
+
+from ._pyllmodel import LLModelPromptContext
+
+if TYPE_CHECKING:
+    from ._pyllmodel import LLModel
+
+# must match LLMODEL_MAX_PROMPT_BATCH in the backend, the most positions llmodel_decode_sample can sample at once
+_MAX_SAMPLE = 128
+
+
+class TokenLogprobs:
+    """
+    The log-probability of each token of a response under the model's distribution, before the sampling parameters
+    such as the temperature are applied, and optionally the most likely alternatives at each position.
+
+    The values are kept in flat arrays rather than one object per token. Pass an instance as the logprobs argument of
+    `GPT4All.generate` to fill it in as tokens are generated; the entry for a token is added before the response
+    callback receives it, so the callback can stop a generation the model is unsure about:
+
+        logprobs = TokenLogprobs()
+        model.generate(prompt, logprobs=logprobs, callback=lambda token_id, response: logprobs.logprobs[-1] > -4.0)
+    """
+
+    __slots__ = ('top_n', 'token_ids', 'logprobs', 'top_token_ids', 'top_logprobs')
+
+    def __init__(self, top_n: int = 0):
+        """
+        Args:
+            top_n: The number of most likely tokens to record at each position.
+        """
+        if top_n < 0:
+            raise ValueError(f"top_n must not be negative, got {top_n}")
+        self.top_n = top_n
+        self.token_ids: array[int] = array('i')
+        """The id of each token."""
+        self.logprobs: array[float] = array('f')
+        """The log-probability of each token."""
+        self.top_token_ids: array[int] = array('i')
+        """The top_n most likely token ids at each position, most likely first, one position after another."""
+        self.top_logprobs: array[float] = array('f')
+        """The log-probabilities of the tokens in top_token_ids."""
+
+    def __len__(self) -> int:
+        return len(self.token_ids)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(top_n={self.top_n}, n_tokens={len(self)})"
+
+    def _append(self, token_id: int, logprob: float, top_token_ids: array[int], top_logprobs: array[float]) -> None:
+        self.token_ids.append(token_id)
+        self.logprobs.append(logprob)
+        if self.top_n:
+            # the vocabulary may be smaller than top_n, so pad to keep one stride per position
+            n_missing = self.top_n - len(top_token_ids)
+            self.top_token_ids.extend(top_token_ids)
+            self.top_logprobs.extend(top_logprobs)
+            if n_missing:
+                self.top_token_ids.extend([-1] * n_missing)
+                self.top_logprobs.extend([-math.inf] * n_missing)
+
+    def clear(self) -> None:
+        """Remove all tokens, e.g. to reuse the instance for another generation."""
+        for values in (self.token_ids, self.logprobs, self.top_token_ids, self.top_logprobs):
+            del values[:]
+
+    def top(self, index: int) -> list[tuple[int, float]]:
+        """Return the most likely tokens at a position, as (token id, log-probability) pairs, most likely first."""
+        start = range(len(self))[index] * self.top_n
+        return list(zip(self.top_token_ids[start:start + self.top_n], self.top_logprobs[start:start + self.top_n]))
+
+    @property
+    def total_logprob(self) -> float:
+        """The log-probability of the whole sequence of tokens."""
+        return math.fsum(self.logprobs)
+
+    @property
+    def perplexity(self) -> float:
+        """The perplexity of the tokens, exp(-mean log-probability), or NaN if there are none. Lower is more likely."""
+        if not self.logprobs:
+            return math.nan
+        return math.exp(-self.total_logprob / len(self.logprobs))
+
+
+def score(model: LLModel, tokens: array[int], n_prompt: int, top_n: int = 0) -> TokenLogprobs:
+    """
+    Compute the log-probability of each of tokens[n_prompt:] given the tokens before it, evaluating up to 128 of them
+    at a time. The model must have exclusive use of its context.
+    """
+    if not 1 <= n_prompt <= len(tokens):
+        raise ValueError(f"n_prompt must be between 1 and the number of tokens, got {n_prompt}")
+    if len(tokens) > model.n_ctx:
+        raise ValueError(f"The text is too long to score ({len(tokens)} > {model.n_ctx} tokens).")
+
+    # decode_sample also samples at each position, which costs the least when greedy
+    model.init_sampler(LLModelPromptContext(temp=0.0, repeat_penalty=1.0))
+    result = TokenLogprobs(top_n)
+    for start in range(n_prompt, len(tokens), _MAX_SAMPLE):
+        end = min(start + _MAX_SAMPLE, len(tokens))
+        # the position before each token predicts it
+        model.decode_sample(tokens[:end - 1], end - start)
+        for i, tok in enumerate(tokens[start:end]):
+            result._append(tok, model.sampled_logprob(i, tok), *model.sampled_top_logprobs(i, top_n))
+    return result
@@ -0,0 +1,109 @@
+"""
+Token-level sampling with log-probabilities, including several completions of one prompt, which is only evaluated once.
+"""
+from __future__ import annotations
+
+from array import array
+from typing import TYPE_CHECKING, Callable, NamedTuple, Sequence
+
+from ._pyllmodel import LLModelPromptContext
+from ._speculative import _ResponseEmitter
+
+if TYPE_CHECKING:
+    from ._logprobs import TokenLogprobs
+    from ._pyllmodel import LLModel, PromptCallbackType, RawResponseCallbackType
+
+
+class Sample(NamedTuple):
+    """One of the completions generated by `generate`."""
+
+    n_tokens: int
+    """The number of tokens in the completion."""
+    logprob: float
+    """
+    The sum of the log-probabilities of those tokens under the model's distribution, plus that of the end-of-text token
+    if the model ended the completion, so that a completion that is cut short ranks below one the model would end there.
+    """
+
+
+def generate(
+    model: LLModel,
+    prompt: str | array[int] | Sequence[int],
+    n: int,
+    make_callback: Callable[[int], RawResponseCallbackType],
+    context: LLModelPromptContext,
+    prompt_callback: PromptCallbackType | None = None,
+    logprobs: Sequence[TokenLogprobs] | None = None,
+) -> list[Sample]:
+    """
+    Generate n completions of a prompt, one after the other. The response tokens of the i-th completion are sent to
+    make_callback(i), and returning False stops that completion only. If logprobs is given, the log-probability of each
+    token of the i-th completion is appended to logprobs[i] before the token is sent.
+
+    The prompt is evaluated context.n_batch tokens at a time, and stays at the start of the model's context, so after
+    the first completion only its last token is evaluated again before sampling the next one. Log-probabilities are
+    those of the model before the sampling parameters are applied, so that completions can be ranked against each
+    other. Like speculative decoding, generation stops when the context window is full, and prompt_callback is called
+    once for the whole prompt.
+    """
+    tokens = model.tokenize(prompt) if isinstance(prompt, str) else array('i', prompt)
+    if not tokens:
+        raise ValueError("Prompt tokenized to zero tokens.")
+    if len(tokens) >= model.n_ctx:
+        raise ValueError(f"The prompt is too long for sampling ({len(tokens)} >= {model.n_ctx} tokens).")
+
+    if prompt_callback is not None and not prompt_callback(len(tokens), False):
+        return []
+
+    if context.n_batch < 1:
+        raise ValueError(f"n_batch must be at least 1, got {context.n_batch}")
+    if context.n_batch < len(tokens):
+        # all but the last batch, after each of which a token is sampled and discarded, so sample greedily
+        model.init_sampler(LLModelPromptContext(temp=0.0, repeat_penalty=1.0))
+        for end in range(context.n_batch, len(tokens), context.n_batch):
+            model.decode_sample(tokens[:end], 1)
+
+    return [
+        _generate_one(model, tokens, make_callback(i), context, None if logprobs is None else logprobs[i])
+        for i in range(n)
+    ]
+
+
+def _generate_one(
+    model: LLModel,
+    prompt: array[int],
+    callback: RawResponseCallbackType,
+    context: LLModelPromptContext,
+    output: TokenLogprobs | None,
+) -> Sample:
+    # The emitter sends tokens in the order they were sampled, possibly later, and drops any that are part of a stop
+    # sequence, so only count the log-probabilities of those that reach the callback
+    top_n = 0 if output is None else output.top_n
+    logprobs: list[float] = []
+    top: list[tuple[array[int], array[float]]] = []
+    n_tokens = 0
+    logprob = 0.0
+    end = False
+
+    def _callback(token_id: int, piece: bytes) -> bool:
+        nonlocal n_tokens, logprob
+        logprob += logprobs[n_tokens]
+        if output is not None:
+            output._append(token_id, logprobs[n_tokens], *top[n_tokens])
+        n_tokens += 1
+        return callback(token_id, piece)
+
+    model.init_sampler(context)
+    emit = _ResponseEmitter(model, _callback, context.n_predict)
+    tokens = array('i', prompt)
+    while len(tokens) <= model.n_ctx:
+        (tok,), end = model.decode_sample(tokens, 1)
+        logprobs.append(model.sampled_logprob(0, tok))
+        if output is not None:
+            top.append(model.sampled_top_logprobs(0, top_n))
+        tokens.append(tok)
+        if not emit(tok, end):
+            break
+    if end:
+        logprob += logprobs[-1]  # the end-of-text token, which is not sent to the callback
+    return Sample(n_tokens, logprob)
@@ -0,0 +1,162 @@
+"""
+On-disk cache of model states keyed by the prompt prefix that produced them.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+from array import array
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from ._pyllmodel import LLModelState
+
+if TYPE_CHECKING:
+    from ._pyllmodel import LLModel
+
+# magic, number of input tokens, size of the state data
+_HEADER = struct.Struct("<8sQQ")
+_MAGIC = b"G4ASTAT1"
+_SUFFIX = ".state"
+
+
+class PrefixCache:
+    """
+    A persistent cache of model states for prompts that share a common prefix, such as a long system message or a
+    block of few-shot examples.
+
+    Entries are keyed by a hash of the rendered prefix and the identity of the model file, and are stored as one file
+    each in a directory that may be shared between processes. The least recently used entries are evicted once the
+    total size exceeds a byte budget.
+    """
+
+    def __init__(self, path: str | os.PathLike[str], max_bytes: int = 4 * 2**30):
+        """
+        Constructor
+
+        Args:
+            path: Directory to store the cached states in. Created if it does not exist.
+            max_bytes: The maximum total size of the cached states, in bytes. Default is 4 GiB.
+        """
+        if max_bytes <= 0:
+            raise ValueError(f"max_bytes must be a positive integer, got {max_bytes}")
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(model: LLModel, prefix: str) -> str:
+        """Compute the cache key for a rendered prompt prefix evaluated by the given model."""
+        # hashing a multi-GB model file is too slow, so identify it by its path, size, and modification time
+        st = os.stat(model.model_path)
+        identity = [os.path.abspath(model.model_path.decode()), st.st_size, st.st_mtime_ns, model.n_ctx, model.ngl]
+        hsh = hashlib.sha256(json.dumps(identity).encode())
+        hsh.update(b"\0")
+        hsh.update(prefix.encode())
+        return hsh.hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.path / (key + _SUFFIX)
+
+    def get(self, key: str) -> LLModelState | None:
+        """
+        Look up a cached state.
+
+        The state data is a copy-on-write memory map of the cache file, so it is only paged in as the backend reads
+        it.
+
+        Returns:
+            The cached state, or None if there is no entry for this key.
+        """
+        entry = self._entry_path(key)
+        try:
+            with open(entry, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (FileNotFoundError, ValueError):
+            return None  # missing or empty
+
+        view = memoryview(mm)
+        if len(view) < _HEADER.size:
+            return None
+        magic, n_input_tokens, state_size = _HEADER.unpack_from(view)
+        tokens_end = _HEADER.size + n_input_tokens * 4
+        if magic != _MAGIC or tokens_end + state_size != len(view):
+            return None  # not written by this version, or truncated
+
+        input_tokens = array("i")
+        input_tokens.frombytes(view[_HEADER.size:tokens_end])
+
+        # mark as recently used
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return LLModelState(view[tokens_end:], input_tokens)
+
+    def put(self, key: str, state: LLModelState) -> None:
+        """Store a state, evicting the least recently used entries if the cache is over budget."""
+        data = memoryview(state.data).cast("B")
+        input_tokens = state.input_tokens
+        if not isinstance(input_tokens, array) or input_tokens.itemsize != 4:
+            input_tokens = array("i", input_tokens)
+
+        if _HEADER.size + len(input_tokens) * 4 + len(data) > self.max_bytes:
+            return  # would never fit
+
+        entry = self._entry_path(key)
+        tmp_path = entry.with_name(f"{entry.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(_HEADER.pack(_MAGIC, len(input_tokens), len(data)))
+                f.write(input_tokens.tobytes())
+                f.write(data)
+            os.replace(tmp_path, entry)
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for entry in self.path.glob("*" + _SUFFIX):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue  # removed by another process
+            entries.append((st.st_mtime_ns, st.st_size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                continue  # in use (on Windows) or already removed
+            total -= size
+
+    def clear(self) -> None:
+        """Remove all cached states."""
+        for entry in self.path.glob("*" + _SUFFIX):
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+
+    @property
+    def nbytes(self) -> int:
+        """The total size of the cached states, in bytes."""
+        total = 0
+        for entry in self.path.glob("*" + _SUFFIX):
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
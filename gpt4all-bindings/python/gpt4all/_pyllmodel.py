@@ -1,15 +1,22 @@
 from __future__ import annotations
 
+import codecs
 import ctypes
+import functools
+import hashlib
 import os
 import platform
-import subprocess
 import sys
 import textwrap
 import threading
+import weakref
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
 from enum import Enum
 from queue import Queue
-from typing import TYPE_CHECKING, Any, Callable, Generic, Iterable, Iterator, Literal, NoReturn, TypeVar, overload
+from typing import (TYPE_CHECKING, Any, AsyncIterator, Callable, ContextManager, Generic, Iterable, Iterator, Literal,
+                    NamedTuple, NoReturn, Sequence, TypeVar, overload)
 
 if sys.version_info >= (3, 9):
     import importlib.resources as importlib_resources
@@ -23,14 +30,23 @@ else:
     from typing import TypedDict
 
 if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+
+    from ._logprobs import TokenLogprobs
+    from ._parallel import Sample
+    from ._speculative import SpeculativeStats
+
+    from numpy.typing import NDArray
     from typing_extensions import ParamSpec, TypeAlias
     T = TypeVar("T")
     P = ParamSpec("P")
 
-EmbeddingsType = TypeVar('EmbeddingsType', bound='list[Any]')
+EmbeddingsType = TypeVar('EmbeddingsType', bound='list[Any] | NDArray[Any]')
 
 cuda_found: bool = False
 
+_utf8_decoder = codecs.getincrementaldecoder('utf-8')
+
 
 # TODO(jared): use operator.call after we drop python 3.10 support
 def _operator_call(obj: Callable[P, T], /, *args: P.args, **kwargs: P.kwargs) -> T:
@@ -38,9 +54,10 @@ def _operator_call(obj: Callable[P, T], /, *args: P.args, **kwargs: P.kwargs) ->
 
 
 # Detect Rosetta 2
-@_operator_call
 def check_rosetta() -> None:
     if platform.system() == "Darwin" and platform.processor() == "i386":
+        import subprocess
+
         p = subprocess.run("sysctl -n sysctl.proc_translated".split(), capture_output=True, text=True)
         if p.returncode == 0 and p.stdout.strip() == "1":
             raise RuntimeError(textwrap.dedent("""\
@@ -50,20 +67,20 @@ def check_rosetta() -> None:
 
 
 # Check for C++ runtime libraries
-if platform.system() == "Windows":
-    try:
-        ctypes.CDLL("msvcp140.dll")
-        ctypes.CDLL("vcruntime140.dll")
-        ctypes.CDLL("vcruntime140_1.dll")
-    except OSError as e:
-        print(textwrap.dedent(f"""\
-            {e!r}
-            The Microsoft Visual C++ runtime libraries were not found. Please install them from
-            https://aka.ms/vs/17/release/vc_redist.x64.exe
-        """), file=sys.stderr)
-
-
-@_operator_call
+def check_msvc_runtime() -> None:
+    if platform.system() == "Windows":
+        try:
+            ctypes.CDLL("msvcp140.dll")
+            ctypes.CDLL("vcruntime140.dll")
+            ctypes.CDLL("vcruntime140_1.dll")
+        except OSError as e:
+            print(textwrap.dedent(f"""\
+                {e!r}
+                The Microsoft Visual C++ runtime libraries were not found. Please install them from
+                https://aka.ms/vs/17/release/vc_redist.x64.exe
+            """), file=sys.stderr)
+
+
 def find_cuda() -> None:
     global cuda_found
 
@@ -113,7 +130,46 @@ def load_llmodel_library():
     return lib
 
 
-llmodel = load_llmodel_library()
+def _load_llmodel() -> ctypes.CDLL:
+    check_rosetta()
+    check_msvc_runtime()
+    find_cuda()
+    lib = load_llmodel_library()
+    _declare_signatures(lib)
+    lib.llmodel_set_implementation_search_path(str(MODEL_LIB_PATH).encode())
+    return lib
+
+
+class _LazyLibrary:
+    """
+    The llmodel library, loaded on first use so that importing gpt4all does not load any native code.
+
+    Functions are cached as attributes once they have been looked up, so later calls cost no more than calling the
+    library directly.
+    """
+
+    def __init__(self, load: Callable[[], ctypes.CDLL]):
+        self._load = load
+        self._lib: ctypes.CDLL | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._lib is not None
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith('__'):
+            raise AttributeError(name)  # e.g. probed by copy or pickle
+        if self._lib is None:
+            with self._lock:
+                if self._lib is None:
+                    self._lib = self._load()
+        func = getattr(self._lib, name)
+        setattr(self, name, func)
+        return func
+
+
+llmodel: Any = _LazyLibrary(_load_llmodel)
 
 
 class LLModelPromptContext(ctypes.Structure):
@@ -127,6 +183,7 @@ class LLModelPromptContext(ctypes.Structure):
         ("repeat_penalty", ctypes.c_float),
         ("repeat_last_n",  ctypes.c_int32),
         ("context_erase",  ctypes.c_float),
+        ("grammar",        ctypes.c_char_p),
     ]
 
 
@@ -141,92 +198,209 @@ class LLModelGPUDevice(ctypes.Structure):
     ]
 
 
+PromptCallback       = ctypes.CFUNCTYPE(ctypes.c_bool, ctypes.POINTER(ctypes.c_int32), ctypes.c_size_t, ctypes.c_bool)
+ResponseCallback     = ctypes.CFUNCTYPE(ctypes.c_bool, ctypes.c_int32, ctypes.c_char_p)
+EmbCancelCallback    = ctypes.CFUNCTYPE(ctypes.c_bool, ctypes.POINTER(ctypes.c_uint), ctypes.c_uint, ctypes.c_char_p)
+SpecialTokenCallback = ctypes.CFUNCTYPE(None, ctypes.c_char_p, ctypes.c_char_p)
+
+
 # Define C function signatures using ctypes
-llmodel.llmodel_model_create.argtypes = [ctypes.c_char_p]
-llmodel.llmodel_model_create.restype = ctypes.c_void_p
+def _declare_signatures(llmodel: ctypes.CDLL) -> None:
+    llmodel.llmodel_model_create.argtypes = [ctypes.c_char_p]
+    llmodel.llmodel_model_create.restype = ctypes.c_void_p
+
+    llmodel.llmodel_model_create2.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_char_p)]
+    llmodel.llmodel_model_create2.restype = ctypes.c_void_p
+
+    llmodel.llmodel_model_destroy.argtypes = [ctypes.c_void_p]
+    llmodel.llmodel_model_destroy.restype = None
+
+    llmodel.llmodel_loadModel.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
+    llmodel.llmodel_loadModel.restype = ctypes.c_bool
+    llmodel.llmodel_required_mem.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
+    llmodel.llmodel_required_mem.restype = ctypes.c_size_t
+    llmodel.llmodel_isModelLoaded.argtypes = [ctypes.c_void_p]
+    llmodel.llmodel_isModelLoaded.restype = ctypes.c_bool
+
+    llmodel.llmodel_state_get_size.argtypes = [ctypes.c_void_p]
+    llmodel.llmodel_state_get_size.restype = ctypes.c_uint64
+
+    llmodel.llmodel_state_get_data.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_uint8),
+        ctypes.c_uint64,
+        ctypes.POINTER(ctypes.POINTER(ctypes.c_int32)),
+        ctypes.POINTER(ctypes.c_uint64),
+    ]
+    llmodel.llmodel_state_get_data.restype = ctypes.c_uint64
 
-llmodel.llmodel_model_create2.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_char_p)]
-llmodel.llmodel_model_create2.restype = ctypes.c_void_p
+    llmodel.llmodel_state_free_input_tokens.argtypes = [ctypes.POINTER(ctypes.c_int32)]
+    llmodel.llmodel_state_free_input_tokens.restype = None
 
-llmodel.llmodel_model_destroy.argtypes = [ctypes.c_void_p]
-llmodel.llmodel_model_destroy.restype = None
+    llmodel.llmodel_state_set_data.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_uint8),
+        ctypes.c_uint64,
+        ctypes.POINTER(ctypes.c_int32),
+        ctypes.c_uint64,
+    ]
+    llmodel.llmodel_state_set_data.restype = ctypes.c_uint64
+
+    llmodel.llmodel_reset_context.argtypes = [ctypes.c_void_p]
+    llmodel.llmodel_reset_context.restype = None
+
+    llmodel.llmodel_prompt.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        PromptCallback,
+        ResponseCallback,
+        ctypes.POINTER(LLModelPromptContext),
+        ctypes.POINTER(ctypes.c_char_p),
+    ]
 
-llmodel.llmodel_loadModel.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
-llmodel.llmodel_loadModel.restype = ctypes.c_bool
-llmodel.llmodel_required_mem.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
-llmodel.llmodel_required_mem.restype = ctypes.c_size_t
-llmodel.llmodel_isModelLoaded.argtypes = [ctypes.c_void_p]
-llmodel.llmodel_isModelLoaded.restype = ctypes.c_bool
+    llmodel.llmodel_prompt.restype = ctypes.c_bool
 
-PromptCallback       = ctypes.CFUNCTYPE(ctypes.c_bool, ctypes.POINTER(ctypes.c_int32), ctypes.c_size_t, ctypes.c_bool)
-ResponseCallback     = ctypes.CFUNCTYPE(ctypes.c_bool, ctypes.c_int32, ctypes.c_char_p)
-EmbCancelCallback    = ctypes.CFUNCTYPE(ctypes.c_bool, ctypes.POINTER(ctypes.c_uint), ctypes.c_uint, ctypes.c_char_p)
-SpecialTokenCallback = ctypes.CFUNCTYPE(None, ctypes.c_char_p, ctypes.c_char_p)
+    llmodel.llmodel_prompt_tokens.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_int32),
+        ctypes.c_size_t,
+        PromptCallback,
+        ResponseCallback,
+        ctypes.POINTER(LLModelPromptContext),
+        ctypes.POINTER(ctypes.c_char_p),
+    ]
+
+    llmodel.llmodel_prompt_tokens.restype = ctypes.c_bool
+
+    llmodel.llmodel_embed.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_char_p),
+        ctypes.POINTER(ctypes.c_size_t),
+        ctypes.c_char_p,
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_size_t),
+        ctypes.c_bool,
+        ctypes.c_bool,
+        EmbCancelCallback,
+        ctypes.POINTER(ctypes.c_char_p),
+    ]
+
+    llmodel.llmodel_embed.restype = ctypes.POINTER(ctypes.c_float)
+
+    llmodel.llmodel_free_embedding.argtypes = [ctypes.POINTER(ctypes.c_float)]
+    llmodel.llmodel_free_embedding.restype = None
 
-llmodel.llmodel_prompt.argtypes = [
-    ctypes.c_void_p,
-    ctypes.c_char_p,
-    PromptCallback,
-    ResponseCallback,
-    ctypes.POINTER(LLModelPromptContext),
-    ctypes.POINTER(ctypes.c_char_p),
-]
+    llmodel.llmodel_setThreadCount.argtypes = [ctypes.c_void_p, ctypes.c_int32]
+    llmodel.llmodel_setThreadCount.restype = None
 
-llmodel.llmodel_prompt.restype = ctypes.c_bool
+    llmodel.llmodel_set_implementation_search_path.argtypes = [ctypes.c_char_p]
+    llmodel.llmodel_set_implementation_search_path.restype = None
 
-llmodel.llmodel_embed.argtypes = [
-    ctypes.c_void_p,
-    ctypes.POINTER(ctypes.c_char_p),
-    ctypes.POINTER(ctypes.c_size_t),
-    ctypes.c_char_p,
-    ctypes.c_int,
-    ctypes.POINTER(ctypes.c_size_t),
-    ctypes.c_bool,
-    ctypes.c_bool,
-    EmbCancelCallback,
-    ctypes.POINTER(ctypes.c_char_p),
-]
+    llmodel.llmodel_threadCount.argtypes = [ctypes.c_void_p]
+    llmodel.llmodel_threadCount.restype = ctypes.c_int32
 
-llmodel.llmodel_embed.restype = ctypes.POINTER(ctypes.c_float)
+    llmodel.llmodel_available_gpu_devices.argtypes = [ctypes.c_size_t, ctypes.POINTER(ctypes.c_int32)]
+    llmodel.llmodel_available_gpu_devices.restype = ctypes.POINTER(LLModelGPUDevice)
 
-llmodel.llmodel_free_embedding.argtypes = [ctypes.POINTER(ctypes.c_float)]
-llmodel.llmodel_free_embedding.restype = None
+    llmodel.llmodel_gpu_init_gpu_device_by_string.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+    llmodel.llmodel_gpu_init_gpu_device_by_string.restype = ctypes.c_bool
 
-llmodel.llmodel_setThreadCount.argtypes = [ctypes.c_void_p, ctypes.c_int32]
-llmodel.llmodel_setThreadCount.restype = None
+    llmodel.llmodel_gpu_init_gpu_device_by_struct.argtypes = [ctypes.c_void_p, ctypes.POINTER(LLModelGPUDevice)]
+    llmodel.llmodel_gpu_init_gpu_device_by_struct.restype = ctypes.c_bool
 
-llmodel.llmodel_set_implementation_search_path.argtypes = [ctypes.c_char_p]
-llmodel.llmodel_set_implementation_search_path.restype = None
+    llmodel.llmodel_gpu_init_gpu_device_by_int.argtypes = [ctypes.c_void_p, ctypes.c_int32]
+    llmodel.llmodel_gpu_init_gpu_device_by_int.restype = ctypes.c_bool
 
-llmodel.llmodel_threadCount.argtypes = [ctypes.c_void_p]
-llmodel.llmodel_threadCount.restype = ctypes.c_int32
+    llmodel.llmodel_model_backend_name.argtypes = [ctypes.c_void_p]
+    llmodel.llmodel_model_backend_name.restype = ctypes.c_char_p
 
-llmodel.llmodel_set_implementation_search_path(str(MODEL_LIB_PATH).encode())
+    llmodel.llmodel_model_gpu_device_name.argtypes = [ctypes.c_void_p]
+    llmodel.llmodel_model_gpu_device_name.restype = ctypes.c_char_p
 
-llmodel.llmodel_available_gpu_devices.argtypes = [ctypes.c_size_t, ctypes.POINTER(ctypes.c_int32)]
-llmodel.llmodel_available_gpu_devices.restype = ctypes.POINTER(LLModelGPUDevice)
+    llmodel.llmodel_count_prompt_tokens.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_char_p)]
+    llmodel.llmodel_count_prompt_tokens.restype = ctypes.c_int32
 
-llmodel.llmodel_gpu_init_gpu_device_by_string.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
-llmodel.llmodel_gpu_init_gpu_device_by_string.restype = ctypes.c_bool
+    llmodel.llmodel_count_prompt_tokens_batch.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_char_p),
+        ctypes.c_int32,
+        ctypes.POINTER(ctypes.c_int32),
+        ctypes.POINTER(ctypes.c_char_p),
+    ]
+    llmodel.llmodel_count_prompt_tokens_batch.restype = ctypes.c_int32
+
+    llmodel.llmodel_tokenize.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        ctypes.POINTER(ctypes.POINTER(ctypes.c_int32)),
+        ctypes.POINTER(ctypes.c_char_p),
+    ]
+    llmodel.llmodel_tokenize.restype = ctypes.c_int32
 
-llmodel.llmodel_gpu_init_gpu_device_by_struct.argtypes = [ctypes.c_void_p, ctypes.POINTER(LLModelGPUDevice)]
-llmodel.llmodel_gpu_init_gpu_device_by_struct.restype = ctypes.c_bool
+    llmodel.llmodel_free_tokens.argtypes = [ctypes.POINTER(ctypes.c_int32)]
+    llmodel.llmodel_free_tokens.restype = None
+
+    llmodel.llmodel_detokenize.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_int32),
+        ctypes.c_size_t,
+        ctypes.POINTER(ctypes.c_size_t),
+        ctypes.POINTER(ctypes.c_char_p),
+    ]
+    # not c_char_p, which would be converted to bytes and lose the pointer needed to free it
+    llmodel.llmodel_detokenize.restype = ctypes.POINTER(ctypes.c_char)
 
-llmodel.llmodel_gpu_init_gpu_device_by_int.argtypes = [ctypes.c_void_p, ctypes.c_int32]
-llmodel.llmodel_gpu_init_gpu_device_by_int.restype = ctypes.c_bool
+    llmodel.llmodel_is_special_token.argtypes = [ctypes.c_void_p, ctypes.c_int32]
+    llmodel.llmodel_is_special_token.restype = ctypes.c_bool
 
-llmodel.llmodel_model_backend_name.argtypes = [ctypes.c_void_p]
-llmodel.llmodel_model_backend_name.restype = ctypes.c_char_p
+    llmodel.llmodel_free_text.argtypes = [ctypes.POINTER(ctypes.c_char)]
+    llmodel.llmodel_free_text.restype = None
 
-llmodel.llmodel_model_gpu_device_name.argtypes = [ctypes.c_void_p]
-llmodel.llmodel_model_gpu_device_name.restype = ctypes.c_char_p
+    llmodel.llmodel_init_sampler.argtypes = [
+        ctypes.c_void_p, ctypes.POINTER(LLModelPromptContext), ctypes.POINTER(ctypes.c_char_p),
+    ]
+    llmodel.llmodel_init_sampler.restype = ctypes.c_bool
 
-llmodel.llmodel_count_prompt_tokens.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char_p)]
-llmodel.llmodel_count_prompt_tokens.restype = ctypes.c_int32
+    llmodel.llmodel_sampler_accept.argtypes = [
+        ctypes.c_void_p, ctypes.POINTER(ctypes.c_int32), ctypes.c_size_t, ctypes.POINTER(ctypes.c_char_p),
+    ]
+    llmodel.llmodel_sampler_accept.restype = ctypes.c_bool
+
+    llmodel.llmodel_decode_sample.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_int32),
+        ctypes.c_size_t,
+        ctypes.c_int32,
+        ctypes.POINTER(ctypes.c_int32),
+        ctypes.POINTER(ctypes.c_bool),
+        ctypes.POINTER(ctypes.c_char_p),
+    ]
+    llmodel.llmodel_decode_sample.restype = ctypes.c_int32
+
+    llmodel.llmodel_sampled_logprob.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_int32,
+        ctypes.c_int32,
+        ctypes.POINTER(ctypes.c_float),
+        ctypes.POINTER(ctypes.c_char_p),
+    ]
+    llmodel.llmodel_sampled_logprob.restype = ctypes.c_bool
+
+    llmodel.llmodel_sampled_top_logprobs.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_int32,
+        ctypes.c_int32,
+        ctypes.POINTER(ctypes.c_int32),
+        ctypes.POINTER(ctypes.c_float),
+        ctypes.POINTER(ctypes.c_char_p),
+    ]
+    llmodel.llmodel_sampled_top_logprobs.restype = ctypes.c_int32
 
-llmodel.llmodel_model_foreach_special_token.argtypes = [ctypes.c_void_p, SpecialTokenCallback]
-llmodel.llmodel_model_foreach_special_token.restype = None
+    llmodel.llmodel_model_foreach_special_token.argtypes = [ctypes.c_void_p, SpecialTokenCallback]
+    llmodel.llmodel_model_foreach_special_token.restype = None
 
+
+PromptCallbackType = Callable[[int, bool], bool]
 ResponseCallbackType = Callable[[int, str], bool]
 RawResponseCallbackType = Callable[[int, bytes], bool]
 EmbCancelCallbackType: TypeAlias = 'Callable[[list[int], str], bool]'
@@ -241,6 +415,52 @@ class Sentinel(Enum):
     TERMINATING_SYMBOL = 0
 
 
+class _CallbackDispatcher:
+    # Passes the library's callbacks on to those of the prompt a model is running. Its ctypes thunks are created once
+    # per model and reused by every prompt instead of being allocated for each call.
+    __slots__ = ('decode', 'append', 'token', 'response', 'prompt', 'prompt_thunk', 'response_thunk')
+
+    def __init__(self) -> None:
+        self.decode: Callable[[bytes], str] = _utf8_decoder(errors='replace').decode
+        self.append: Callable[[str], None] | None = None  # collects the response, if not None
+        self.token: Callable[[int], Any] | None = None  # receives each token id, if not None
+        self.response: ResponseCallbackType | None = None
+        self.prompt: PromptCallbackType | None = None
+        self.prompt_thunk = PromptCallback(self._on_prompt)
+        self.response_thunk = ResponseCallback(self._on_response)
+
+    def start(
+        self, callback: ResponseCallbackType, prompt_callback: PromptCallbackType | None, output: list[str] | None,
+        token_callback: Callable[[int], Any] | None = None,
+    ) -> tuple[Any, ...]:
+        # Returns the callbacks of the prompt that was running, which a callback may have started this one from, to
+        # pass to finish
+        saved = self.decode, self.append, self.token, self.response, self.prompt
+        self.decode = _utf8_decoder(errors='replace').decode
+        self.append = None if output is None else output.append
+        self.token = token_callback
+        self.response = None if callback is empty_response_callback else callback
+        self.prompt = prompt_callback
+        return saved
+
+    def finish(self, saved: tuple[Any, ...]) -> None:
+        self.decode, self.append, self.token, self.response, self.prompt = saved
+
+    def _on_prompt(self, token_ids: ctypes._Pointer[ctypes.c_int32], n_token_ids: int, cached: bool) -> bool:
+        return self.prompt is None or self.prompt(n_token_ids, cached)
+
+    def _on_response(self, token_id: int, response: bytes) -> bool:
+        # the same as LLModel._callback_decoder, inlined to keep the work done for each token to a minimum
+        if self.token is not None:
+            self.token(token_id)
+        decoded = self.decode(response)
+        if not decoded and response:
+            return True  # wait for more continuation bytes
+        if self.append is not None:
+            self.append(decoded)
+        return self.response is None or self.response(token_id, decoded)
+
+
 class EmbedResult(Generic[EmbeddingsType], TypedDict):
     embeddings: EmbeddingsType
     n_prompt_tokens: int
@@ -250,6 +470,89 @@ class CancellationError(Exception):
     """raised when embedding is canceled"""
 
 
+class LLModelState(NamedTuple):
+    """
+    A snapshot of the internal state of an LLModel, as returned by `LLModel.save_state`.
+
+    The state is specific to the model file and context size it was saved from.
+    """
+
+    data: memoryview
+    """The serialized state of the model, including the KV cache."""
+    input_tokens: array[int]
+    """The tokens that were used to produce the KV cache, as int32."""
+
+
+def _as_c_buffer(data: Any, ctype: type[ctypes._SimpleCData]) -> ctypes.Array[Any]:
+    # Wrap a buffer without copying it, unless it is read-only
+    view = memoryview(data).cast('B')
+    n_elem = len(view) // ctypes.sizeof(ctype)
+    if view.readonly:
+        return (ctype * n_elem).from_buffer_copy(view)
+    return (ctype * n_elem).from_buffer(view)
+
+
+def _as_token_buffer(tokens: array[int] | Sequence[int]) -> ctypes.Array[ctypes.c_int32]:
+    # Wrap int32 token ids without copying them, converting other sequences of ints
+    try:
+        view = memoryview(tokens)  # type: ignore[arg-type]
+    except TypeError:
+        view = None
+    if (
+        view is None or view.ndim != 1 or not view.c_contiguous or view.format.lstrip('@=') not in ('i', 'l')
+        or view.itemsize != 4
+    ):
+        tokens = array('i', tokens)
+    return _as_c_buffer(tokens, ctypes.c_int32)
+
+
+_worker_local = threading.local()  # the executor that owns the current thread, if it is a model's worker
+
+
+def _make_worker() -> ThreadPoolExecutor:
+    # concurrent.futures is imported here since it is slow to import
+    from concurrent.futures import ThreadPoolExecutor
+
+    def mark_thread() -> None:
+        _worker_local.executor = executor
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llmodel", initializer=mark_thread)
+    return executor
+
+
+class _TokenCountCache:
+    # An LRU cache of prompt token counts, keyed by a hash of the prompt so that long prompts are not kept alive.
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._counts: OrderedDict[bytes, int] = OrderedDict()
+
+    @staticmethod
+    def key(prompt: str) -> bytes:
+        return hashlib.blake2b(prompt.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+    def get(self, key: bytes) -> int | None:
+        with self._lock:
+            n_tok = self._counts.get(key)
+            if n_tok is not None:
+                self._counts.move_to_end(key)
+            return n_tok
+
+    def put(self, key: bytes, n_tok: int) -> None:
+        with self._lock:
+            self._counts[key] = n_tok
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.maxsize:
+                self._counts.popitem(last=False)
+
+
+class _SharedContext:
+    # The context of a model shared by sessions created with LLModel.new_session, which take turns using it.
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.owner: LLModel | None = None  # the session whose state is currently in the context
+
+
 class LLModel:
     """
     Base class and universal wrapper for GPT4All language models
@@ -267,16 +570,12 @@ class LLModel:
         Backend to use. One of 'auto', 'cpu', 'metal', 'kompute', or 'cuda'.
     """
 
-    def __init__(self, model_path: str, n_ctx: int, ngl: int, backend: str):
-        self.model_path = model_path.encode()
-        self.n_ctx = n_ctx
-        self.ngl = ngl
-        self.buffer = bytearray()
-        self.buff_expecting_cont_bytes: int = 0
+    TOKEN_COUNT_CACHE_SIZE = 65536
 
+    def __init__(self, model_path: str, n_ctx: int, ngl: int, backend: str):
         # Construct a model implementation
         err = ctypes.c_char_p()
-        model = llmodel.llmodel_model_create2(self.model_path, backend.encode(), ctypes.byref(err))
+        model = llmodel.llmodel_model_create2(model_path.encode(), backend.encode(), ctypes.byref(err))
         if model is None:
             s = err.value
             errmsg = 'null' if s is None else s.decode()
@@ -289,10 +588,33 @@ class LLModel:
                 print('WARNING: CUDA runtime libraries not found. Try `pip install "gpt4all[cuda]"`\n', file=sys.stderr)
 
             raise RuntimeError(f"Unable to instantiate model: {errmsg}")
+        self._init_instance(model_path.encode(), n_ctx, ngl, model, None)
+
+    def _init_instance(
+        self, model_path: bytes, n_ctx: int, ngl: int, model: ctypes.c_void_p, base: LLModel | None,
+    ) -> None:
+        # Set up the attributes of a model, or of a session created from base with new_session
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.ngl = ngl
+        # runs prompts in the background for the streaming APIs, one at a time
+        self._worker = _make_worker()
+        self._dispatcher = _CallbackDispatcher()
+        self._shared: _SharedContext | None = None if base is None else base._shared
+        self._base = base  # the model that owns the native handle, if this is a session
+        self._parked_state: LLModelState | None = None  # this session's state while another session uses the context
+        self._stream_stops: set[Callable[[], None]] = set()  # stop the streaming prompts in progress, see close
         self.model: ctypes.c_void_p | None = model
+        self.speculative_stats: SpeculativeStats | None = None  # of the last generation with a draft model
+        if base is not None:
+            # tokenization only depends on the weights
+            self.special_tokens_map = base.special_tokens_map
+            self._token_counts = base._token_counts
+            return
         self.special_tokens_map: dict[str, str] = {}
+        self._token_counts = _TokenCountCache(self.TOKEN_COUNT_CACHE_SIZE)
         llmodel.llmodel_model_foreach_special_token(
-            self.model, lambda n, t: self.special_tokens_map.__setitem__(n.decode(), t.decode()),
+            model, lambda n, t: self.special_tokens_map.__setitem__(n.decode(), t.decode()),
         )
 
     def __del__(self, llmodel=llmodel):
@@ -300,9 +622,92 @@ class LLModel:
             self.close()
 
     def close(self) -> None:
-        if self.model is not None:
-            llmodel.llmodel_model_destroy(self.model)
+        if self.model is None:
+            return
+        # stop streaming prompts, including those waiting for their consumer to catch up, so the worker can finish
+        for stop in list(self._stream_stops):
+            stop()
+        model = self.model
+        deferred = False
+        try:
+            if getattr(_worker_local, 'executor', None) is self._worker:
+                # Called by a prompt running on the worker, e.g. by dropping the last reference to the model from a
+                # callback. The worker cannot wait for itself, and the native prompt may still be on its stack, so
+                # release the model once that prompt has returned.
+                self._worker.submit(self._release, model)
+                deferred = True
+                self._worker.shutdown(wait=False)
+            else:
+                self._worker.shutdown()
+        finally:
+            if not deferred:
+                self._release(model)
             self.model = None
+            self._parked_state = None
+
+    def _release(self, model: ctypes.c_void_p) -> None:
+        if self._base is None:
+            llmodel.llmodel_model_destroy(model)
+        else:
+            assert self._shared is not None
+            with self._shared.lock:
+                if self._shared.owner is self:
+                    self._shared.owner = None
+            self._base = None
+
+    def new_session(self) -> LLModel:
+        """
+        Create a session that shares the loaded weights of this model, but has its own context state.
+
+        Sessions take turns using the model's context. When a session uses it after another one, the other session's
+        state is saved and this session's state is restored, so neither has to process its prompt again. A new session
+        starts with an empty context. Sessions must be closed before the model they were created from.
+        """
+        if self.model is None:
+            self._raise_closed()
+        if self._base is not None:
+            return self._base.new_session()
+
+        if self._shared is None:
+            self._shared = _SharedContext()
+            self._shared.owner = self  # whatever is in the context belongs to this model
+        session = LLModel.__new__(LLModel)
+        session._init_instance(self.model_path, self.n_ctx, self.ngl, self.model, self)
+        return session
+
+    def hold_context(self) -> ContextManager[bool]:
+        """
+        Use the context of this model exclusively for the duration of a with block, e.g. to make several calls to
+        `decode_sample` without another session of the same model using the context in between.
+
+        The with block receives whether another session used the context since this model last held it. State that is
+        not saved with the context, such as the sampler set up by `init_sampler`, must then be set up again.
+        """
+        if self.model is None:
+            self._raise_closed()
+        return self._use_context()
+
+    @contextmanager
+    def _use_context(self) -> Iterator[bool]:
+        # Gives this model exclusive use of its context for the duration, after swapping in this session's state if
+        # another session used the context last. Yields whether it did.
+        shared = self._shared
+        if shared is None:
+            yield False
+            return
+        with shared.lock:
+            switched = shared.owner is not self
+            if switched:
+                if shared.owner is not None:
+                    shared.owner._parked_state = self._save_state()
+                if self._parked_state is not None:
+                    self._restore_state(self._parked_state)
+                    self._parked_state = None
+                else:
+                    # a new session, which must not see the tokens another session left in the context
+                    llmodel.llmodel_reset_context(self.model)
+                shared.owner = self
+            yield switched
 
     def _raise_closed(self) -> NoReturn:
         raise ValueError("Attempted operation on a closed LLModel")
@@ -321,17 +726,209 @@ class LLModel:
         return None if dev is None else dev.decode()
 
     def count_prompt_tokens(self, prompt: str) -> int:
+        """Count the tokens of a prompt. Counts are cached, so counting the same prompt again is cheap."""
         if self.model is None:
             self._raise_closed()
+        key = self._token_counts.key(prompt)
+        if (n_tok := self._token_counts.get(key)) is not None:
+            return n_tok
         err = ctypes.c_char_p()
-        n_tok = llmodel.llmodel_count_prompt_tokens(self.model, prompt, ctypes.byref(err))
+        n_tok = llmodel.llmodel_count_prompt_tokens(self.model, prompt.encode(), ctypes.byref(err))
         if n_tok < 0:
             s = err.value
             errmsg = 'null' if s is None else s.decode()
             raise RuntimeError(f'Unable to count prompt tokens: {errmsg}')
+        self._token_counts.put(key, n_tok)
         return n_tok
 
-    llmodel.llmodel_count_prompt_tokens.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    def count_prompt_tokens_batch(self, prompts: Iterable[str]) -> list[int]:
+        """
+        Count the tokens of each of several prompts. The distinct prompts whose counts are not cached are counted in
+        a single call into the model.
+        """
+        if self.model is None:
+            self._raise_closed()
+        prompts = list(prompts)
+        counts: dict[str, int] = {}
+        keys: dict[str, bytes] = {}  # of the prompts to count
+        for prompt in prompts:
+            if prompt not in counts and prompt not in keys:
+                key = self._token_counts.key(prompt)
+                if (n_tok := self._token_counts.get(key)) is not None:
+                    counts[prompt] = n_tok
+                else:
+                    keys[prompt] = key
+
+        if keys:
+            n_prompts = len(keys)
+            c_prompts = (ctypes.c_char_p * n_prompts)(*(prompt.encode() for prompt in keys))
+            c_counts = (ctypes.c_int32 * n_prompts)()
+            err = ctypes.c_char_p()
+            if llmodel.llmodel_count_prompt_tokens_batch(
+                self.model, c_prompts, n_prompts, c_counts, ctypes.byref(err),
+            ) < 0:
+                s = err.value
+                raise RuntimeError(f"Unable to count prompt tokens: {'null' if s is None else s.decode()}")
+            for (prompt, key), n_tok in zip(keys.items(), c_counts):
+                self._token_counts.put(key, n_tok)
+                counts[prompt] = n_tok
+
+        return [counts[prompt] for prompt in prompts]
+
+    def tokenize(self, prompt: str) -> array[int]:
+        """
+        Tokenize a prompt the same way as `prompt_model` does, including special tokens and the BOS token, if the model
+        uses one.
+
+        Returns:
+            The token ids, as int32.
+        """
+        if self.model is None:
+            self._raise_closed()
+        tokens_ptr = ctypes.POINTER(ctypes.c_int32)()
+        err = ctypes.c_char_p()
+        n_tok = llmodel.llmodel_tokenize(self.model, prompt.encode(), ctypes.byref(tokens_ptr), ctypes.byref(err))
+        if n_tok < 0:
+            s = err.value
+            raise RuntimeError(f"Unable to tokenize: {'null' if s is None else s.decode()}")
+        try:
+            tokens = array('i')
+            tokens.frombytes(ctypes.string_at(tokens_ptr, n_tok * ctypes.sizeof(ctypes.c_int32)))
+        finally:
+            llmodel.llmodel_free_tokens(tokens_ptr)
+        self._token_counts.put(self._token_counts.key(prompt), n_tok)
+        return tokens
+
+    def detokenize(self, tokens: Sequence[int] | array[int]) -> str:
+        """Convert token ids to text, including the text of special tokens."""
+        return self.detokenize_bytes(tokens).decode('utf-8', 'replace')
+
+    def detokenize_bytes(self, tokens: Sequence[int] | array[int]) -> bytes:
+        """Like `detokenize`, but return the UTF-8 encoded text, which may end partway through a character."""
+        if self.model is None:
+            self._raise_closed()
+        if not isinstance(tokens, array) or tokens.itemsize != ctypes.sizeof(ctypes.c_int32):
+            tokens = array('i', tokens)
+        size = ctypes.c_size_t()
+        err = ctypes.c_char_p()
+        text_ptr = llmodel.llmodel_detokenize(
+            self.model, _as_c_buffer(tokens, ctypes.c_int32), len(tokens), ctypes.byref(size), ctypes.byref(err),
+        )
+        if not text_ptr:
+            s = err.value
+            raise RuntimeError(f"Unable to detokenize: {'null' if s is None else s.decode()}")
+        try:
+            return ctypes.string_at(text_ptr, size.value)
+        finally:
+            llmodel.llmodel_free_text(text_ptr)
+
+    def is_special_token(self, token: int) -> bool:
+        """Whether a token is a special token, such as a control token, which is not checked for stop sequences."""
+        if self.model is None:
+            self._raise_closed()
+        return llmodel.llmodel_is_special_token(self.model, token)
+
+    def init_sampler(self, context: LLModelPromptContext) -> None:
+        """Set the sampling parameters for `decode_sample`, and clear the history used for the repetition penalty."""
+        if self.model is None:
+            self._raise_closed()
+        err = ctypes.c_char_p()
+        with self._use_context():
+            ok = llmodel.llmodel_init_sampler(self.model, ctypes.byref(context), ctypes.byref(err))
+        if not ok:
+            s = err.value
+            raise RuntimeError(f"Unable to initialize sampler: {'null' if s is None else s.decode()}")
+
+    def accept_sampled(self, tokens: array[int]) -> None:
+        """
+        Feed tokens to the sampler as if `decode_sample` had sampled them, to restore the repetition penalty history
+        and grammar state of a response that is resumed after `init_sampler`.
+        """
+        if self.model is None:
+            self._raise_closed()
+        if not tokens:
+            return
+        err = ctypes.c_char_p()
+        with self._use_context():
+            ok = llmodel.llmodel_sampler_accept(
+                self.model, _as_c_buffer(tokens, ctypes.c_int32), len(tokens), ctypes.byref(err),
+            )
+        if not ok:
+            s = err.value
+            raise RuntimeError(f"Unable to update sampler: {'null' if s is None else s.decode()}")
+
+    def decode_sample(self, tokens: array[int], n_sample: int) -> tuple[array[int], bool]:
+        """
+        Evaluate a sequence of tokens, reusing the longest prefix already in the context, and sample the token after
+        each of the last n_sample tokens, stopping after the first that differs from the next token of the sequence.
+
+        Returns:
+            The sampled tokens, and whether the last of them ends the response.
+        """
+        if self.model is None:
+            self._raise_closed()
+        sampled = (ctypes.c_int32 * n_sample)()
+        end = ctypes.c_bool()
+        err = ctypes.c_char_p()
+        with self._use_context():
+            n_sampled = llmodel.llmodel_decode_sample(
+                self.model, _as_c_buffer(tokens, ctypes.c_int32), len(tokens), n_sample, sampled, ctypes.byref(end),
+                ctypes.byref(err),
+            )
+        if n_sampled < 0:
+            s = err.value
+            raise RuntimeError(f"Unable to decode: {'null' if s is None else s.decode()}")
+        return array('i', sampled[:n_sampled]), end.value
+
+    def sampled_logprob(self, index: int, token: int) -> float:
+        """
+        Return the log-probability of a token at the index'th position sampled by the last call to `decode_sample`,
+        before the sampling parameters such as the temperature and repetition penalty are applied.
+        """
+        if self.model is None:
+            self._raise_closed()
+        logprob = ctypes.c_float()
+        err = ctypes.c_char_p()
+        with self._use_context():
+            ok = llmodel.llmodel_sampled_logprob(self.model, index, token, ctypes.byref(logprob), ctypes.byref(err))
+        if not ok:
+            s = err.value
+            raise RuntimeError(f"Unable to get logprob: {'null' if s is None else s.decode()}")
+        return logprob.value
+
+    def sampled_top_logprobs(self, index: int, n_top: int) -> tuple[array[int], array[float]]:
+        """
+        Return the n_top most likely tokens at the index'th position sampled by the last call to `decode_sample`, and
+        their log-probabilities as for `sampled_logprob`, most likely first.
+        """
+        if self.model is None:
+            self._raise_closed()
+        if n_top == 0:
+            return array('i'), array('f')
+        token_ids = array('i', bytes(4 * n_top))
+        logprobs = array('f', bytes(4 * n_top))
+        err = ctypes.c_char_p()
+        with self._use_context():
+            n = llmodel.llmodel_sampled_top_logprobs(
+                self.model, index, n_top, _as_c_buffer(token_ids, ctypes.c_int32),
+                _as_c_buffer(logprobs, ctypes.c_float), ctypes.byref(err),
+            )
+        if n < 0:
+            s = err.value
+            raise RuntimeError(f"Unable to get logprobs: {'null' if s is None else s.decode()}")
+        return token_ids[:n], logprobs[:n]
+
+    def score_tokens(self, tokens: array[int] | Sequence[int], n_prompt: int, top_n: int = 0) -> TokenLogprobs:
+        """
+        Compute the log-probability of each token after the first n_prompt, given the tokens before it, under the
+        model's distribution, e.g. to compute the perplexity of a reference response.
+        """
+        if self.model is None:
+            self._raise_closed()
+        from . import _logprobs
+
+        with self._use_context():
+            return _logprobs.score(self, array('i', tokens), n_prompt, top_n)
 
     @staticmethod
     def list_gpus(mem_required: int = 0) -> list[str]:
@@ -396,6 +993,66 @@ class LLModel:
             raise Exception("Model not loaded")
         return llmodel.llmodel_threadCount(self.model)
 
+    def save_state(self) -> LLModelState:
+        """
+        Save the internal state of the model, including the KV cache and the tokens used to produce it.
+
+        Returns:
+            The saved state. Its data is a view of a buffer owned by Python, so it can be written out or restored
+            without further copies.
+        """
+        if self.model is None:
+            self._raise_closed()
+        with self._use_context():
+            return self._save_state()
+
+    def _save_state(self) -> LLModelState:
+        state_size = llmodel.llmodel_state_get_size(self.model)
+        buf = bytearray(state_size)
+        input_tokens_ptr = ctypes.POINTER(ctypes.c_int32)()
+        n_input_tokens = ctypes.c_uint64()
+        bytes_written = llmodel.llmodel_state_get_data(
+            self.model, _as_c_buffer(buf, ctypes.c_uint8), state_size, ctypes.byref(input_tokens_ptr),
+            ctypes.byref(n_input_tokens),
+        )
+        if not bytes_written:
+            raise RuntimeError("Unable to save model state")
+
+        try:
+            input_tokens = array('i')
+            n_bytes = n_input_tokens.value * ctypes.sizeof(ctypes.c_int32)
+            input_tokens.frombytes(ctypes.string_at(input_tokens_ptr, n_bytes))
+        finally:
+            llmodel.llmodel_state_free_input_tokens(input_tokens_ptr)
+
+        return LLModelState(memoryview(buf)[:bytes_written], input_tokens)
+
+    def restore_state(self, state: LLModelState | tuple[Any, Sequence[int]]) -> None:
+        """
+        Restore the internal state of the model from a previous call to `save_state`.
+
+        Args:
+            state: The state to restore. The data may be any object supporting the buffer protocol, and is passed to
+                the backend without copying unless it is read-only.
+        """
+        if self.model is None:
+            self._raise_closed()
+        with self._use_context():
+            self._restore_state(state)
+
+    def _restore_state(self, state: LLModelState | tuple[Any, Sequence[int]]) -> None:
+        data, input_tokens = state
+        if not isinstance(input_tokens, array) or input_tokens.itemsize != ctypes.sizeof(ctypes.c_int32):
+            input_tokens = array('i', input_tokens)
+        c_data = _as_c_buffer(data, ctypes.c_uint8)
+        c_input_tokens = _as_c_buffer(input_tokens, ctypes.c_int32)
+
+        bytes_read = llmodel.llmodel_state_set_data(
+            self.model, c_data, len(c_data), c_input_tokens, len(input_tokens),
+        )
+        if not bytes_read:
+            raise RuntimeError("Unable to restore model state")
+
     @overload
     def generate_embeddings(
         self, text: str, prefix: str | None, dimensionality: int, do_mean: bool, atlas: bool,
@@ -419,12 +1076,87 @@ class LLModel:
         if not text:
             raise ValueError("text must not be None or empty")
 
-        if self.model is None:
-            self._raise_closed()
+        if single_text := isinstance(text, str):
+            text = [text]
+
+        embedding_ptr, embedding_size, token_count = self._embed(
+            text, prefix, dimensionality, do_mean, atlas, cancel_cb,
+        )
+
+        # extract output
+        n_embd = embedding_size // len(text)
+        embedding_array = [
+            embedding_ptr[i:i + n_embd]
+            for i in range(0, embedding_size, n_embd)
+        ]
+        llmodel.llmodel_free_embedding(embedding_ptr)
+
+        embeddings = embedding_array[0] if single_text else embedding_array
+        return {'embeddings': embeddings, 'n_prompt_tokens': token_count}
+
+    def generate_embeddings_array(
+        self, text: str | list[str], prefix: str | None, dimensionality: int, do_mean: bool, atlas: bool,
+        cancel_cb: EmbCancelCallbackType | None,
+    ) -> EmbedResult[NDArray[Any]]:
+        """
+        Like `generate_embeddings`, but the embeddings are returned as a float32 NumPy array of shape (n_texts, dim),
+        or (dim,) for a single text.
+
+        The array is a view of the buffer allocated by the backend, which is freed once the array and all views of it
+        have been garbage collected.
+        """
+        import numpy as np
+
+        if not text:
+            raise ValueError("text must not be None or empty")
 
         if single_text := isinstance(text, str):
             text = [text]
 
+        embedding_ptr, embedding_size, token_count = self._embed(
+            text, prefix, dimensionality, do_mean, atlas, cancel_cb,
+        )
+
+        # take ownership of the backend's buffer
+        buf = (ctypes.c_float * embedding_size).from_address(ctypes.addressof(embedding_ptr.contents))
+        weakref.finalize(buf, llmodel.llmodel_free_embedding, embedding_ptr)
+
+        embeddings = np.frombuffer(buf, dtype=np.float32).reshape(len(text), embedding_size // len(text))
+        if single_text:
+            embeddings = embeddings[0]
+        return {'embeddings': embeddings, 'n_prompt_tokens': token_count}
+
+    def generate_embeddings_bytes(
+        self, text: list[str], prefix: str | None, dimensionality: int, do_mean: bool, atlas: bool,
+        cancel_cb: EmbCancelCallbackType | None,
+    ) -> tuple[list[bytes], int]:
+        """
+        Like `generate_embeddings`, but each embedding is returned as the float32 bytes written by the model, along
+        with the number of prompt tokens.
+        """
+        if not text:
+            raise ValueError("text must not be None or empty")
+
+        embedding_ptr, embedding_size, token_count = self._embed(
+            text, prefix, dimensionality, do_mean, atlas, cancel_cb,
+        )
+        try:
+            data = ctypes.string_at(embedding_ptr, embedding_size * ctypes.sizeof(ctypes.c_float))
+        finally:
+            llmodel.llmodel_free_embedding(embedding_ptr)
+
+        stride = len(data) // len(text)
+        return [data[i:i + stride] for i in range(0, len(data), stride)], token_count
+
+    def _embed(
+        self, text: list[str], prefix: str | None, dimensionality: int, do_mean: bool, atlas: bool,
+        cancel_cb: EmbCancelCallbackType | None,
+    ) -> tuple[ctypes._Pointer[ctypes.c_float], int, int]:
+        # Returns the embeddings buffer, which must be freed with llmodel_free_embedding, its size, and the number of
+        # prompt tokens.
+        if self.model is None:
+            self._raise_closed()
+
         # prepare input
         embedding_size = ctypes.c_size_t()
         token_count = ctypes.c_size_t()
@@ -441,10 +1173,11 @@ class LLModel:
         cancel_cb_wrapper = EmbCancelCallback() if cancel_cb is None else EmbCancelCallback(wrap_cancel_cb)
 
         # generate the embeddings
-        embedding_ptr = llmodel.llmodel_embed(
-            self.model, c_texts, ctypes.byref(embedding_size), c_prefix, dimensionality, ctypes.byref(token_count),
-            do_mean, atlas, cancel_cb_wrapper, ctypes.byref(error),
-        )
+        with self._use_context():
+            embedding_ptr = llmodel.llmodel_embed(
+                self.model, c_texts, ctypes.byref(embedding_size), c_prefix, dimensionality,
+                ctypes.byref(token_count), do_mean, atlas, cancel_cb_wrapper, ctypes.byref(error),
+            )
 
         if not embedding_ptr:
             msg = "(unknown error)" if error.value is None else error.value.decode()
@@ -452,20 +1185,11 @@ class LLModel:
                 raise CancellationError(msg)
             raise RuntimeError(f'Failed to generate embeddings: {msg}')
 
-        # extract output
-        n_embd = embedding_size.value // len(text)
-        embedding_array = [
-            embedding_ptr[i:i + n_embd]
-            for i in range(0, embedding_size.value, n_embd)
-        ]
-        llmodel.llmodel_free_embedding(embedding_ptr)
-
-        embeddings = embedding_array[0] if single_text else embedding_array
-        return {'embeddings': embeddings, 'n_prompt_tokens': token_count.value}
+        return embedding_ptr, embedding_size.value, token_count.value
 
     def prompt_model(
         self,
-        prompt          : str,
+        prompt          : str | None,
         callback        : ResponseCallbackType,
         n_predict       : int                  = 4096,
         top_k           : int                  = 40,
@@ -477,6 +1201,14 @@ class LLModel:
         repeat_last_n   : int                  = 10,
         context_erase   : float                = 0.75,
         reset_context   : bool                 = False,
+        prompt_callback : PromptCallbackType | None = None,
+        draft_model     : LLModel | None       = None,
+        n_draft         : int                  = 4,
+        output          : list[str] | None     = None,
+        grammar         : str | None           = None,
+        tokens          : array[int] | Sequence[int] | None = None,
+        logprobs        : TokenLogprobs | None = None,
+        token_callback  : Callable[[int], Any] | None = None,
     ):
         """
         Generate response from model from a prompt.
@@ -484,9 +1216,29 @@ class LLModel:
         Parameters
         ----------
         prompt: str
-            Question, task, or conversation for model to respond to
+            Question, task, or conversation for model to respond to, or None if tokens is given
         callback(token_id:int, response:str): bool
             The model sends response tokens to callback
+        prompt_callback(n_tokens:int, cached:bool): bool
+            Called as prompt tokens are processed, with whether they were already in the model's context
+        draft_model: LLModel
+            A smaller model with the same vocabulary that proposes n_draft tokens at a time for this model to verify in
+            one batch (speculative decoding). Statistics are stored in `speculative_stats`. prompt_callback is then
+            called once for the whole prompt, which is never reported as cached.
+        output: list[str]
+            If given, the response is appended to it piece by piece before each call to callback
+        grammar: str
+            A GBNF grammar with a "root" rule. Tokens that cannot continue a response matching it are never sampled.
+        tokens: array[int]
+            The prompt as token ids, e.g. from `tokenize`, instead of text. An int32 buffer such as array('i') is passed
+            to the model without being copied.
+        logprobs: TokenLogprobs
+            If given, the log-probability of each response token, and its top_n most likely alternatives, is appended to
+            it before each call to callback. The response is then generated token by token, which stops when the
+            context window is full, and prompt_callback is called once for the whole prompt.
+        token_callback(token_id:int)
+            Called with the id of each response token as soon as it is generated, before it is decoded. Unlike callback,
+            it is called once per token even when several tokens make up one character.
 
         Returns
         -------
@@ -495,9 +1247,8 @@ class LLModel:
 
         if self.model is None:
             self._raise_closed()
-
-        self.buffer.clear()
-        self.buff_expecting_cont_bytes = 0
+        if (prompt is None) == (tokens is None):
+            raise ValueError("Exactly one of prompt and tokens must be given")
 
         context = LLModelPromptContext(
             n_predict      = n_predict,
@@ -509,25 +1260,157 @@ class LLModel:
             repeat_penalty = repeat_penalty,
             repeat_last_n  = repeat_last_n,
             context_erase  = context_erase,
+            grammar        = None if grammar is None else grammar.encode(),
         )
 
+        if logprobs is not None:
+            if draft_model is not None:
+                raise ValueError("logprobs cannot be used with a draft model")
+            from . import _parallel
+
+            with self._use_context():
+                _parallel.generate(
+                    self, prompt if tokens is None else tokens, 1,
+                    lambda index: self._callback_decoder(callback, output, token_callback), context, prompt_callback,
+                    [logprobs],
+                )
+            return
+
+        if draft_model is not None:
+            if draft_model.model is None:
+                draft_model._raise_closed()
+            from . import _speculative
+
+            # the draft only needs to guess well, so it samples greedily. It does not follow the grammar, because its
+            # sampler would also advance the grammar over the proposals that are rejected.
+            draft_context = LLModelPromptContext(
+                n_predict=n_predict, temp=0.0, n_batch=n_batch, repeat_penalty=repeat_penalty,
+                repeat_last_n=repeat_last_n,
+            )
+            with self._use_context(), draft_model._use_context():
+                self.speculative_stats = _speculative.generate(
+                    self, draft_model, prompt if tokens is None else tokens,
+                    self._callback_decoder(callback, output, token_callback), context, draft_context, n_draft,
+                    prompt_callback,
+                )
+            return
+
         error_msg: bytes | None = None
         def error_callback(msg: bytes) -> None:
             nonlocal error_msg
             error_msg = msg
 
+        dispatcher = self._dispatcher
         err = ctypes.c_char_p()
-        if not llmodel.llmodel_prompt(
-            self.model,
-            ctypes.c_char_p(prompt.encode()),
-            PromptCallback(self._prompt_callback),
-            ResponseCallback(self._callback_decoder(callback)),
-            context,
-            ctypes.byref(err),
-        ):
+        with self._use_context():
+            # set the callbacks only once this model holds the context, while no other prompt can be using them
+            saved = dispatcher.start(callback, prompt_callback, output, token_callback)
+            try:
+                if tokens is None:
+                    assert prompt is not None
+                    ok = llmodel.llmodel_prompt(
+                        self.model,
+                        ctypes.c_char_p(prompt.encode()),
+                        dispatcher.prompt_thunk,
+                        dispatcher.response_thunk,
+                        context,
+                        ctypes.byref(err),
+                    )
+                else:
+                    ok = llmodel.llmodel_prompt_tokens(
+                        self.model,
+                        _as_token_buffer(tokens),
+                        len(tokens),
+                        dispatcher.prompt_thunk,
+                        dispatcher.response_thunk,
+                        context,
+                        ctypes.byref(err),
+                    )
+            finally:
+                dispatcher.finish(saved)
+        if not ok:
             s = err.value
             raise RuntimeError(f"prompt error: {'null' if s is None else s.decode()}")
 
+    def prompt_model_samples(
+        self,
+        prompt          : str | None,
+        n               : int,
+        callback        : Callable[[int, int, str], bool],
+        n_predict       : int                  = 4096,
+        top_k           : int                  = 40,
+        top_p           : float                = 0.9,
+        min_p           : float                = 0.0,
+        temp            : float                = 0.1,
+        n_batch         : int                  = 8,
+        repeat_penalty  : float                = 1.2,
+        repeat_last_n   : int                  = 10,
+        prompt_callback : PromptCallbackType | None = None,
+        outputs         : list[list[str]] | None = None,
+        grammar         : str | None           = None,
+        tokens          : array[int] | Sequence[int] | None = None,
+        logprobs        : list[TokenLogprobs] | None = None,
+        token_callback  : Callable[[int], Any] | None = None,
+    ) -> list[Sample]:
+        """
+        Generate n responses to one prompt, evaluating the prompt only once.
+
+        Parameters
+        ----------
+        prompt: str
+            Question, task, or conversation for model to respond to, or None if tokens is given
+        n: int
+            The number of responses to generate
+        callback(index:int, token_id:int, response:str): bool
+            The model sends the tokens of the index'th response to callback. Returning False stops that response.
+        prompt_callback(n_tokens:int, cached:bool): bool
+            Called once for the whole prompt, which is never reported as cached
+        outputs: list[list[str]]
+            If given, n lists to which the responses are appended piece by piece before each call to callback
+        logprobs: list[TokenLogprobs]
+            If given, n structures to which the log-probabilities of the response tokens are appended
+        token_callback(token_id:int)
+            Called with the id of each token generated for any of the responses
+
+        The remaining parameters have the same meaning as for `prompt_model`. Unlike `prompt_model`, generation stops
+        when the context window is full.
+
+        Returns
+        -------
+        The number of tokens and total log-probability of each response.
+        """
+
+        if self.model is None:
+            self._raise_closed()
+        if (prompt is None) == (tokens is None):
+            raise ValueError("Exactly one of prompt and tokens must be given")
+        if n < 1:
+            raise ValueError(f"n must be at least 1, got {n}")
+
+        context = LLModelPromptContext(
+            n_predict      = n_predict,
+            top_k          = top_k,
+            top_p          = top_p,
+            min_p          = min_p,
+            temp           = temp,
+            n_batch        = n_batch,
+            repeat_penalty = repeat_penalty,
+            repeat_last_n  = repeat_last_n,
+            grammar        = None if grammar is None else grammar.encode(),
+        )
+
+        def make_callback(index: int) -> RawResponseCallbackType:
+            return self._callback_decoder(
+                functools.partial(callback, index), None if outputs is None else outputs[index], token_callback,
+            )
+
+        from . import _parallel
+
+        with self._use_context():
+            return _parallel.generate(
+                self, prompt if tokens is None else tokens, n, make_callback, context, prompt_callback, logprobs,
+            )
+
     def prompt_model_streaming(
         self, prompt: str, callback: ResponseCallbackType = empty_response_callback, **kwargs: Any,
     ) -> Iterator[str]:
@@ -535,82 +1418,122 @@ class LLModel:
             self._raise_closed()
 
         output_queue: Queue[str | Sentinel] = Queue()
+        stop = threading.Event()
 
         # Put response tokens into an output queue
-        def _generator_callback_wrapper(callback: ResponseCallbackType) -> ResponseCallbackType:
-            def _generator_callback(token_id: int, response: str):
-                nonlocal callback
-
-                if callback(token_id, response):
-                    output_queue.put(response)
-                    return True
-
+        def _generator_callback(token_id: int, response: str) -> bool:
+            if stop.is_set() or not callback(token_id, response):
                 return False
+            output_queue.put(response)
+            return True
 
-            return _generator_callback
-
-        def run_llmodel_prompt(prompt: str, callback: ResponseCallbackType, **kwargs):
-            self.prompt_model(prompt, callback, **kwargs)
-            output_queue.put(Sentinel.TERMINATING_SYMBOL)
+        def run_llmodel_prompt() -> None:
+            try:
+                self.prompt_model(prompt, _generator_callback, **kwargs)
+            finally:
+                output_queue.put(Sentinel.TERMINATING_SYMBOL)
 
-        # Kick off llmodel_prompt in separate thread so we can return generator
-        # immediately
-        thread = threading.Thread(
-            target=run_llmodel_prompt,
-            args=(prompt, _generator_callback_wrapper(callback)),
-            kwargs=kwargs,
-        )
-        thread.start()
+        # Kick off llmodel_prompt in the background so we can return tokens as they are generated
+        self._stream_stops.add(stop.set)
+        future = self._worker.submit(run_llmodel_prompt)
 
         # Generator
-        while True:
-            response = output_queue.get()
-            if isinstance(response, Sentinel):
-                break
-            yield response
+        try:
+            while True:
+                response = output_queue.get()
+                if isinstance(response, Sentinel):
+                    break
+                yield response
+        finally:
+            # stop generating if the generator is closed early
+            stop.set()
+            self._stream_stops.discard(stop.set)
+
+        future.result()  # raise any error from the prompt
+
+    async def prompt_model_async(
+        self, prompt: str, callback: ResponseCallbackType = empty_response_callback, max_pending: int = 16,
+        **kwargs: Any,
+    ) -> AsyncIterator[str]:
+        """
+        Generate a response from a prompt without blocking the event loop.
 
-    def _callback_decoder(self, callback: ResponseCallbackType) -> RawResponseCallbackType:
-        def _raw_callback(token_id: int, response: bytes) -> bool:
-            nonlocal self, callback
+        The prompt is processed on a background thread shared by all calls on this model, so concurrent calls run one
+        after the other. Generation pauses while `max_pending` tokens are waiting to be consumed, and stops as soon as
+        the iterator is closed or the consuming task is cancelled.
+        """
+        if self.model is None:
+            self._raise_closed()
 
-            decoded = []
+        import asyncio
 
-            for byte in response:
+        loop = asyncio.get_running_loop()
+        output_queue: asyncio.Queue[str | Sentinel] = asyncio.Queue()
+        pending = threading.Semaphore(max_pending)
+        stop = threading.Event()
 
-                bits = "{:08b}".format(byte)
-                (high_ones, _, _) = bits.partition('0')
+        def put(item: str | Sentinel) -> None:
+            try:
+                loop.call_soon_threadsafe(output_queue.put_nowait, item)
+            except RuntimeError:
+                stop.set()  # event loop is closed, nobody is listening
 
-                if len(high_ones) == 1:
-                    # continuation byte
-                    self.buffer.append(byte)
-                    self.buff_expecting_cont_bytes -= 1
+        # Put response tokens into an output queue, waiting for the consumer to catch up
+        def _generator_callback(token_id: int, response: str) -> bool:
+            if stop.is_set() or not callback(token_id, response):
+                return False
+            pending.acquire()
+            if stop.is_set():
+                return False
+            put(response)
+            return True
 
-                else:
-                    # beginning of a byte sequence
-                    if len(self.buffer) > 0:
-                        decoded.append(self.buffer.decode(errors='replace'))
+        def run_llmodel_prompt() -> None:
+            try:
+                self.prompt_model(prompt, _generator_callback, **kwargs)
+            finally:
+                put(Sentinel.TERMINATING_SYMBOL)
 
-                        self.buffer.clear()
+        def cancel() -> None:
+            stop.set()
+            pending.release()  # wake the prompt if it is waiting for the consumer
 
-                    self.buffer.append(byte)
-                    self.buff_expecting_cont_bytes = max(0, len(high_ones) - 1)
+        self._stream_stops.add(cancel)
+        future = loop.run_in_executor(self._worker, run_llmodel_prompt)
 
-                if self.buff_expecting_cont_bytes <= 0:
-                    # received the whole sequence or an out of place continuation byte
-                    decoded.append(self.buffer.decode(errors='replace'))
+        try:
+            while True:
+                response = await output_queue.get()
+                if isinstance(response, Sentinel):
+                    break
+                pending.release()
+                yield response
+            await future  # raise any error from the prompt
+        finally:
+            self._stream_stops.discard(cancel)
+            if not future.done():
+                # stop generating if the iterator is closed early or the task is cancelled
+                cancel()
 
-                    self.buffer.clear()
-                    self.buff_expecting_cont_bytes = 0
+    @staticmethod
+    def _callback_decoder(
+        callback: ResponseCallbackType, output: list[str] | None = None,
+        token_callback: Callable[[int], Any] | None = None,
+    ) -> RawResponseCallbackType:
+        # Tokens may end partway through a multibyte UTF-8 sequence, so decode incrementally and hold on to incomplete
+        # sequences until the rest arrives with the following tokens
+        decode = _utf8_decoder(errors='replace').decode
+        append = None if output is None else output.append
 
-            if len(decoded) == 0 and self.buff_expecting_cont_bytes > 0:
+        def _raw_callback(token_id: int, response: bytes) -> bool:
+            if token_callback is not None:
+                token_callback(token_id)
+            decoded = decode(response)
+            if not decoded and response:
                 # wait for more continuation bytes
                 return True
-
-            return callback(token_id, ''.join(decoded))
+            if append is not None:
+                append(decoded)
+            return callback(token_id, decoded)
 
         return _raw_callback
-
-    # Empty prompt callback
-    @staticmethod
-    def _prompt_callback(token_ids: ctypes._Pointer[ctypes.c_int32], n_token_ids: int, cached: bool) -> bool:
-        return True
@@ -0,0 +1,122 @@
+"""
+Reference-counted registry of loaded models, shared between GPT4All instances.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from typing import NamedTuple
+
+from ._pyllmodel import LLModel
+
+
+class _ModelKey(NamedTuple):
+    path: str
+    backend: str
+    n_ctx: int
+    ngl: int
+    device: str | None
+
+
+class _Entry:
+    def __init__(self, model: LLModel, nbytes: int):
+        self.model = model
+        self.nbytes = nbytes
+        self.refs = 0
+
+
+class ModelRegistry:
+    """
+    A reference-counted registry of loaded models.
+
+    GPT4All instances constructed with the same registry and model settings share one copy of the model weights. Each
+    instance gets a session with its own context state, which is swapped in when the instance uses the model. A model
+    that is no longer used by any instance is kept loaded while the total size of such idle models is within a byte
+    budget, so that a new instance can reuse it without loading it again.
+    """
+
+    def __init__(self, max_idle_bytes: int = 0):
+        """
+        Constructor
+
+        Args:
+            max_idle_bytes: The maximum total size, in bytes, of the model files of idle models to keep loaded. The
+                least recently used idle models are unloaded first. Default is 0, in which case a model is unloaded as
+                soon as it is no longer used.
+        """
+        if max_idle_bytes < 0:
+            raise ValueError(f"max_idle_bytes must not be negative, got {max_idle_bytes}")
+        self.max_idle_bytes = max_idle_bytes
+        # reentrant, since a session may be garbage collected while the lock is held
+        self._lock = threading.RLock()
+        self._entries: dict[_ModelKey, _Entry] = {}
+        self._idle: OrderedDict[_ModelKey, None] = OrderedDict()  # least recently used first
+        self._finalizers: weakref.WeakKeyDictionary[LLModel, weakref.finalize] = weakref.WeakKeyDictionary()
+
+    def acquire(self, model_path: str, backend: str, n_ctx: int, ngl: int, device: str | None = None) -> LLModel:
+        """
+        Get a session of a model, loading it if it is not already loaded.
+
+        Returns:
+            A session that shares the model's weights. Call `release` (or close the GPT4All instance that owns it) when
+            it is no longer needed.
+        """
+        key = _ModelKey(os.path.abspath(model_path), backend, n_ctx, ngl, device)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # loading is slow, but holding the lock ensures a model is not loaded twice by concurrent callers
+                model = LLModel(key.path, n_ctx, ngl, backend)
+                try:
+                    if device is not None:
+                        model.init_gpu(device)
+                    if not model.load_model():
+                        raise RuntimeError(f"Unable to load model: {key.path!r}")
+                except:
+                    model.close()
+                    raise
+                entry = self._entries[key] = _Entry(model, os.path.getsize(key.path))
+            self._idle.pop(key, None)
+            session = entry.model.new_session()
+            entry.refs += 1
+            # sessions that are garbage collected without being released are released then
+            self._finalizers[session] = weakref.finalize(session, self._release, key)
+            return session
+
+    def release(self, session: LLModel) -> None:
+        """Close a session returned by `acquire`, and unload its model if it is idle and over budget."""
+        session.close()
+        finalizer = self._finalizers.pop(session, None)
+        if finalizer is not None:
+            finalizer()
+
+    def _release(self, key: _ModelKey) -> None:
+        with self._lock:
+            entry = self._entries[key]
+            entry.refs -= 1
+            if not entry.refs:
+                self._idle[key] = None
+                self._evict()
+
+    def _evict(self) -> None:
+        idle_bytes = sum(self._entries[key].nbytes for key in self._idle)
+        while self._idle and idle_bytes > self.max_idle_bytes:
+            key, _ = self._idle.popitem(last=False)
+            entry = self._entries.pop(key)
+            entry.model.close()
+            idle_bytes -= entry.nbytes
+
+    def clear(self) -> None:
+        """Unload all idle models."""
+        with self._lock:
+            for key in self._idle:
+                self._entries.pop(key).model.close()
+            self._idle.clear()
+
+    @property
+    def n_loaded(self) -> int:
+        """The number of models currently loaded, including idle ones."""
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,401 @@
+"""
+A scheduler that runs generation requests from many threads or coroutines on one loaded model.
+"""
+from __future__ import annotations
+
+import itertools
+import threading
+import time
+from array import array
+from types import TracebackType
+from typing import TYPE_CHECKING, Any, Sequence, TypedDict
+
+from ._grammar import json_schema_to_grammar
+from ._pyllmodel import LLModel, LLModelPromptContext, ResponseCallbackType, empty_response_callback
+from ._speculative import _common_prefix_length, _ResponseEmitter
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+    from typing_extensions import Self
+
+    from .gpt4all import GPT4All
+
+
+class DeadlineExceededError(TimeoutError):
+    """Raised by a request to a `Scheduler` that did not finish before its deadline."""
+
+    def __init__(self, message: str, partial_response: str):
+        super().__init__(message)
+        self.partial_response = partial_response
+        """The text generated before the deadline, which may end partway through a stop sequence."""
+
+
+class SchedulerStats(TypedDict):
+    n_queued: int
+    """The number of requests waiting for a session."""
+    n_active: int
+    """The number of requests that have a session, including those waiting for their next turn."""
+    oldest_queued_wait: float
+    """How long the request that has been queued the longest has waited, in seconds, or 0 if none is queued."""
+    n_completed: int
+    """The number of requests that finished, including those stopped by their callback."""
+    n_expired: int
+    """The number of requests that did not finish before their deadline."""
+    n_failed: int
+    """The number of requests that raised an error."""
+    n_preemptions: int
+    """The number of times a request was paused to give another one a turn."""
+    n_prompt_tokens: int
+    """The number of prompt tokens processed, excluding those reused from a session's context."""
+    n_generated_tokens: int
+    """The number of tokens sampled."""
+
+
+class _Session:
+    # A context of the model, and the tokens in it, which the next request may share a prefix with
+    __slots__ = ('model', 'tokens', 'busy')
+
+    def __init__(self, model: LLModel):
+        self.model = model
+        self.tokens = array('i')
+        self.busy = False
+
+
+class _Request:
+    __slots__ = (
+        'future', 'tokens', 'n_prompt', 'n_evaluated', 'context', 'emit', 'pieces', 'deadline', 'submit_time', 'seq',
+        'last_turn', 'session',
+    )
+
+    def __init__(
+        self, future: Future[str], tokens: array[int], context: LLModelPromptContext, deadline: float | None,
+        seq: int,
+    ):
+        self.future = future
+        self.tokens = tokens  # the prompt, then the tokens sampled after it
+        self.n_prompt = len(tokens)
+        self.n_evaluated = 0  # the number of prompt tokens known to be in the session's context
+        self.context = context
+        self.emit: _ResponseEmitter | None = None
+        self.pieces: list[str] = []
+        self.deadline = deadline
+        self.submit_time = time.monotonic()
+        self.seq = seq
+        self.last_turn = -1
+        self.session: _Session | None = None
+
+    def priority(self) -> tuple[float, int]:
+        # Earliest deadline first, then the request that waited longest for its turn
+        return (float('inf') if self.deadline is None else self.deadline, self.last_turn)
+
+    def queue_priority(self) -> tuple[float, int]:
+        return (float('inf') if self.deadline is None else self.deadline, self.seq)
+
+
+class Scheduler:
+    """
+    Runs generation requests from many threads or coroutines on one loaded model.
+
+    The model's context holds one sequence at a time, so requests cannot share a decoding step. Instead, each active
+    request has a session with its own context state (see `LLModel.new_session`), and the requests take turns
+    generating up to `slice_tokens` tokens at a time: those with the earliest deadline first, and otherwise the one that
+    has waited longest for its turn. A request whose deadline is earlier than that of the request generating takes over
+    without waiting for the end of the slice. Long prompts are processed in chunks of `prefill_chunk` tokens, so that
+    they do not hold up the other requests either. A new request is given the free session whose context shares the
+    longest prefix with its prompt, e.g. the same system message, so that the prefix is not processed again.
+
+    Chat templates are not applied. Like `GPT4All.generate` with a draft model, generation stops when the context
+    window is full instead of discarding the beginning of the context.
+    """
+
+    def __init__(
+        self, model: GPT4All, *, max_active: int = 4, slice_tokens: int = 128, prefill_chunk: int = 512,
+    ):
+        """
+        Constructor
+
+        Args:
+            model: The model to generate with. Calls to its `generate` method may be made at the same time, but each
+                one holds up the scheduled requests until it is done. Close the scheduler before the model.
+            max_active: The maximum number of requests with a session at the same time. Each session keeps a copy of
+                its context state in memory while another one uses the model.
+            slice_tokens: The number of tokens a request generates before the next request has its turn. Smaller
+                values share the model more fairly, at the cost of swapping context states more often, which copies
+                the whole state of the context each time.
+            prefill_chunk: The number of prompt tokens a request processes in one turn.
+        """
+        if max_active < 1:
+            raise ValueError(f"max_active must be at least 1, got {max_active}")
+        if slice_tokens < 1:
+            raise ValueError(f"slice_tokens must be at least 1, got {slice_tokens}")
+        if prefill_chunk < 1:
+            raise ValueError(f"prefill_chunk must be at least 1, got {prefill_chunk}")
+        self.model = model
+        self.max_active = max_active
+        self.slice_tokens = slice_tokens
+        self.prefill_chunk = prefill_chunk
+
+        self._cond = threading.Condition()
+        self._queued: list[_Request] = []
+        self._active: list[_Request] = []
+        self._sessions: list[_Session] = []
+        self._seq = itertools.count()
+        self._turns = itertools.count()
+        self._closing = False
+        self._sampler_owner: _Request | None = None  # the request whose sampler state the model has
+        self._last_run: _Request | None = None
+        self._n_completed = self._n_expired = self._n_failed = self._n_preemptions = 0
+        self._n_prompt_tokens = self._n_generated_tokens = 0
+        self._thread = threading.Thread(target=self._run, name="gpt4all-scheduler", daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self, typ: type[BaseException] | None, value: BaseException | None, tb: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Wait for the submitted requests to finish, then close the sessions."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        for session in self._sessions:
+            session.model.close()
+        self._sessions.clear()
+
+    def submit(
+        self,
+        prompt         : str | Sequence[int],
+        *,
+        max_tokens     : int                   = 200,
+        temp           : float                 = 0.7,
+        top_k          : int                   = 40,
+        top_p          : float                 = 0.4,
+        min_p          : float                 = 0.0,
+        repeat_penalty : float                 = 1.18,
+        repeat_last_n  : int                   = 64,
+        callback       : ResponseCallbackType  = empty_response_callback,
+        grammar        : str | None            = None,
+        json_schema    : dict[str, Any] | None = None,
+        timeout        : float | None          = None,
+    ) -> Future[str]:
+        """
+        Submit a request for a completion.
+
+        Args:
+            prompt: The prompt for the model to complete, as text or as token ids from `GPT4All.tokenize`.
+            callback: A function with arguments token_id:int and response:str, which receives the tokens as they are
+                generated and stops the generation by returning False. It is called on the scheduler's thread.
+            timeout: The number of seconds from now by which the request must finish. If it has not, the future's
+                `result` raises `DeadlineExceededError`. Default is None, for no deadline.
+
+            The remaining arguments have the same meaning as for `GPT4All.generate`.
+
+        Returns:
+            A future for the completion. Cancelling it only has an effect while the request is queued. To wait for it
+            in a coroutine, use `asyncio.wrap_future`, or call `agenerate` instead.
+        """
+        from concurrent.futures import Future
+
+        if json_schema is not None:
+            if grammar is not None:
+                raise ValueError("grammar and json_schema cannot be used together")
+            grammar = json_schema_to_grammar(json_schema)
+        model = self.model.model
+        tokens = model.tokenize(prompt) if isinstance(prompt, str) else array('i', prompt)
+        if not tokens:
+            raise ValueError("Prompt tokenized to zero tokens.")
+        if len(tokens) > (limit := model.n_ctx - 4):
+            raise ValueError(f"Your message was too long and could not be processed ({len(tokens)} > {limit}).")
+        context = LLModelPromptContext(
+            n_predict      = max_tokens,
+            top_k          = top_k,
+            top_p          = top_p,
+            min_p          = min_p,
+            temp           = temp,
+            repeat_penalty = repeat_penalty,
+            repeat_last_n  = repeat_last_n,
+            grammar        = None if grammar is None else grammar.encode(),
+        )
+
+        future: Future[str] = Future()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("cannot submit a request to a closed scheduler")
+            request = _Request(future, tokens, context, deadline, next(self._seq))
+            request.emit = _ResponseEmitter(model, LLModel._callback_decoder(callback, request.pieces), max_tokens)
+            self._queued.append(request)
+            self._cond.notify_all()
+        return future
+
+    def generate(self, prompt: str | Sequence[int], **kwargs: Any) -> str:
+        """Submit a request with `submit`, and wait for its completion."""
+        return self.submit(prompt, **kwargs).result()
+
+    async def agenerate(self, prompt: str | Sequence[int], **kwargs: Any) -> str:
+        """Submit a request with `submit`, and wait for its completion without blocking the event loop."""
+        import asyncio
+
+        return await asyncio.wrap_future(self.submit(prompt, **kwargs))
+
+    @property
+    def stats(self) -> SchedulerStats:
+        """The current depth of the queue and the number of active requests, and counts since the scheduler started."""
+        with self._cond:
+            now = time.monotonic()
+            return SchedulerStats(
+                n_queued           = len(self._queued),
+                n_active           = len(self._active),
+                oldest_queued_wait = max((now - r.submit_time for r in self._queued), default=0.0),
+                n_completed        = self._n_completed,
+                n_expired          = self._n_expired,
+                n_failed           = self._n_failed,
+                n_preemptions      = self._n_preemptions,
+                n_prompt_tokens    = self._n_prompt_tokens,
+                n_generated_tokens = self._n_generated_tokens,
+            )
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    self._expire(now)
+                    self._admit()
+                    if self._active:
+                        break
+                    if self._closing and not self._queued:
+                        return
+                    deadlines = [r.deadline for r in self._queued if r.deadline is not None]
+                    self._cond.wait(min(deadlines) - now if deadlines else None)
+                request = min(self._active, key=_Request.priority)
+                if self._last_run is not None and self._last_run is not request and self._last_run in self._active:
+                    self._n_preemptions += 1
+                self._last_run = request
+                request.last_turn = next(self._turns)
+            try:
+                done = self._take_turn(request)
+            except BaseException as e:
+                self._finish(request, e)
+                if not isinstance(e, Exception):
+                    raise
+            else:
+                if done:
+                    self._finish(request)
+
+    def _expire(self, now: float) -> None:
+        # Fail the requests whose deadline has passed while they waited to be admitted or for their turn
+        for request in [r for r in self._queued if r.deadline is not None and r.deadline <= now]:
+            self._queued.remove(request)
+            if request.future.set_running_or_notify_cancel():
+                self._n_expired += 1
+                request.future.set_exception(DeadlineExceededError("The request expired while queued", ""))
+        for request in [r for r in self._active if r.deadline is not None and r.deadline <= now]:
+            self._finish(request, DeadlineExceededError(
+                "The request did not finish before its deadline", "".join(request.pieces),
+            ))
+
+    def _admit(self) -> None:
+        # Give queued requests a session, as long as there is one free or room for another
+        while self._queued and len(self._active) < self.max_active:
+            request = min(self._queued, key=_Request.queue_priority)
+            self._queued.remove(request)
+            if not request.future.set_running_or_notify_cancel():
+                continue  # cancelled while queued
+
+            free = [s for s in self._sessions if not s.busy]
+            best = max(free, key=lambda s: _common_prefix_length(s.tokens, request.tokens), default=None)
+            if best is None:
+                best = _Session(self.model.model.new_session())
+                self._sessions.append(best)
+            best.busy = True
+            request.session = best
+            # the last token in the mirror was only sampled, not evaluated
+            request.n_evaluated = max(0, min(_common_prefix_length(best.tokens, request.tokens), len(best.tokens) - 1))
+            self._active.append(request)
+
+    def _take_turn(self, request: _Request) -> bool:
+        # Process a chunk of the prompt or generate up to slice_tokens tokens. Returns whether the request is done.
+        assert request.session is not None and request.emit is not None
+        session = request.session.model
+        with session.hold_context() as switched:
+            n_uncached = request.n_prompt - request.n_evaluated
+            if n_uncached > self.prefill_chunk:
+                # the token sampled after the chunk is discarded
+                end = request.n_evaluated + self.prefill_chunk
+                session.decode_sample(request.tokens[:end], 1)
+                self._sampler_owner = None
+                request.n_evaluated = end
+                self._count(n_prompt_tokens=self.prefill_chunk)
+                return False
+
+            # another request or another user of the model may have changed the sampler
+            if switched or self._sampler_owner is not request:
+                session.init_sampler(request.context)
+                session.accept_sampled(request.tokens[request.n_prompt:])
+                self._sampler_owner = request
+
+            n_ctx = session.n_ctx
+            for _ in range(self.slice_tokens):
+                if len(request.tokens) >= n_ctx:
+                    return True  # the context is full
+                (token,), end = session.decode_sample(request.tokens, 1)
+                if request.n_evaluated < request.n_prompt:
+                    # the rest of the prompt was evaluated along with the first sample
+                    self._count(n_prompt_tokens=request.n_prompt - request.n_evaluated)
+                    request.n_evaluated = request.n_prompt
+                request.tokens.append(token)
+                self._count(n_generated_tokens=1)
+                if not request.emit(token, end):
+                    return True
+                if request.deadline is not None and time.monotonic() > request.deadline:
+                    raise DeadlineExceededError(
+                        "The request did not finish before its deadline", "".join(request.pieces),
+                    )
+                if self._has_earlier_deadline(request):
+                    break
+        return False
+
+    def _has_earlier_deadline(self, request: _Request) -> bool:
+        # Whether a request that would take its turn before this one is waiting, either active or queued with room to
+        # be admitted
+        deadline = float('inf') if request.deadline is None else request.deadline
+        with self._cond:
+            waiting = self._active if len(self._active) >= self.max_active else self._active + self._queued
+            return any(r.deadline is not None and r.deadline < deadline for r in waiting if r is not request)
+
+    def _count(self, n_prompt_tokens: int = 0, n_generated_tokens: int = 0) -> None:
+        with self._cond:
+            self._n_prompt_tokens += n_prompt_tokens
+            self._n_generated_tokens += n_generated_tokens
+
+    def _finish(self, request: _Request, error: BaseException | None = None) -> None:
+        with self._cond:
+            self._active.remove(request)
+            if self._sampler_owner is request:
+                self._sampler_owner = None
+            session = request.session
+            assert session is not None
+            # a request that stopped partway through its prompt only left the part that was evaluated in the context
+            if request.n_evaluated < request.n_prompt:
+                session.tokens = request.tokens[:request.n_evaluated]
+            else:
+                session.tokens = request.tokens
+            session.busy = False
+            if error is None:
+                self._n_completed += 1
+            elif isinstance(error, DeadlineExceededError):
+                self._n_expired += 1
+            else:
+                self._n_failed += 1
+            self._cond.notify_all()
+        if error is None:
+            request.future.set_result("".join(request.pieces))
+        else:
+            request.future.set_exception(error)
@@ -0,0 +1,183 @@
+"""
+Speculative decoding: a small draft model proposes tokens, and the target model checks them all in one batch.
+"""
+from __future__ import annotations
+
+from array import array
+from typing import TYPE_CHECKING, NamedTuple, Sequence
+
+if TYPE_CHECKING:
+    from ._pyllmodel import LLModel, LLModelPromptContext, PromptCallbackType, RawResponseCallbackType
+
+# must match LLModel::generateResponse in the backend
+STOP_SEQUENCES = tuple(s.encode() for s in (
+    "### System", "### Instruction", "### Human", "### User", "### Response", "### Assistant", "### Context",
+    "<|im_start|>", "<|im_end|>", "<|endoftext|>",
+))
+
+
+class SpeculativeStats(NamedTuple):
+    """Statistics about a generation with a draft model."""
+
+    n_drafted: int
+    """The number of tokens proposed by the draft model."""
+    n_accepted: int
+    """The number of proposed tokens that the target model would have generated as well."""
+    n_target_passes: int
+    """The number of times the target model evaluated a batch of tokens, including the prompt."""
+
+    @property
+    def acceptance_rate(self) -> float:
+        """The fraction of proposed tokens that were accepted."""
+        return self.n_accepted / self.n_drafted if self.n_drafted else 0.0
+
+
+def generate(
+    target: LLModel,
+    draft: LLModel,
+    prompt: str | array[int] | Sequence[int],
+    callback: RawResponseCallbackType,
+    context: LLModelPromptContext,
+    draft_context: LLModelPromptContext,
+    n_draft: int,
+    prompt_callback: PromptCallbackType | None = None,
+) -> SpeculativeStats:
+    """
+    Generate a response with the target model, using a draft model that shares its vocabulary to propose up to n_draft
+    tokens at a time.
+
+    Each token is sampled from the target model given the tokens before it, so the response is the same as without a
+    draft model when sampling greedily, up to floating-point differences between evaluating tokens in a batch and one
+    at a time. Unlike `LLModel.prompt_model`, generation stops when the context window is full, and prompt_callback is
+    called once for the whole prompt. The vocabularies are only compared if the prompt is given as text.
+    """
+    if isinstance(prompt, str):
+        tokens = target.tokenize(prompt)
+        if draft.tokenize(prompt) != tokens:
+            raise ValueError("The draft model must use the same vocabulary as the target model.")
+    else:
+        tokens = array('i', prompt)
+    if not tokens:
+        raise ValueError("Prompt tokenized to zero tokens.")
+    if len(tokens) >= target.n_ctx:
+        raise ValueError(f"The prompt is too long for speculative decoding ({len(tokens)} >= {target.n_ctx} tokens).")
+
+    if prompt_callback is not None and not prompt_callback(len(tokens), False):
+        return SpeculativeStats(0, 0, 0)
+
+    target.init_sampler(context)
+    draft.init_sampler(draft_context)
+    emit = _ResponseEmitter(target, callback, context.n_predict)
+    n_drafted = n_accepted = 0
+
+    sampled, end = target.decode_sample(tokens, 1)
+    n_target_passes = 1
+    while True:
+        tokens.extend(sampled)
+        for i, tok in enumerate(sampled):
+            if not emit(tok, end and i == len(sampled) - 1):
+                return SpeculativeStats(n_drafted, n_accepted, n_target_passes)
+
+        if len(tokens) > target.n_ctx:
+            return SpeculativeStats(n_drafted, n_accepted, n_target_passes)  # the context is full
+
+        # Propose tokens with the draft model, leaving room in the context for the target model to sample one more,
+        # and proposing no more than the response may still need
+        k = min(n_draft, emit.n_remaining - 1, target.n_ctx - len(tokens), max(0, draft.n_ctx - len(tokens) + 1))
+        proposed = array('i')
+        for _ in range(k):
+            (tok,), draft_end = draft.decode_sample(tokens + proposed, 1)
+            proposed.append(tok)
+            if draft_end:
+                break
+
+        # The target model evaluates the proposed tokens in one batch, and samples after each until it disagrees
+        sampled, end = target.decode_sample(tokens + proposed, len(proposed) + 1)
+        n_target_passes += 1
+        n_drafted += len(proposed)
+        n_accepted += _common_prefix_length(sampled, proposed)
+
+
+def _common_prefix_length(a: array[int], b: array[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class _ResponseEmitter:
+    # Sends sampled tokens to the response callback, withholding those that may be part of a stop sequence, the same
+    # way as LLModel::generateResponse does.
+
+    def __init__(self, model: LLModel, callback: RawResponseCallbackType, n_predict: int):
+        self.model = model
+        self.callback = callback
+        self.n_remaining = n_predict
+        self._pieces: dict[int, bytes] = {}
+        self._special: dict[int, bool] = {}
+        self._cached_tokens: list[int] = []
+        self._cached_response = b""
+
+    def _piece(self, token: int) -> bytes:
+        if (piece := self._pieces.get(token)) is None:
+            piece = self._pieces[token] = self.model.detokenize_bytes([token])
+        return piece
+
+    def _is_special(self, token: int) -> bool:
+        if (special := self._special.get(token)) is None:
+            special = self._special[token] = self.model.is_special_token(token)
+        return special
+
+    def __call__(self, token: int, is_end: bool) -> bool:
+        # Returns whether to continue generating
+        piece = self._piece(token)
+        self._cached_tokens.append(token)
+        self._cached_response += piece
+        cached = self._cached_response
+
+        stop = False
+        limit: int | None = None
+        if is_end:
+            stop = True
+            limit = len(cached) - len(piece)
+        elif self._is_special(token):
+            # Special tokens must exactly match a stop sequence, and are not checked together with the text before them
+            if piece in STOP_SEQUENCES:
+                stop = True
+                limit = len(cached) - len(piece)
+        else:
+            # Check if the response contains a stop sequence
+            for seq in STOP_SEQUENCES:
+                if (match := cached.find(seq)) != -1:
+                    stop = True
+                    limit = match if limit is None else min(limit, match)
+            # Check if the response ends with the start of a stop sequence
+            if limit is None:
+                for seq in STOP_SEQUENCES:
+                    if (match := _overlap(cached, seq)) is not None:
+                        limit = match if limit is None else min(limit, match)
+
+        # Send the cached tokens, up to the length limit
+        length = 0
+        while self._cached_tokens:
+            tok = self._cached_tokens[0]
+            piece = self._piece(tok)
+            if limit is not None and length + (1 if stop else len(piece)) > limit:
+                break
+            del self._cached_tokens[0]
+            self._cached_response = self._cached_response[len(piece):]
+            self.n_remaining -= 1
+            if not self.callback(tok, piece) or self.n_remaining <= 0:
+                return False
+            length += len(piece)
+        return not stop
+
+
+def _overlap(s: bytes, key: bytes) -> int | None:
+    # If some prefix of key is at the end of s, return the position in s where it starts
+    for start in range(max(0, len(s) - len(key)), len(s)):
+        if key.startswith(s[start:]):
+            return start
+    return None
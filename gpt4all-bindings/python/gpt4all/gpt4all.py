@@ -3,43 +3,69 @@ Python only API for running all GPT4All models.
 """
 from __future__ import annotations
 
+import copy
+import functools
 import hashlib
+import itertools
 import json
 import os
 import platform
 import re
+import struct
 import sys
+import time
 import warnings
+from array import array
 from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 from types import TracebackType
-from typing import TYPE_CHECKING, Any, Iterable, Iterator, Literal, NamedTuple, NoReturn, Protocol, TypedDict, overload
-
-import jinja2
-import requests
-from jinja2.sandbox import ImmutableSandboxedEnvironment
-from requests.exceptions import ChunkedEncodingError
-from tqdm import tqdm
-from urllib3.exceptions import IncompleteRead, ProtocolError
+from typing import (TYPE_CHECKING, Any, AsyncIterator, Callable, Iterable, Iterator, Literal, NamedTuple, NoReturn,
+                    Sequence, TypedDict, overload)
 
 from ._pyllmodel import (CancellationError as CancellationError, EmbCancelCallbackType, EmbedResult as EmbedResult,
-                         LLModel, ResponseCallbackType, _operator_call, empty_response_callback)
+                         LLModel, LLModelPromptContext, LLModelState as LLModelState, ResponseCallbackType,
+                         empty_response_callback)
+from ._catalog import fetch_models, read_cached_models
+from ._embed_cache import EmbeddingCache as EmbeddingCache
+from ._grammar import (SchemaValidationError as SchemaValidationError, json_schema_to_grammar as json_schema_to_grammar,
+                       validate_json as validate_json)
+from ._history import (HistoryPolicy as HistoryPolicy, KeepLastTurns as KeepLastTurns, SlidingWindow as SlidingWindow,
+                       SummarizeOlderTurns as SummarizeOlderTurns)
+from ._logprobs import TokenLogprobs as TokenLogprobs
+from ._prefix_cache import PrefixCache as PrefixCache
+from ._registry import ModelRegistry as ModelRegistry
+from ._scheduler import (DeadlineExceededError as DeadlineExceededError, Scheduler as Scheduler,
+                         SchedulerStats as SchedulerStats)
+from ._speculative import SpeculativeStats as SpeculativeStats, _common_prefix_length
+
+# jinja2, requests, tqdm, and the native library are only loaded when they are first needed, to keep imports fast
 
 if TYPE_CHECKING:
-    from typing_extensions import Self, TypeAlias
+    import asyncio
 
-if sys.platform == "darwin":
-    import fcntl
+    import jinja2
+    import numpy as np
+    from jinja2.sandbox import ImmutableSandboxedEnvironment
+    from numpy.typing import NDArray
+    from typing_extensions import Self, TypeAlias
 
 # TODO: move to config
 DEFAULT_MODEL_DIRECTORY = Path.home() / ".cache" / "gpt4all"
+MODEL_LIST_URL = "https://gpt4all.io/models/models3.json"
+MODEL_LIST_MAX_AGE = 24 * 60 * 60  # seconds
+# added to the token count of a message the chat template cannot render by itself
+MESSAGE_TOKEN_OVERHEAD = 8
 
 ConfigType: TypeAlias = "dict[str, Any]"
+BatchResponseCallbackType = Callable[[int, int, str], bool]
 
 # Environment setup adapted from HF transformers
-@_operator_call
+@functools.lru_cache(maxsize=None)
 def _jinja_env() -> ImmutableSandboxedEnvironment:
+    import jinja2
+    from jinja2.sandbox import ImmutableSandboxedEnvironment
+
     def raise_exception(message: str) -> NoReturn:
         raise jinja2.exceptions.TemplateError(message)
 
@@ -61,9 +87,207 @@ class MessageType(TypedDict):
     content: str
 
 
+class _ChatRenderer:
+    """
+    Renders the prompt for each turn of a chat session.
+
+    Only the messages added since the previous turn are rendered and appended to the text rendered before, as long as
+    that gives the same result as rendering the whole history. This is checked on the first N_CHECKS turns, and if the
+    template turns out not to be append-only, the whole history is rendered on every turn instead.
+
+    Checking a turn costs as much as rendering the whole history, so later turns are not checked. A template that only
+    renders earlier messages differently once the history is longer than that, e.g. one that drops all but the last
+    few assistant messages, is not detected, and its prompts keep the earlier renderings of those messages.
+    """
+
+    N_CHECKS = 2
+
+    def __init__(self, template: jinja2.Template, special_tokens: dict[str, str]):
+        self.template = template
+        self.special_tokens = special_tokens
+        self.incremental = True
+        self._checks_left = self.N_CHECKS
+        try:
+            # the text a template renders before any message, e.g. a BOS token
+            self._prologue = self.render([], add_generation_prompt=False)
+        except Exception:
+            self.incremental = False
+            self._prologue = ""
+        self._reset()
+
+    def _reset(self) -> None:
+        self._rendered_messages: list[MessageType] = []  # copies of the messages rendered so far
+        self._rendered = self._prologue  # the rendering of those messages, without a generation prompt
+
+    def render(self, messages: list[MessageType], add_generation_prompt: bool = True) -> str:
+        return self.template.render(
+            messages=messages, add_generation_prompt=add_generation_prompt, **self.special_tokens,
+        )
+
+    def render_message(self, message: MessageType) -> str:
+        """Render a single message, without the text the template renders before any message."""
+        return self._render_suffix([message], add_generation_prompt=False)
+
+    def _render_suffix(self, messages: list[MessageType], add_generation_prompt: bool) -> str:
+        text = self.render(messages, add_generation_prompt=add_generation_prompt)
+        if not text.startswith(self._prologue):
+            raise ValueError("template is not append-only")
+        return text[len(self._prologue):]
+
+    def render_prompt(self, history: list[MessageType]) -> tuple[str, str]:
+        """
+        Render the prompt for a history that ends with a new user message.
+
+        Returns:
+            The prompt, and the rendering of the new message by itself.
+        """
+        if self.incremental:
+            try:
+                return self._render_prompt_incremental(history)
+            except Exception:
+                self.incremental = False  # fall back to rendering the whole history
+        return self.render(history), self.render(history[-1:])
+
+    def _render_prompt_incremental(self, history: list[MessageType]) -> tuple[str, str]:
+        n_rendered = len(self._rendered_messages)
+        if history[:n_rendered] != self._rendered_messages:
+            self._reset()  # the history was edited
+            n_rendered = 0
+
+        # Render the messages since the previous turn, which start with the previous user message, so that templates
+        # that check the order of roles accept them.
+        new_user = len(history) - 1
+        rendered = self._rendered
+        if n_rendered < new_user:
+            rendered += self._render_suffix(history[n_rendered:new_user], add_generation_prompt=False)
+        last_msg_rendered = self._render_suffix(history[new_user:], add_generation_prompt=True)
+        prompt = rendered + last_msg_rendered
+
+        if self._checks_left:
+            if prompt != self.render(history):
+                raise ValueError("template is not append-only")
+            self._checks_left -= 1
+
+        self._rendered_messages.extend(msg.copy() for msg in history[n_rendered:new_user])
+        self._rendered = rendered
+        return prompt, last_msg_rendered
+
+
 class ChatSession(NamedTuple):
     template: jinja2.Template
     history: list[MessageType]
+    renderer: _ChatRenderer | None = None  # created on the first prompt if None
+    history_policy: HistoryPolicy | None = None
+    token_counts: dict[tuple[str, str], int] | None = None  # by role and content, created on the first prompt if None
+
+
+class GPT4AllState(NamedTuple):
+    """A snapshot of a GPT4All instance, as returned by `GPT4All.save_state`."""
+
+    model_state: LLModelState
+    """The saved state of the underlying model."""
+    history: list[MessageType] | None
+    """A copy of the chat session history, or None if there was no active chat session."""
+
+
+class BatchResult(TypedDict):
+    outputs: list[str]
+    """The completion of each prompt, in the same order as the prompts."""
+    n_prompt_tokens: int
+    """The number of prompt tokens that were processed, excluding those reused from the model's context."""
+    n_generated_tokens: int
+    """The total number of tokens generated."""
+    n_output_tokens: list[int]
+    """The number of tokens generated for each prompt, in the same order as the prompts."""
+    elapsed: float
+    """The wall-clock time taken by the whole batch, in seconds."""
+    tokens_per_second: float
+    """The number of generated tokens per second across the whole batch."""
+
+
+class Completion(TypedDict):
+    text: str
+    """The generated text."""
+    n_tokens: int
+    """The number of tokens generated."""
+    logprob: float
+    """The sum of the log-probabilities of the generated tokens under the model, before the sampling parameters are
+    applied, including the end-of-text token if the model ended the completion. Higher values mean the model finds the
+    completion more likely."""
+
+
+class GenerationStats(TypedDict):
+    n_prompt_tokens: int
+    """The number of prompt tokens, including those reused from the model's context."""
+    n_cached_tokens: int
+    """The number of prompt tokens reused from the model's context instead of being processed."""
+    n_generated_tokens: int
+    """The number of tokens generated."""
+    time_to_first_token: float | None
+    """
+    The time from when the prompt is sent to the model to the first generated token, in seconds, or None if none was
+    generated. This excludes applying the chat template and loading a cached prefix, which `total_time` includes.
+    """
+    prompt_tokens_per_second: float
+    """The number of prompt tokens processed, excluding cached ones, per second until the first generated token."""
+    decode_tokens_per_second: float
+    """The number of tokens generated per second after the first one."""
+    total_time: float
+    """The wall-clock time taken by the whole call, in seconds."""
+
+
+MetricsHookType = Callable[[GenerationStats], None]
+
+
+class _StatsCollector:
+    # Measures a call to generate. start must be called when the prompt is sent to the model, and the prompt and token
+    # callbacks must be passed to the model.
+
+    def __init__(self) -> None:
+        self.start_time = time.perf_counter()
+        self.prompt_start_time: float | None = None
+        self.first_token_time: float | None = None
+        self.n_prompt_tokens = 0
+        self.n_cached_tokens = 0
+        self.n_generated_tokens = 0
+
+    @property
+    def started(self) -> bool:
+        return self.prompt_start_time is not None
+
+    def start(self) -> None:
+        self.prompt_start_time = time.perf_counter()
+
+    def prompt_callback(self, n_tokens: int, cached: bool) -> bool:
+        self.n_prompt_tokens += n_tokens
+        if cached:
+            self.n_cached_tokens += n_tokens
+        return True
+
+    def token_callback(self, token_id: int) -> None:
+        # response callbacks are called per decoded piece, which may span several tokens
+        if not self.n_generated_tokens:
+            self.first_token_time = time.perf_counter()
+        self.n_generated_tokens += 1
+
+    def finish(self) -> GenerationStats:
+        end_time = time.perf_counter()
+        ttft = prompt_tps = decode_tps = None
+        if self.first_token_time is not None:
+            ttft = self.first_token_time - (self.prompt_start_time or self.start_time)
+            if ttft > 0:
+                prompt_tps = (self.n_prompt_tokens - self.n_cached_tokens) / ttft
+            if (decode_time := end_time - self.first_token_time) > 0:
+                decode_tps = (self.n_generated_tokens - 1) / decode_time
+        return GenerationStats(
+            n_prompt_tokens          = self.n_prompt_tokens,
+            n_cached_tokens          = self.n_cached_tokens,
+            n_generated_tokens       = self.n_generated_tokens,
+            time_to_first_token      = ttft,
+            prompt_tokens_per_second = prompt_tps or 0.0,
+            decode_tokens_per_second = decode_tps or 0.0,
+            total_time               = end_time - self.start_time,
+        )
 
 
 class Embed4All:
@@ -73,18 +297,25 @@ class Embed4All:
 
     MIN_DIMENSIONALITY = 64
 
-    def __init__(self, model_name: str | None = None, *, n_threads: int | None = None, device: str | None = None, **kwargs: Any):
+    def __init__(
+        self, model_name: str | None = None, *, n_threads: int | None = None, device: str | None = None,
+        cache: EmbeddingCache | None = None, **kwargs: Any,
+    ):
         """
         Constructor
 
         Args:
             n_threads: number of CPU threads used by GPT4All. Default is None, then the number of threads are determined automatically.
             device: The processing unit on which the embedding model will run. See the `GPT4All` constructor for more info.
+            cache: A cache of embeddings. Texts found in it are not passed to the model, and the embeddings of the rest
+                are added to it. Default is None.
             kwargs: Remaining keyword arguments are passed to the `GPT4All` constructor.
         """
         if model_name is None:
             model_name = "all-MiniLM-L6-v2.gguf2.f16.gguf"
         self.gpt4all = GPT4All(model_name, n_threads=n_threads, device=device, **kwargs)
+        self.cache = cache
+        self._model_id: str | None = None  # identifies the model file in cache keys, computed on first use
 
     def __enter__(self) -> Self:
         return self
@@ -165,28 +396,368 @@ class Embed4All:
 
         Returns:
             With return_dict=False, an embedding or list of embeddings of your text(s).
+            With return_dict=True, a dict with keys 'embeddings' and 'n_prompt_tokens'. If a cache is in use, texts
+            found in it do not count towards 'n_prompt_tokens'.
+
+        Raises:
+            CancellationError: If cancel_cb returned True and embedding was canceled.
+        """
+        dimensionality, do_mean = self._check_embed_args(dimensionality, long_text_mode)
+        result = self._generate(text, prefix, dimensionality, do_mean, atlas, cancel_cb, as_array=False)
+        return result if return_dict else result["embeddings"]
+
+    @overload
+    def embed_array(
+        self, text: str | list[str], *, prefix: str | None = ..., dimensionality: int | None = ...,
+        long_text_mode: str = ..., return_dict: Literal[False] = ..., atlas: bool = ...,
+        cancel_cb: EmbCancelCallbackType | None = ...,
+    ) -> NDArray[np.float32]: ...
+    @overload
+    def embed_array(
+        self, text: str | list[str], *, prefix: str | None = ..., dimensionality: int | None = ...,
+        long_text_mode: str = ..., return_dict: Literal[True], atlas: bool = ...,
+        cancel_cb: EmbCancelCallbackType | None = ...,
+    ) -> EmbedResult[NDArray[np.float32]]: ...
+    @overload
+    def embed_array(
+        self, text: str | list[str], *, prefix: str | None = ..., dimensionality: int | None = ...,
+        long_text_mode: str = ..., return_dict: bool = ..., atlas: bool = ...,
+        cancel_cb: EmbCancelCallbackType | None = ...,
+    ) -> Any: ...
+
+    def embed_array(
+        self, text: str | list[str], *, prefix: str | None = None, dimensionality: int | None = None,
+        long_text_mode: str = "mean", return_dict: bool = False, atlas: bool = False,
+        cancel_cb: EmbCancelCallbackType | None = None,
+    ) -> Any:
+        """
+        Generate one or more embeddings as a NumPy array. Requires NumPy to be installed.
+
+        This avoids creating a Python float for each dimension of each embedding: the array is a view of the memory
+        the embeddings were written to by the model, which is freed when the array is no longer referenced.
+
+        Args:
+            text: A text or list of texts to generate embeddings for.
+
+            The remaining arguments have the same meaning as for `embed`.
+
+        Returns:
+            With return_dict=False, a float32 array of shape (dim,) for a single text, or (n_texts, dim) for a list of
+            texts.
             With return_dict=True, a dict with keys 'embeddings' and 'n_prompt_tokens'.
 
         Raises:
             CancellationError: If cancel_cb returned True and embedding was canceled.
         """
+        dimensionality, do_mean = self._check_embed_args(dimensionality, long_text_mode)
+        result = self._generate(text, prefix, dimensionality, do_mean, atlas, cancel_cb, as_array=True)
+        return result if return_dict else result["embeddings"]
+
+    def embed_iter(
+        self, texts: Iterable[str], *, batch_size: int = 64, prefix: str | None = None,
+        dimensionality: int | None = None, long_text_mode: str = "mean", atlas: bool = False,
+        cancel_cb: EmbCancelCallbackType | None = None, output_path: str | os.PathLike[str] | None = None,
+    ) -> Iterator[tuple[int, NDArray[np.float32]]]:
+        """
+        Generate embeddings for a large or unbounded number of texts. Requires NumPy to be installed.
+
+        Texts are pulled from the iterable only as they are needed, and embedded in batches, so memory use does not
+        grow with the number of texts.
+
+        Args:
+            texts: The texts to generate embeddings for.
+            batch_size: The number of texts to pass to the model at once.
+            output_path: If given, the embeddings are also written to a .npy file at this path as they are generated.
+                The file appears once the iterator is exhausted, and can then be opened without loading it into
+                memory with `numpy.load(output_path, mmap_mode='r')`. If an error occurs or the iterator is closed
+                before then, no file is written.
+
+            The remaining arguments have the same meaning as for `embed`.
+
+        Returns:
+            An iterator of (index, embeddings) pairs, where embeddings is a float32 array of shape (n, dim) holding the
+            embeddings of the n texts starting at index.
+
+        Raises:
+            CancellationError: If cancel_cb returned True and embedding was canceled.
+        """
+        if batch_size <= 0:
+            raise ValueError(f"Batch size must be a positive integer, got {batch_size}")
+        dimensionality, do_mean = self._check_embed_args(dimensionality, long_text_mode)
+
+        def generate() -> Iterator[tuple[int, NDArray[np.float32]]]:
+            writer = None if output_path is None else _NpyWriter(output_path)
+            texts_iter = iter(texts)
+            index = 0
+            try:
+                while batch := list(itertools.islice(texts_iter, batch_size)):
+                    result = self._generate(
+                        batch, prefix, dimensionality, do_mean, atlas, cancel_cb, as_array=True,
+                    )
+                    embeddings = result["embeddings"]
+                    if writer is not None:
+                        writer.write(embeddings)
+                    yield index, embeddings
+                    index += len(batch)
+                if writer is not None:
+                    writer.commit()
+            finally:
+                if writer is not None:
+                    writer.discard()
+
+        return generate()
+
+    @classmethod
+    def _check_embed_args(cls, dimensionality: int | None, long_text_mode: str) -> tuple[int, bool]:
         if dimensionality is None:
             dimensionality = -1
         else:
             if dimensionality <= 0:
                 raise ValueError(f"Dimensionality must be None or a positive integer, got {dimensionality}")
-            if dimensionality < self.MIN_DIMENSIONALITY:
+            if dimensionality < cls.MIN_DIMENSIONALITY:
                 warnings.warn(
-                    f"Dimensionality {dimensionality} is less than the suggested minimum of {self.MIN_DIMENSIONALITY}."
+                    f"Dimensionality {dimensionality} is less than the suggested minimum of {cls.MIN_DIMENSIONALITY}."
                     " Performance may be degraded."
                 )
         try:
             do_mean = {"mean": True, "truncate": False}[long_text_mode]
         except KeyError:
             raise ValueError(f"Long text mode must be one of 'mean' or 'truncate', got {long_text_mode!r}")
-        result = self.gpt4all.model.generate_embeddings(text, prefix, dimensionality, do_mean, atlas, cancel_cb)
+        return dimensionality, do_mean
+
+    def _generate(
+        self, text: str | list[str], prefix: str | None, dimensionality: int, do_mean: bool, atlas: bool,
+        cancel_cb: EmbCancelCallbackType | None, as_array: bool,
+    ) -> EmbedResult[Any]:
+        model = self.gpt4all.model
+        if self.cache is None:
+            generate = model.generate_embeddings_array if as_array else model.generate_embeddings
+            return generate(text, prefix, dimensionality, do_mean, atlas, cancel_cb)
+
+        if as_array:
+            import numpy as np
+
+        if not text:
+            raise ValueError("text must not be None or empty")
+        texts = [text] if isinstance(text, str) else text
+
+        if self._model_id is None:
+            self._model_id = EmbeddingCache.model_id(self.gpt4all.config["path"], self.gpt4all.config.get("md5sum"))
+        keys = [
+            EmbeddingCache.key(self._model_id, prefix, dimensionality, do_mean, atlas, t)
+            for t in texts
+        ]
+        found = self.cache.get(keys)
+
+        # only embed the texts that were not found, once each
+        missing = {k: t for k, t in zip(keys, texts) if k not in found}
+        n_prompt_tokens = 0
+        if missing:
+            vectors, n_prompt_tokens = model.generate_embeddings_bytes(
+                list(missing.values()), prefix, dimensionality, do_mean, atlas, cancel_cb,
+            )
+            new = dict(zip(missing, vectors))
+            self.cache.put(new)
+            found.update(new)
+
+        embeddings: Any
+        if as_array:
+            data = bytearray(b"".join(found[k] for k in keys))  # writable, like the uncached result
+            embeddings = np.frombuffer(data, dtype=np.float32).reshape(len(texts), -1)
+        else:
+            embeddings = [array("f", found[k]).tolist() for k in keys]
+        if isinstance(text, str):
+            embeddings = embeddings[0]
+        return {"embeddings": embeddings, "n_prompt_tokens": n_prompt_tokens}
+
+
+# the embedder of the current Embed4AllPool worker process
+_pool_embedder: Embed4All | None = None
+
+
+def _pool_worker_init(model_name: str, model_path: str, n_threads: int | None, kwargs: dict[str, Any]) -> None:
+    global _pool_embedder
+    _pool_embedder = Embed4All(model_name, model_path=model_path, allow_download=False, n_threads=n_threads, **kwargs)
+
+
+def _pool_worker_embed(
+    texts: list[str], prefix: str | None, dimensionality: int, do_mean: bool, atlas: bool,
+) -> tuple[bytes, int]:
+    assert _pool_embedder is not None
+    vectors, n_prompt_tokens = _pool_embedder.gpt4all.model.generate_embeddings_bytes(
+        texts, prefix, dimensionality, do_mean, atlas, None,
+    )
+    return b"".join(vectors), n_prompt_tokens
+
+
+class Embed4AllPool:
+    """
+    Generates embeddings with a copy of the model in each of several worker processes, to make use of more CPU cores
+    than a single model can.
+
+    Worker processes are started with the "spawn" method, so a script that creates a pool must guard its entry point
+    with `if __name__ == "__main__":`.
+    """
+
+    def __init__(
+        self, model_name: str | None = None, *, processes: int | None = None, threads_per_process: int = 4,
+        batch_size: int = 32, model_path: str | os.PathLike[str] | None = None, allow_download: bool = True,
+        verbose: bool = False, **kwargs: Any,
+    ):
+        """
+        Constructor
+
+        Args:
+            model_name: The name of the embedding model. See the `Embed4All` constructor for more info.
+            processes: The number of worker processes. Default is None, in which case one is started for every
+                `threads_per_process` CPU cores.
+            threads_per_process: The number of CPU threads used by each worker process.
+            batch_size: The number of texts sent to a worker process at once.
+            model_path: Path to directory containing the model file or, if the file does not exist, where to download
+                it. The model is downloaded once, before the workers are started.
+            allow_download: Allow API to download the model from gpt4all.io. Default is True.
+            verbose: If True, print debug messages.
+            kwargs: Remaining keyword arguments, such as `device`, are passed to the `Embed4All` constructor in each
+                worker process.
+        """
+        if threads_per_process <= 0:
+            raise ValueError(f"threads_per_process must be a positive integer, got {threads_per_process}")
+        if processes is None:
+            processes = max(1, (os.cpu_count() or 1) // threads_per_process)
+        elif processes <= 0:
+            raise ValueError(f"processes must be a positive integer, got {processes}")
+        if batch_size <= 0:
+            raise ValueError(f"Batch size must be a positive integer, got {batch_size}")
+
+        if model_name is None:
+            model_name = "all-MiniLM-L6-v2.gguf2.f16.gguf"
+        self.config: ConfigType = GPT4All.retrieve_model(
+            model_name, model_path=model_path, allow_download=allow_download, verbose=verbose,
+        )
+        self.processes = processes
+        self.batch_size = batch_size
+
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        model_file = Path(self.config["path"])
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_pool_worker_init,
+            initargs=(model_file.name, str(model_file.parent), threads_per_process, kwargs),
+        )
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self, typ: type[BaseException] | None, value: BaseException | None, tb: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stop the worker processes and free associated system resources."""
+        self._executor.shutdown()
+
+    @overload
+    def embed(
+        self, texts: list[str], *, prefix: str | None = ..., dimensionality: int | None = ...,
+        long_text_mode: str = ..., return_dict: Literal[False] = ..., atlas: bool = ...,
+    ) -> list[list[float]]: ...
+    @overload
+    def embed(
+        self, texts: list[str], *, prefix: str | None = ..., dimensionality: int | None = ...,
+        long_text_mode: str = ..., return_dict: Literal[True], atlas: bool = ...,
+    ) -> EmbedResult[list[list[float]]]: ...
+    @overload
+    def embed(
+        self, texts: list[str], *, prefix: str | None = ..., dimensionality: int | None = ...,
+        long_text_mode: str = ..., return_dict: bool = ..., atlas: bool = ...,
+    ) -> Any: ...
+
+    def embed(
+        self, texts: list[str], *, prefix: str | None = None, dimensionality: int | None = None,
+        long_text_mode: str = "mean", return_dict: bool = False, atlas: bool = False,
+    ) -> Any:
+        """
+        Generate embeddings for a list of texts, split into batches across the worker processes.
+
+        The arguments have the same meaning as for `Embed4All.embed`.
+
+        Returns:
+            With return_dict=False, a list of embeddings, in the same order as the texts.
+            With return_dict=True, a dict with keys 'embeddings' and 'n_prompt_tokens'.
+        """
+        data, n_prompt_tokens = self._embed(texts, prefix, dimensionality, long_text_mode, atlas)
+        embeddings = array("f", data).tolist()
+        n_embd = len(embeddings) // len(texts)
+        result: EmbedResult[list[list[float]]] = {
+            "embeddings": [embeddings[i:i + n_embd] for i in range(0, len(embeddings), n_embd)],
+            "n_prompt_tokens": n_prompt_tokens,
+        }
         return result if return_dict else result["embeddings"]
 
+    @overload
+    def embed_array(
+        self, texts: list[str], *, prefix: str | None = ..., dimensionality: int | None = ...,
+        long_text_mode: str = ..., return_dict: Literal[False] = ..., atlas: bool = ...,
+    ) -> NDArray[np.float32]: ...
+    @overload
+    def embed_array(
+        self, texts: list[str], *, prefix: str | None = ..., dimensionality: int | None = ...,
+        long_text_mode: str = ..., return_dict: Literal[True], atlas: bool = ...,
+    ) -> EmbedResult[NDArray[np.float32]]: ...
+    @overload
+    def embed_array(
+        self, texts: list[str], *, prefix: str | None = ..., dimensionality: int | None = ...,
+        long_text_mode: str = ..., return_dict: bool = ..., atlas: bool = ...,
+    ) -> Any: ...
+
+    def embed_array(
+        self, texts: list[str], *, prefix: str | None = None, dimensionality: int | None = None,
+        long_text_mode: str = "mean", return_dict: bool = False, atlas: bool = False,
+    ) -> Any:
+        """
+        Like `embed`, but the embeddings are returned as a float32 NumPy array of shape (n_texts, dim). Requires
+        NumPy to be installed.
+        """
+        import numpy as np
+
+        data, n_prompt_tokens = self._embed(texts, prefix, dimensionality, long_text_mode, atlas)
+        result: EmbedResult[NDArray[np.float32]] = {
+            "embeddings": np.frombuffer(data, dtype=np.float32).reshape(len(texts), -1),
+            "n_prompt_tokens": n_prompt_tokens,
+        }
+        return result if return_dict else result["embeddings"]
+
+    def _embed(
+        self, texts: list[str], prefix: str | None, dimensionality: int | None, long_text_mode: str, atlas: bool,
+    ) -> tuple[bytearray, int]:
+        # Returns the embeddings as float32 bytes, in order, and the total number of prompt tokens.
+        if not texts or isinstance(texts, str):
+            raise ValueError("texts must be a non-empty list of strings")
+        dimensionality, do_mean = Embed4All._check_embed_args(dimensionality, long_text_mode)
+
+        # each batch is returned as a single bytes object, which is much cheaper to pass between processes than
+        # lists of floats
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        futures = [
+            self._executor.submit(_pool_worker_embed, batch, prefix, dimensionality, do_mean, atlas)
+            for batch in batches
+        ]
+        data = bytearray()
+        n_prompt_tokens = 0
+        try:
+            for future in futures:
+                batch_data, batch_tokens = future.result()
+                data += batch_data
+                n_prompt_tokens += batch_tokens
+        finally:
+            for future in futures:
+                future.cancel()
+        return data, n_prompt_tokens
+
 
 class GPT4All:
     """
@@ -205,6 +776,9 @@ class GPT4All:
         n_ctx: int = 2048,
         ngl: int = 100,
         verbose: bool = False,
+        prefix_cache: PrefixCache | None = None,
+        registry: ModelRegistry | None = None,
+        metrics_hook: MetricsHookType | None = None,
     ):
         """
         Constructor
@@ -230,10 +804,25 @@ class GPT4All:
             n_ctx: Maximum size of context window
             ngl: Number of GPU layers to use (Vulkan)
             verbose: If True, print debug messages.
+            prefix_cache: A cache of model states used to skip processing the beginning of a chat session's prompt
+                when it matches one seen before, e.g. the same system message. Default is None.
+            registry: A registry of loaded models. If given, instances with the same model file, device, `n_ctx`, and
+                `ngl` share one copy of the model's weights, each with its own context state. Note that `n_threads` is
+                then a setting of the shared model. Default is None, in which case the model is loaded for this
+                instance only.
+            metrics_hook: A function called with the `GenerationStats` of each call to `generate` and `agenerate`, and
+                of each prompt of `generate_batch`, e.g. to update Prometheus counters. A streaming call that is closed
+                early is reported when it is closed. Default is None.
         """
 
         self.model_type = model_type
+        self.prefix_cache = prefix_cache
+        self.registry = registry
+        self.metrics_hook = metrics_hook
         self._chat_session: ChatSession | None = None
+        self._prefix_cache_checked = False
+        self._loaded_prefix_key: str | None = None  # the cached prefix the model's context currently starts with
+        self._agenerate_lock: asyncio.Lock | None = None  # created on first use, in the event loop that uses it
 
         device_init = None
         if sys.platform == "darwin":
@@ -260,10 +849,13 @@ class GPT4All:
 
         # Retrieve model and download if allowed
         self.config: ConfigType = self.retrieve_model(model_name, model_path=model_path, allow_download=allow_download, verbose=verbose)
-        self.model = LLModel(self.config["path"], n_ctx, ngl, backend)
-        if device_init is not None:
-            self.model.init_gpu(device_init)
-        self.model.load_model()
+        if registry is not None:
+            self.model = registry.acquire(self.config["path"], backend, n_ctx, ngl, device_init)
+        else:
+            self.model = LLModel(self.config["path"], n_ctx, ngl, backend)
+            if device_init is not None:
+                self.model.init_gpu(device_init)
+            self.model.load_model()
         # Set n_threads
         if n_threads is not None:
             self.model.set_thread_count(n_threads)
@@ -278,7 +870,10 @@ class GPT4All:
 
     def close(self) -> None:
         """Delete the model instance and free associated system resources."""
-        self.model.close()
+        if self.registry is not None:
+            self.registry.release(self.model)
+        else:
+            self.model.close()
 
     @property
     def backend(self) -> Literal["cpu", "kompute", "cuda", "metal"]:
@@ -290,6 +885,11 @@ class GPT4All:
         """The name of the GPU device currently in use, or None for backends other than Kompute or CUDA."""
         return self.model.device
 
+    @property
+    def speculative_stats(self) -> SpeculativeStats | None:
+        """Statistics about the last generation with a draft model, such as the fraction of proposed tokens accepted."""
+        return self.model.speculative_stats
+
     @property
     def current_chat_session(self) -> list[MessageType] | None:
         return None if self._chat_session is None else self._chat_session.history
@@ -300,18 +900,101 @@ class GPT4All:
             raise ValueError("current_chat_session may only be set when there is an active chat session")
         self._chat_session.history[:] = history
 
+    def save_state(self) -> GPT4AllState:
+        """
+        Take a snapshot of the model state and the active chat session, if any.
+
+        Restoring the snapshot later with `restore_state` avoids processing the same prompt again, e.g. a long system
+        message shared by many requests.
+
+        Returns:
+            The saved state.
+        """
+        history = None
+        if self._chat_session is not None:
+            history = [msg.copy() for msg in self._chat_session.history]
+        return GPT4AllState(model_state=self.model.save_state(), history=history)
+
+    def restore_state(self, state: GPT4AllState) -> None:
+        """
+        Restore a snapshot taken by `save_state`.
+
+        Args:
+            state: The state to restore. If it includes a chat session history, there must be an active chat session,
+                and its history will be replaced.
+        """
+        if state.history is not None and self._chat_session is None:
+            raise ValueError("A state with chat history may only be restored when there is an active chat session")
+        self.model.restore_state(state.model_state)
+        self._loaded_prefix_key = None
+        if state.history is not None:
+            assert self._chat_session is not None
+            self._chat_session.history[:] = [msg.copy() for msg in state.history]
+
+    def tokenize(self, text: str) -> array[int]:
+        """
+        Tokenize text the same way as a prompt passed to `generate`, after any chat template is applied.
+
+        Returns:
+            The token ids, as int32. Special tokens written in the text are tokenized as such, and the BOS token is
+            included if the model uses one.
+        """
+        return self.model.tokenize(text)
+
+    def detokenize(self, tokens: Iterable[int]) -> str:
+        """Convert token ids to text, including the text of special tokens."""
+        return self.model.detokenize(tokens if isinstance(tokens, array) else list(tokens))
+
+    def count_prompt_tokens(self, prompt: str) -> int:
+        """
+        Count the tokens of a prompt, as it would be tokenized by `generate` after any chat template is applied.
+
+        Counts are cached by a hash of the prompt, so counting the same prompt again does not tokenize it again.
+        """
+        return self.model.count_prompt_tokens(prompt)
+
+    def count_prompt_tokens_batch(self, prompts: Iterable[str]) -> list[int]:
+        """Count the tokens of each of several prompts, in a single call into the model. See `count_prompt_tokens`."""
+        return self.model.count_prompt_tokens_batch(prompts)
+
+    def score(self, text: str, *, prompt: str | None = None, top_n: int = 0) -> TokenLogprobs:
+        """
+        Compute the log-probability the model gives each token of a text, e.g. to measure its perplexity.
+
+        Args:
+            text: The text to score. Without a prompt, every token but the first is scored, which is the BOS token if
+                the model uses one.
+            prompt: Text that comes before text and is not scored. Chat templates are not applied.
+            top_n: The number of most likely tokens to record at each position.
+
+        Returns:
+            The log-probability of each scored token. See `TokenLogprobs.perplexity`.
+        """
+        if prompt is None:
+            tokens = self.model.tokenize(text)
+            n_prompt = 1
+        else:
+            tokens = self.model.tokenize(prompt + text)
+            n_prompt = _common_prefix_length(self.model.tokenize(prompt), tokens)
+        self._loaded_prefix_key = None  # the text replaces any cached prefix in the context
+        return self.model.score_tokens(tokens, n_prompt, top_n)
+
     @staticmethod
-    def list_models() -> list[ConfigType]:
+    def list_models(max_age: float = MODEL_LIST_MAX_AGE) -> list[ConfigType]:
         """
         Fetch model list from https://gpt4all.io/models/models3.json.
 
+        The list is cached in the default model directory. A cached copy is used without a request if it is younger
+        than max_age seconds; otherwise it is revalidated with a conditional request, and used as a fallback if the
+        request fails.
+
+        Args:
+            max_age: The maximum age of the cached list, in seconds. Pass 0 to always revalidate. Default is one day.
+
         Returns:
             Model list in JSON format.
         """
-        resp = requests.get("https://gpt4all.io/models/models3.json")
-        if resp.status_code != 200:
-            raise ValueError(f"Request failed: HTTP {resp.status_code} {resp.reason}")
-        return resp.json()
+        return fetch_models(_model_list_cache_path(), MODEL_LIST_URL, max_age)
 
     @classmethod
     def retrieve_model(
@@ -337,13 +1020,6 @@ class GPT4All:
 
         model_filename = append_extension_if_missing(model_name)
 
-        # get the config for the model
-        config: ConfigType = {}
-        if allow_download:
-            models = cls.list_models()
-            if (model := next((m for m in models if m["filename"] == model_filename), None)) is not None:
-                config.update(model)
-
         # Validate download directory
         if model_path is None:
             try:
@@ -358,6 +1034,22 @@ class GPT4All:
             raise FileNotFoundError(f"Model directory does not exist: {model_path!r}")
 
         model_dest = model_path / model_filename
+
+        # get the config for the model
+        config: ConfigType = {}
+        if allow_download:
+            if not model_dest.exists():
+                models = cls.list_models()
+            # the model is already downloaded, so avoid the network if the model list has ever been cached
+            elif (models := read_cached_models(_model_list_cache_path(), MODEL_LIST_URL)) is None:
+                try:
+                    models = cls.list_models()
+                except (OSError, ValueError) as e:  # includes requests.RequestException
+                    warnings.warn(f"Failed to fetch the model list, using the model file without its config: {e}")
+                    models = []
+            if (model := next((m for m in models if m["filename"] == model_filename), None)) is not None:
+                config.update(model)
+
         if model_dest.exists():
             config["path"] = str(model_dest)
             if verbose:
@@ -382,6 +1074,7 @@ class GPT4All:
         url: str | None = None,
         expected_size: int | None = None,
         expected_md5: str | None = None,
+        connections: int = 4,
     ) -> str | os.PathLike[str]:
         """
         Download model from gpt4all.io.
@@ -393,11 +1086,21 @@ class GPT4All:
             url: the models remote url (e.g. may be hosted on HF)
             expected_size: The expected size of the download.
             expected_md5: The expected MD5 hash of the download.
+            connections: The number of connections to download with. If the server supports range requests, the file
+                is downloaded in segments over this many connections at once, and an interrupted download is resumed
+                by the next call, from any process. Default is 4.
 
         Returns:
             Model file destination.
         """
 
+        import requests
+        from requests.exceptions import ChunkedEncodingError
+        from tqdm import tqdm
+        from urllib3.exceptions import IncompleteRead, ProtocolError
+
+        from ._download import _fsync, download_segmented, probe_range_support
+
         # Download model
         if url is None:
             url = f"https://gpt4all.io/models/gguf/{model_filename}"
@@ -417,63 +1120,70 @@ class GPT4All:
                 raise ValueError(f"Expected identity Content-Encoding, got {enc}")
             return response
 
-        response = make_request()
-
-        total_size_in_bytes = int(response.headers.get("content-length", 0))
-        block_size = 2**20  # 1 MB
-
         partial_path = Path(model_path) / (model_filename + ".part")
+        remote = probe_range_support(url) if connections > 1 else None
+        if remote is not None:
+            if expected_size is not None and remote.size != expected_size:
+                raise ValueError(f"Expected file size of {expected_size} bytes, got {remote.size}")
+            download_segmented(url, partial_path, remote, connections, expected_md5=expected_md5, verbose=verbose)
+        else:
+            response = make_request()
 
-        with open(partial_path, "w+b") as partf:
-            try:
-                with tqdm(desc="Downloading", total=total_size_in_bytes, unit="iB", unit_scale=True) as progress_bar:
-                    while True:
-                        last_progress = progress_bar.n
-                        try:
-                            for data in response.iter_content(block_size):
-                                partf.write(data)
-                                progress_bar.update(len(data))
-                        except ChunkedEncodingError as cee:
-                            if cee.args and isinstance(pe := cee.args[0], ProtocolError):
-                                if len(pe.args) >= 2 and isinstance(ir := pe.args[1], IncompleteRead):
-                                    assert progress_bar.n <= ir.partial  # urllib3 may be ahead of us but never behind
-                                    # the socket was closed during a read - retry
-                                    response = make_request(progress_bar.n)
-                                    continue
-                            raise
-                        if total_size_in_bytes != 0 and progress_bar.n < total_size_in_bytes:
-                            if progress_bar.n == last_progress:
-                                raise RuntimeError("Download not making progress, aborting.")
-                            # server closed connection prematurely - retry
-                            response = make_request(progress_bar.n)
-                            continue
-                        break
-
-                # verify file integrity
-                file_size = partf.tell()
-                if expected_size is not None and file_size != expected_size:
-                    raise ValueError(f"Expected file size of {expected_size} bytes, got {file_size}")
-                if expected_md5 is not None:
-                    partf.seek(0)
-                    hsh = hashlib.md5()
-                    with tqdm(desc="Verifying", total=file_size, unit="iB", unit_scale=True) as bar:
-                        while chunk := partf.read(block_size):
-                            hsh.update(chunk)
-                            bar.update(len(chunk))
-                    if hsh.hexdigest() != expected_md5.lower():
-                        raise ValueError(f"Expected MD5 hash of {expected_md5!r}, got {hsh.hexdigest()!r}")
-            except:
-                if verbose:
-                    print("Cleaning up the interrupted download...", file=sys.stderr)
-                try:
-                    os.remove(partial_path)
-                except OSError:
-                    pass
-                raise
+            total_size_in_bytes = int(response.headers.get("content-length", 0))
+            block_size = 2**20  # 1 MB
 
-            # flush buffers and sync the inode
-            partf.flush()
-            _fsync(partf)
+            with open(partial_path, "w+b") as partf:
+                try:
+                    progress_bar = tqdm(desc="Downloading", total=total_size_in_bytes, unit="iB", unit_scale=True)
+                    with progress_bar:
+                        while True:
+                            last_progress = progress_bar.n
+                            try:
+                                for data in response.iter_content(block_size):
+                                    partf.write(data)
+                                    progress_bar.update(len(data))
+                            except ChunkedEncodingError as cee:
+                                if cee.args and isinstance(pe := cee.args[0], ProtocolError):
+                                    if len(pe.args) >= 2 and isinstance(ir := pe.args[1], IncompleteRead):
+                                        # urllib3 may be ahead of us but never behind
+                                        assert progress_bar.n <= ir.partial
+                                        # the socket was closed during a read - retry
+                                        response = make_request(progress_bar.n)
+                                        continue
+                                raise
+                            if total_size_in_bytes != 0 and progress_bar.n < total_size_in_bytes:
+                                if progress_bar.n == last_progress:
+                                    raise RuntimeError("Download not making progress, aborting.")
+                                # server closed connection prematurely - retry
+                                response = make_request(progress_bar.n)
+                                continue
+                            break
+
+                    # verify file integrity
+                    file_size = partf.tell()
+                    if expected_size is not None and file_size != expected_size:
+                        raise ValueError(f"Expected file size of {expected_size} bytes, got {file_size}")
+                    if expected_md5 is not None:
+                        partf.seek(0)
+                        hsh = hashlib.md5()
+                        with tqdm(desc="Verifying", total=file_size, unit="iB", unit_scale=True) as bar:
+                            while chunk := partf.read(block_size):
+                                hsh.update(chunk)
+                                bar.update(len(chunk))
+                        if hsh.hexdigest() != expected_md5.lower():
+                            raise ValueError(f"Expected MD5 hash of {expected_md5!r}, got {hsh.hexdigest()!r}")
+                except:
+                    if verbose:
+                        print("Cleaning up the interrupted download...", file=sys.stderr)
+                    try:
+                        os.remove(partial_path)
+                    except OSError:
+                        pass
+                    raise
+
+                # flush buffers and sync the inode
+                partf.flush()
+                _fsync(partf)
 
         # move to final destination
         download_path = Path(model_path) / model_filename
@@ -492,38 +1202,82 @@ class GPT4All:
 
     @overload
     def generate(
-        self, prompt: str, *, max_tokens: int = ..., temp: float = ..., top_k: int = ..., top_p: float = ...,
-        min_p: float = ..., repeat_penalty: float = ..., repeat_last_n: int = ..., n_batch: int = ...,
-        n_predict: int | None = ..., streaming: Literal[False] = ..., callback: ResponseCallbackType = ...,
+        self, prompt: str | None = ..., *, max_tokens: int = ..., temp: float = ..., top_k: int = ...,
+        top_p: float = ..., min_p: float = ..., repeat_penalty: float = ..., repeat_last_n: int = ...,
+        n_batch: int = ..., n_predict: int | None = ..., streaming: Literal[False] = ...,
+        callback: ResponseCallbackType = ..., draft_model: GPT4All | None = ..., n_draft: int = ...,
+        return_stats: Literal[False] = ..., grammar: str | None = ..., json_schema: dict[str, Any] | None = ...,
+        prompt_tokens: Sequence[int] | None = ..., n: None = ..., logprobs: TokenLogprobs | None = ...,
     ) -> str: ...
     @overload
     def generate(
-        self, prompt: str, *, max_tokens: int = ..., temp: float = ..., top_k: int = ..., top_p: float = ...,
-        min_p: float = ..., repeat_penalty: float = ..., repeat_last_n: int = ..., n_batch: int = ...,
-        n_predict: int | None = ..., streaming: Literal[True], callback: ResponseCallbackType = ...,
+        self, prompt: str | None = ..., *, max_tokens: int = ..., temp: float = ..., top_k: int = ...,
+        top_p: float = ..., min_p: float = ..., repeat_penalty: float = ..., repeat_last_n: int = ...,
+        n_batch: int = ..., n_predict: int | None = ..., streaming: Literal[False] = ...,
+        callback: ResponseCallbackType = ..., draft_model: GPT4All | None = ..., n_draft: int = ...,
+        return_stats: Literal[True], grammar: str | None = ..., json_schema: dict[str, Any] | None = ...,
+        prompt_tokens: Sequence[int] | None = ..., n: None = ..., logprobs: TokenLogprobs | None = ...,
+    ) -> tuple[str, GenerationStats]: ...
+    @overload
+    def generate(
+        self, prompt: str | None = ..., *, max_tokens: int = ..., temp: float = ..., top_k: int = ...,
+        top_p: float = ..., min_p: float = ..., repeat_penalty: float = ..., repeat_last_n: int = ...,
+        n_batch: int = ..., n_predict: int | None = ..., streaming: Literal[True], callback: ResponseCallbackType = ...,
+        draft_model: GPT4All | None = ..., n_draft: int = ..., return_stats: Literal[False] = ...,
+        grammar: str | None = ..., json_schema: dict[str, Any] | None = ..., prompt_tokens: Sequence[int] | None = ...,
+        n: None = ..., logprobs: TokenLogprobs | None = ...,
     ) -> Iterable[str]: ...
     @overload
     def generate(
-        self, prompt: str, *, max_tokens: int = ..., temp: float = ..., top_k: int = ..., top_p: float = ...,
-        min_p: float = ..., repeat_penalty: float = ..., repeat_last_n: int = ..., n_batch: int = ...,
-        n_predict: int | None = ..., streaming: bool, callback: ResponseCallbackType = ...,
+        self, prompt: str | None = ..., *, max_tokens: int = ..., temp: float = ..., top_k: int = ...,
+        top_p: float = ..., min_p: float = ..., repeat_penalty: float = ..., repeat_last_n: int = ...,
+        n_batch: int = ..., n_predict: int | None = ..., streaming: Literal[False] = ...,
+        callback: ResponseCallbackType = ..., draft_model: None = ..., n_draft: int = ...,
+        return_stats: Literal[False] = ..., grammar: str | None = ..., json_schema: dict[str, Any] | None = ...,
+        prompt_tokens: Sequence[int] | None = ..., n: int, logprobs: None = ...,
+    ) -> list[Completion]: ...
+    @overload
+    def generate(
+        self, prompt: str | None = ..., *, max_tokens: int = ..., temp: float = ..., top_k: int = ...,
+        top_p: float = ..., min_p: float = ..., repeat_penalty: float = ..., repeat_last_n: int = ...,
+        n_batch: int = ..., n_predict: int | None = ..., streaming: Literal[False] = ...,
+        callback: ResponseCallbackType = ..., draft_model: None = ..., n_draft: int = ..., return_stats: Literal[True],
+        grammar: str | None = ..., json_schema: dict[str, Any] | None = ..., prompt_tokens: Sequence[int] | None = ...,
+        n: int, logprobs: None = ...,
+    ) -> tuple[list[Completion], GenerationStats]: ...
+    @overload
+    def generate(
+        self, prompt: str | None = ..., *, max_tokens: int = ..., temp: float = ..., top_k: int = ...,
+        top_p: float = ..., min_p: float = ..., repeat_penalty: float = ..., repeat_last_n: int = ...,
+        n_batch: int = ..., n_predict: int | None = ..., streaming: bool, callback: ResponseCallbackType = ...,
+        draft_model: GPT4All | None = ..., n_draft: int = ..., return_stats: bool = ..., grammar: str | None = ...,
+        json_schema: dict[str, Any] | None = ..., prompt_tokens: Sequence[int] | None = ..., n: int | None = ...,
+        logprobs: TokenLogprobs | None = ...,
     ) -> Any: ...
 
     def generate(
         self,
-        prompt         : str,
+        prompt         : str | None            = None,
         *,
-        max_tokens     : int                  = 200,
-        temp           : float                = 0.7,
-        top_k          : int                  = 40,
-        top_p          : float                = 0.4,
-        min_p          : float                = 0.0,
-        repeat_penalty : float                = 1.18,
-        repeat_last_n  : int                  = 64,
-        n_batch        : int                  = 8,
-        n_predict      : int | None           = None,
-        streaming      : bool                 = False,
-        callback       : ResponseCallbackType = empty_response_callback,
+        max_tokens     : int                   = 200,
+        temp           : float                 = 0.7,
+        top_k          : int                   = 40,
+        top_p          : float                 = 0.4,
+        min_p          : float                 = 0.0,
+        repeat_penalty : float                 = 1.18,
+        repeat_last_n  : int                   = 64,
+        n_batch        : int                   = 8,
+        n_predict      : int | None            = None,
+        streaming      : bool                  = False,
+        callback       : ResponseCallbackType  = empty_response_callback,
+        draft_model    : GPT4All | None        = None,
+        n_draft        : int                   = 4,
+        return_stats   : bool                  = False,
+        grammar        : str | None            = None,
+        json_schema    : dict[str, Any] | None = None,
+        prompt_tokens  : Sequence[int] | None  = None,
+        n              : int | None            = None,
+        logprobs       : TokenLogprobs | None  = None,
     ) -> Any:
         """
         Generate outputs from any GPT4All model.
@@ -541,9 +1295,17 @@ class GPT4All:
             n_predict: Equivalent to max_tokens, exists for backwards compatibility.
             streaming: If True, this method will instead return a generator that yields tokens as the model generates them.
             callback: A function with arguments token_id:int and response:str, which receives the tokens from the model as they are generated and stops the generation by returning False.
+            draft_model: A smaller model with the same vocabulary, such as a smaller model of the same family, to use for speculative decoding. It proposes n_draft tokens at a time, which this model checks in one batch. With top_k=1 or temp=0 the output is the same as without a draft model. Generation stops when the context window is full. See `speculative_stats`.
+            n_draft: The number of tokens the draft model proposes at a time.
+            return_stats: If True, also return a `GenerationStats` with token counts and timings. Not supported with streaming; use `metrics_hook` instead.
+            grammar: A GBNF grammar with a "root" rule. Tokens that cannot continue a completion matching it are never sampled, and the completion ends once it is complete.
+            json_schema: A JSON schema for the completion to match, converted with `json_schema_to_grammar`. Keywords such as `minimum` and `pattern` are not enforced; use `validate_json` to check them. The completion may still be cut short by max_tokens.
+            prompt_tokens: The prompt as token ids from `tokenize`, instead of prompt, so that it is not tokenized again. An array('i') is passed to the model without being copied. To combine the tokens of a shared prefix with those of the rest of the prompt, note that `tokenize` starts every text with the BOS token if the model uses one. Not supported in a chat session, which applies the chat template to the prompt text.
+            n: If given, generate this many completions of the prompt, which is evaluated only once, e.g. to pick the best of n. The callback receives the tokens of each completion in turn, and returning False ends that completion. Generation stops when the context window is full. Not supported with streaming or draft_model, or in a chat session.
+            logprobs: A `TokenLogprobs` to which the log-probability of each generated token, and optionally its most likely alternatives, is appended before the callback receives the token, e.g. to stop when the model is unsure or to compute the perplexity of the completion. Generation then stops when the context window is full. Not supported with draft_model or n.
 
         Returns:
-            Either the entire completion or a generator that yields the completion token by token.
+            Either the entire completion or a generator that yields the completion token by token. With n, a list of `Completion`s with the text and log-probability of each. With return_stats, a tuple of the completion(s) and their statistics.
         """
 
         # Preparing the model request
@@ -556,53 +1318,374 @@ class GPT4All:
             repeat_last_n  = repeat_last_n,
             n_batch        = n_batch,
             n_predict      = n_predict if n_predict is not None else max_tokens,
+            grammar        = self._resolve_grammar(grammar, json_schema),
+        )
+        if draft_model is not None:
+            if not 1 <= n_draft < 128:
+                raise ValueError(f"n_draft must be between 1 and 127, got {n_draft}")
+            generate_kwargs.update(draft_model=draft_model.model, n_draft=n_draft)
+        if return_stats and streaming:
+            raise ValueError("return_stats is not supported with streaming=True, use metrics_hook instead")
+        if n is not None:
+            if streaming:
+                raise ValueError("n is not supported with streaming=True")
+            if draft_model is not None:
+                raise ValueError("n cannot be used with draft_model")
+            if self._chat_session is not None:
+                raise ValueError("n cannot be used in a chat session")
+            if logprobs is not None:
+                raise ValueError("logprobs cannot be used with n, each Completion has a logprob instead")
+        if logprobs is not None:
+            if draft_model is not None:
+                raise ValueError("logprobs cannot be used with draft_model")
+            generate_kwargs["logprobs"] = logprobs
+
+        if prompt_tokens is not None:
+            if prompt is not None:
+                raise ValueError("prompt and prompt_tokens cannot both be given")
+            if self._chat_session is not None:
+                raise ValueError("prompt_tokens cannot be used in a chat session")
+            if len(prompt_tokens) > (limit := self.model.n_ctx - 4):
+                raise ValueError(
+                    f"Your message was too long and could not be processed ({len(prompt_tokens)} > {limit}).",
+                )
+            generate_kwargs["tokens"] = prompt_tokens
+        elif prompt is None:
+            raise ValueError("Either prompt or prompt_tokens must be given")
+
+        # The model appends the response to this as it calls the callback
+        pieces: list[str] = []
+        generate_kwargs["output"] = pieces
+
+        stats = None
+        if return_stats or self.metrics_hook is not None:
+            stats = _StatsCollector()
+            generate_kwargs["prompt_callback"] = stats.prompt_callback
+            generate_kwargs["token_callback"] = stats.token_callback
+
+        if prompt is None:
+            self._loaded_prefix_key = None  # the prompt replaces any cached prefix in the context
+        else:
+            prompt = self._render_prompt(prompt, generate_kwargs["n_predict"])
+
+        # Send the request to the model
+        if n is not None:
+            del generate_kwargs["output"]
+            outputs: list[list[str]] = [[] for _ in range(n)]
+            if stats is not None:
+                stats.start()
+            samples = self.model.prompt_model_samples(
+                prompt, n, lambda index, token_id, response: callback(token_id, response), outputs=outputs,
+                **generate_kwargs,
+            )
+            completions = [
+                Completion(text="".join(output), n_tokens=sample.n_tokens, logprob=sample.logprob)
+                for output, sample in zip(outputs, samples)
+            ]
+            if stats is not None:
+                result = self._report_stats(stats)
+                if return_stats:
+                    return completions, result
+            return completions
+
+        if streaming:
+            def stream() -> Iterator[str]:
+                try:
+                    if stats is not None:
+                        stats.start()
+                    yield from self.model.prompt_model_streaming(prompt, callback, **generate_kwargs)
+                    if self._chat_session is not None:
+                        self._chat_session.history.append(MessageType(role="assistant", content="".join(pieces)))
+                finally:
+                    if stats is not None and stats.started:
+                        self._report_stats(stats)
+            return stream()
+
+        if stats is not None:
+            stats.start()
+        self.model.prompt_model(prompt, callback, **generate_kwargs)
+        full_response = "".join(pieces)
+        if self._chat_session is not None:
+            self._chat_session.history.append(MessageType(role="assistant", content=full_response))
+        if stats is not None:
+            result = self._report_stats(stats)
+            if return_stats:
+                return full_response, result
+        return full_response
+
+    @staticmethod
+    def _resolve_grammar(grammar: str | None, json_schema: dict[str, Any] | None) -> str | None:
+        if json_schema is None:
+            return grammar
+        if grammar is not None:
+            raise ValueError("grammar and json_schema cannot be used together")
+        return json_schema_to_grammar(json_schema)
+
+    def _report_stats(self, stats: _StatsCollector) -> GenerationStats:
+        result = stats.finish()
+        if self.metrics_hook is not None:
+            self.metrics_hook(result)
+        return result
+
+    async def agenerate(
+        self,
+        prompt         : str,
+        *,
+        max_tokens     : int                   = 200,
+        temp           : float                 = 0.7,
+        top_k          : int                   = 40,
+        top_p          : float                 = 0.4,
+        min_p          : float                 = 0.0,
+        repeat_penalty : float                 = 1.18,
+        repeat_last_n  : int                   = 64,
+        n_batch        : int                   = 8,
+        n_predict      : int | None            = None,
+        callback       : ResponseCallbackType  = empty_response_callback,
+        max_pending    : int                   = 16,
+        grammar        : str | None            = None,
+        json_schema    : dict[str, Any] | None = None,
+    ) -> AsyncIterator[str]:
+        """
+        Generate outputs from any GPT4All model without blocking the event loop.
+
+        Calls on the same instance run one after the other on a background thread owned by the model. Closing the
+        iterator early or cancelling the task consuming it stops the generation.
+
+        Args:
+            max_pending: The maximum number of generated tokens waiting to be consumed before generation pauses.
+
+            The remaining arguments have the same meaning as for `generate`.
+
+        Returns:
+            An asynchronous iterator that yields the completion token by token.
+        """
+
+        generate_kwargs: dict[str, Any] = dict(
+            temp           = temp,
+            top_k          = top_k,
+            top_p          = top_p,
+            min_p          = min_p,
+            repeat_penalty = repeat_penalty,
+            repeat_last_n  = repeat_last_n,
+            n_batch        = n_batch,
+            n_predict      = n_predict if n_predict is not None else max_tokens,
+            grammar        = self._resolve_grammar(grammar, json_schema),
         )
 
-        # Prepare the callback, process the model response
-        full_response = ""
+        full_response: list[str] = []
+        generate_kwargs["output"] = full_response
+
+        stats = None
+        if self.metrics_hook is not None:
+            stats = _StatsCollector()
+            generate_kwargs["prompt_callback"] = stats.prompt_callback
+            generate_kwargs["token_callback"] = stats.token_callback
+
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        if self._agenerate_lock is None:
+            self._agenerate_lock = asyncio.Lock()
+
+        # Rendering adds the message to the chat session, which must not render another message until the reply to
+        # this one has been added after it, so concurrent calls wait for each other
+        try:
+            async with self._agenerate_lock:
+                # rendering may need to process a cached prefix, so it must run on the model's thread as well
+                prompt = await loop.run_in_executor(
+                    self.model._worker, self._render_prompt, prompt, generate_kwargs["n_predict"],
+                )
+
+                if stats is not None:
+                    stats.start()
+                async for token in self.model.prompt_model_async(
+                    prompt, callback, max_pending=max_pending, **generate_kwargs,
+                ):
+                    yield token
+                if self._chat_session is not None:
+                    self._chat_session.history.append(MessageType(role="assistant", content="".join(full_response)))
+        finally:
+            if stats is not None and stats.started:
+                self._report_stats(stats)
+
+    def generate_batch(
+        self,
+        prompts        : Iterable[str],
+        *,
+        max_tokens     : int                              = 200,
+        temp           : float                            = 0.7,
+        top_k          : int                              = 40,
+        top_p          : float                            = 0.4,
+        min_p          : float                            = 0.0,
+        repeat_penalty : float                            = 1.18,
+        repeat_last_n  : int                              = 64,
+        n_batch        : int                              = 8,
+        n_predict      : int | None                       = None,
+        callback       : BatchResponseCallbackType | None = None,
+    ) -> BatchResult:
+        """
+        Generate completions for many independent prompts with the loaded model.
+
+        Prompts are scheduled so that those sharing a common prefix are processed back to back, which lets the model
+        reuse the part of its context that the prompts have in common instead of processing it again.
+
+        Args:
+            prompts: The prompts for the model to complete. Chat templates are not applied.
+            max_tokens: The maximum number of tokens to generate for each prompt.
+            callback: A function with arguments index:int, token_id:int, and response:str, which receives the tokens
+                for the prompt at the given index as they are generated and stops the generation of that completion by
+                returning False.
 
-        def _callback_wrapper(token_id: int, response: str) -> bool:
-            nonlocal full_response
-            full_response += response
-            return callback(token_id, response)
+            The remaining arguments have the same meaning as for `generate`.
 
+        Returns:
+            A dict with the completions and aggregate statistics about the batch.
+        """
+
+        if self._chat_session is not None:
+            raise ValueError("generate_batch may not be used in a chat session")
+        self._loaded_prefix_key = None
+
+        prompts = list(prompts)
+        generate_kwargs: dict[str, Any] = dict(
+            temp           = temp,
+            top_k          = top_k,
+            top_p          = top_p,
+            min_p          = min_p,
+            repeat_penalty = repeat_penalty,
+            repeat_last_n  = repeat_last_n,
+            n_batch        = n_batch,
+            n_predict      = n_predict if n_predict is not None else max_tokens,
+        )
+
+        # Check request lengths before generating anything
+        limit = self.model.n_ctx - 4
+        for prompt_len in self.model.count_prompt_tokens_batch(prompts):
+            if prompt_len > limit:
+                raise ValueError(f"Your message was too long and could not be processed ({prompt_len} > {limit}).")
+
+        outputs = [""] * len(prompts)
+        n_output_tokens = [0] * len(prompts)
+        n_prompt_tokens = 0
+        n_generated_tokens = 0
+
+        start_time = time.perf_counter()
+        for index in sorted(range(len(prompts)), key=prompts.__getitem__):
+            pieces: list[str] = []
+
+            def response_callback(token_id: int, response: str) -> bool:
+                pieces.append(response)
+                return callback is None or callback(index, token_id, response)
+
+            stats = _StatsCollector()
+            stats.start()
+            self.model.prompt_model(
+                prompts[index], response_callback, prompt_callback=stats.prompt_callback,
+                token_callback=stats.token_callback, **generate_kwargs,
+            )
+            outputs[index] = "".join(pieces)
+            n_output_tokens[index] = stats.n_generated_tokens
+            n_prompt_tokens += stats.n_prompt_tokens - stats.n_cached_tokens
+            n_generated_tokens += stats.n_generated_tokens
+            if self.metrics_hook is not None:
+                self._report_stats(stats)
+        elapsed = time.perf_counter() - start_time
+
+        return BatchResult(
+            outputs            = outputs,
+            n_prompt_tokens    = n_prompt_tokens,
+            n_generated_tokens = n_generated_tokens,
+            n_output_tokens    = n_output_tokens,
+            elapsed            = elapsed,
+            tokens_per_second  = n_generated_tokens / elapsed if elapsed > 0 else 0.0,
+        )
+
+    def _render_prompt(self, prompt: str, n_predict: int) -> str:
+        # Apply the chat template if there is a chat session, and check that the request is not too long
         last_msg_rendered = prompt
+        prefix_rendered = None
         if self._chat_session is not None:
             session = self._chat_session
-            def render(messages: list[MessageType]) -> str:
-                return session.template.render(
-                    messages=messages,
-                    add_generation_prompt=True,
-                    **self.model.special_tokens_map,
+            if session.renderer is None or session.token_counts is None:
+                self._chat_session = session = session._replace(
+                    renderer=session.renderer or _ChatRenderer(session.template, self.model.special_tokens_map),
+                    token_counts={} if session.token_counts is None else session.token_counts,
                 )
             session.history.append(MessageType(role="user", content=prompt))
-            prompt = render(session.history)
-            if len(session.history) > 1:
-                last_msg_rendered = render(session.history[-1:])
+            if session.history_policy is not None:
+                self._fit_history(session, n_predict)
+            prompt, last_msg_rendered = session.renderer.render_prompt(session.history)
+            if len(session.history) > 1 and self.prefix_cache is not None and not self._prefix_cache_checked:
+                prefix_rendered = session.renderer.render(session.history[:-1], add_generation_prompt=False)
+            self._prefix_cache_checked = True
+        else:
+            self._loaded_prefix_key = None
 
         # Check request length
         last_msg_len = self.model.count_prompt_tokens(last_msg_rendered)
         if last_msg_len > (limit := self.model.n_ctx - 4):
             raise ValueError(f"Your message was too long and could not be processed ({last_msg_len} > {limit}).")
 
-        # Send the request to the model
-        if streaming:
-            def stream() -> Iterator[str]:
-                yield from self.model.prompt_model_streaming(prompt, _callback_wrapper, **generate_kwargs)
-                if self._chat_session is not None:
-                    self._chat_session.history.append(MessageType(role="assistant", content=full_response))
-            return stream()
+        if prefix_rendered and prompt.startswith(prefix_rendered):
+            self._load_prefix(prefix_rendered)
 
-        self.model.prompt_model(prompt, _callback_wrapper, **generate_kwargs)
-        if self._chat_session is not None:
-            self._chat_session.history.append(MessageType(role="assistant", content=full_response))
-        return full_response
+        return prompt
+
+    def _fit_history(self, session: ChatSession, n_predict: int) -> None:
+        # Trim the history with the session's policy if it does not fit in the context window with room for the reply
+        assert session.history_policy is not None and session.renderer is not None
+        counts = session.token_counts
+        assert counts is not None
+
+        def n_tokens(message: MessageType) -> int:
+            key = (message["role"], message["content"])
+            if (n := counts.get(key)) is None:
+                try:
+                    n = self.model.count_prompt_tokens(session.renderer.render_message(message))
+                except Exception:
+                    # the template cannot render the message by itself, e.g. because it checks the order of roles
+                    n = self.model.count_prompt_tokens(message["content"]) + MESSAGE_TOKEN_OVERHEAD
+                counts[key] = n
+            return n
+
+        n_ctx = self.model.n_ctx
+        budget = n_ctx - min(n_predict, n_ctx // 2) - 4
+        if sum(map(n_tokens, session.history)) <= budget:
+            return
+
+        history = session.history_policy.trim(list(session.history), n_tokens, budget)
+        if not history or history[-1] != session.history[-1]:
+            raise ValueError("The history policy must keep the new user message")
+        session.history[:] = history
+        # forget the counts of dropped messages, so the memory used by a session stays bounded
+        kept = {(msg["role"], msg["content"]) for msg in history}
+        for key in [key for key in counts if key not in kept]:
+            del counts[key]
+
+    def _load_prefix(self, prefix: str) -> None:
+        # Bring the model's context to the state after processing prefix, using the prefix cache if possible. The next
+        # prompt starting with prefix will then only process what comes after it.
+        assert self.prefix_cache is not None
+        key = self.prefix_cache.key(self.model, prefix)
+        if key == self._loaded_prefix_key:
+            return  # already in context
+
+        if (state := self.prefix_cache.get(key)) is not None:
+            self.model.restore_state(state)
+        else:
+            # process the prefix by itself so its state can be saved. The token sampled after it is not added to the
+            # context, so nothing is generated.
+            self.model.init_sampler(LLModelPromptContext(temp=0.0, repeat_penalty=1.0))
+            self.model.decode_sample(self.model.tokenize(prefix), 1)
+            self.prefix_cache.put(key, self.model.save_state())
+        self._loaded_prefix_key = key
 
     @contextmanager
     def chat_session(
         self,
         system_message: str | Literal[False] | None = None,
         chat_template: str | None = None,
+        history_policy: HistoryPolicy | None = None,
     ):
         """
         Context manager to hold an inference optimized chat session with a GPT4All model.
@@ -610,6 +1693,9 @@ class GPT4All:
         Args:
             system_message: An initial instruction for the model, None to use the model default, or False to disable. Defaults to None.
             chat_template: Jinja template for the conversation, or None to use the model default. Defaults to None.
+            history_policy: How to shorten the history when it no longer fits in the context window together with the
+                reply, e.g. `SlidingWindow()`. The history is trimmed in place before each prompt is processed. If
+                None, the model drops the oldest part of its context by itself when it fills up. Defaults to None.
         """
 
         if system_message is None:
@@ -628,10 +1714,15 @@ class GPT4All:
         history = []
         if system_message is not False:
             history.append(MessageType(role="system", content=system_message))
+        template = _jinja_env().from_string(chat_template)
         self._chat_session = ChatSession(
-            template=_jinja_env.from_string(chat_template),
+            template=template,
             history=history,
+            renderer=_ChatRenderer(template, self.model.special_tokens_map),
+            history_policy=None if history_policy is None else copy.copy(history_policy),
+            token_counts={},
         )
+        self._prefix_cache_checked = False
         try:
             yield self
         finally:
@@ -654,20 +1745,52 @@ def append_extension_if_missing(model_name):
     return model_name
 
 
-class _HasFileno(Protocol):
-    def fileno(self) -> int: ...
-
-
-def _fsync(fd: int | _HasFileno) -> None:
-    if sys.platform == "darwin":
-        # Apple's fsync does not flush the drive write cache
+class _NpyWriter:
+    # Writes a 2D float32 .npy file one block of rows at a time, so the number of rows need not be known in advance.
+    # The header is padded to a fixed size and rewritten with the final shape on commit. Rows go to a temporary file
+    # that only replaces the file at path on commit, so a failed write never leaves a partial file that looks valid.
+
+    HEADER_SIZE = 128
+
+    def __init__(self, path: str | os.PathLike[str]):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        self.file = open(self.tmp_path, "wb")
+        self.n_rows = 0
+        self.n_cols = 0
+        self._write_header()
+
+    def _write_header(self) -> None:
+        header = f"{{'descr': '<f4', 'fortran_order': False, 'shape': ({self.n_rows}, {self.n_cols}), }}"
+        header = header.ljust(self.HEADER_SIZE - 11) + "\n"
+        self.file.seek(0)
+        self.file.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+    def write(self, block: NDArray[np.float32]) -> None:
+        if not self.n_rows:
+            self.n_cols = block.shape[1]
+        elif block.shape[1] != self.n_cols:
+            raise ValueError(f"Expected embeddings of dimension {self.n_cols}, got {block.shape[1]}")
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(block.astype("<f4", copy=False))
+        self.n_rows += block.shape[0]
+
+    def commit(self) -> None:
+        self._write_header()
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self) -> None:
+        # after a successful commit, the temporary file is already gone
+        self.file.close()
         try:
-            fcntl.fcntl(fd, fcntl.F_FULLFSYNC)
+            os.remove(self.tmp_path)
         except OSError:
-            pass  # fall back to fsync
-        else:
-            return
-    os.fsync(fd)
+            pass
+
+
+def _model_list_cache_path() -> Path:
+    return Path(DEFAULT_MODEL_DIRECTORY) / ".models3.json"
 
 
 def _remove_prefix(s: str, prefix: str) -> str:
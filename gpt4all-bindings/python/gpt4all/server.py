@@ -0,0 +1,960 @@
+"""
+An OpenAI-compatible HTTP server for GPT4All models, using only the standard library.
+
+Run it with, for example::
+
+    python -m gpt4all.server --model orca-mini-3b-gguf2-q4_0.gguf --embedding-model all-MiniLM-L6-v2.gguf2.f16.gguf
+
+It serves `/v1/models`, `/v1/completions`, `/v1/chat/completions`, and `/v1/embeddings`. Each model has a queue of
+requests and a pool of workers. A worker that becomes free takes the requests waiting in the queue, up to a batch size,
+and handles those with the same sampling settings in one call to `GPT4All.generate_batch`, which processes prompts with
+a common prefix back to back, or embeds the inputs of all of them in one call to `Embed4All.embed`. The workers of a
+model share one copy of its weights and one context, which they use one at a time, so a single worker per model is
+usually best.
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+from abc import ABC, abstractmethod
+import json
+import queue
+import sys
+import threading
+import time
+import uuid
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import TracebackType
+from typing import TYPE_CHECKING, Any, Callable, Generic, NamedTuple, TypeVar
+from urllib.parse import unquote, urlsplit
+
+from .gpt4all import Embed4All, GPT4All, MessageType, ModelRegistry, _ChatRenderer, _jinja_env
+
+if TYPE_CHECKING:
+    from typing_extensions import Self
+
+DEFAULT_PORT = 4891
+MAX_CHOICES = 128  # the most completions a request may ask for with n
+
+_POST_ENDPOINTS = ("completions", "chat/completions", "embeddings")
+
+
+class _RequestError(Exception):
+    # An error reported to the client in the format of the OpenAI API
+
+    def __init__(
+        self, message: str, status: int = 400, *, code: str | None = None, type: str = "invalid_request_error",
+        param: str | None = None,
+    ):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.type = type
+        self.param = param
+
+    def body(self) -> dict[str, Any]:
+        return {"error": {"code": self.code, "message": str(self), "param": self.param, "type": self.type}}
+
+
+# Request parsing. The checks and messages are the same as those of the chat application's server.
+
+_TYPE_CHECKS: dict[str, Callable[[Any], bool]] = {
+    "boolean": lambda v: isinstance(v, bool),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "number" : lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "string" : lambda v: isinstance(v, str),
+    "array"  : lambda v: isinstance(v, list),
+    "object" : lambda v: isinstance(v, dict),
+}
+
+
+def _format_number(value: float) -> str:
+    text = repr(float(value))
+    return text[:-2] if text.endswith(".0") else text
+
+
+def _take(
+    request: dict[str, Any], key: str, type: str | None = None, required: bool = False, min: float | None = None,
+    max: float | None = None,
+) -> Any:
+    # Remove a parameter from the request and check it, so that what is left over is unrecognized
+    value = request.pop(key, None)
+    if value is None:
+        if required:
+            raise _RequestError(f"you must provide a {key} parameter")
+        return None
+    if type is not None and not _TYPE_CHECKS[type](value):
+        shown = value if isinstance(value, str) else json.dumps(value)
+        raise _RequestError(f"'{shown}' is not of type '{type}' - '{key}'")
+    if min is not None and value < min:
+        raise _RequestError(f"{_format_number(value)} is less than the minimum of {min} - '{key}'")
+    if max is not None and value > max:
+        raise _RequestError(f"{_format_number(value)} is greater than the maximum of {max} - '{key}'")
+    return value
+
+
+def _check_unrecognized(request: dict[str, Any]) -> None:
+    if request:
+        raise _RequestError(f"Unrecognized request argument supplied: {next(iter(request))}")
+
+
+class _SamplingKey(NamedTuple):
+    # completions with the same settings can be generated by one call to generate_batch
+    max_tokens: int
+    temperature: float
+    top_p: float
+    min_p: float
+
+
+class _CompletionJob:
+    # A request to /v1/completions or /v1/chat/completions. The worker handling it reports progress by putting events
+    # on its queue: ("text", index, text) for streamed text, then ("done", choices) or ("error", _RequestError).
+
+    def __init__(self, request: dict[str, Any], chat: bool):
+        self.chat = chat
+        self.model: str = _take(request, "model", "string", required=True)
+
+        if (value := _take(request, "frequency_penalty", "number", min=-2, max=2)) is not None and value != 0:
+            raise _RequestError("'frequency_penalty' is not supported")
+        if (value := _take(request, "presence_penalty", "number")) is not None and value != 0:
+            raise _RequestError("'presence_penalty' is not supported")
+        if _take(request, "seed", "integer") is not None:
+            raise _RequestError("'seed' is not supported")
+        if _take(request, "logit_bias", "object") is not None:
+            raise _RequestError("'logit_bias' is not supported")
+
+        max_tokens = _take(request, "max_tokens", "integer", min=1)
+        self.n: int = _take(request, "n", "integer", min=1, max=MAX_CHOICES) or 1
+        temperature = _take(request, "temperature", "number", min=0, max=2)
+        top_p = _take(request, "top_p", "number", min=0, max=1)
+        min_p = _take(request, "min_p", "number", min=0, max=1)
+        self.sampling = _SamplingKey(
+            max_tokens  = 16 if max_tokens is None else max_tokens,
+            temperature = 1.0 if temperature is None else float(temperature),
+            top_p       = 1.0 if top_p is None else float(top_p),
+            min_p       = 0.0 if min_p is None else float(min_p),
+        )
+
+        stop = request.pop("stop", None)
+        if isinstance(stop, str):
+            stop = [stop]
+        if stop is not None and (
+            not isinstance(stop, list) or len(stop) > 4 or not all(isinstance(s, str) and s for s in stop)
+        ):
+            raise _RequestError("'stop' must be a non-empty string or an array of up to 4 non-empty strings",
+                                param="stop")
+        self.stop: tuple[str, ...] = tuple(stop or ())
+
+        self.stream: bool = bool(_take(request, "stream", "boolean"))
+        stream_options = _take(request, "stream_options", "object")
+        self.include_usage = False
+        if stream_options is not None:
+            if not self.stream:
+                raise _RequestError("The 'stream_options' parameter is only allowed when 'stream' is enabled.")
+            self.include_usage = bool(_take(stream_options, "include_usage", "boolean"))
+            _check_unrecognized(stream_options)
+        _take(request, "user", "string")  # validate but don't use
+
+        self.echo = False
+        self.prompt = ""
+        self.messages: list[MessageType] = []
+        if chat:
+            self._parse_chat(request)
+        else:
+            self._parse_completion(request)
+        _check_unrecognized(request)
+
+        self.prompt_tokens = 0
+        self.events: queue.SimpleQueue[tuple[Any, ...]] = queue.SimpleQueue()
+        self.cancelled = False  # set when the client goes away, to stop generating
+
+    def _parse_completion(self, request: dict[str, Any]) -> None:
+        self.prompt = _take(request, "prompt", "string", required=True)
+        best_of = _take(request, "best_of", "integer")
+        if best_of is not None:
+            if self.n > best_of:
+                raise _RequestError(
+                    "You requested that the server return more choices than it will generate (HINT: you must set 'n' "
+                    f"(currently {self.n}) to be at most 'best_of' (currently {best_of}), or omit either parameter if "
+                    "you don't specifically want to use them.)"
+                )
+            if best_of > self.n:
+                raise _RequestError("'best_of' is not supported")
+        self.echo = bool(_take(request, "echo", "boolean"))
+        if _take(request, "logprobs", "integer", min=0) is not None:
+            raise _RequestError("'logprobs' is not supported")
+        if _take(request, "suffix", "string"):
+            raise _RequestError("'suffix' is not supported")
+
+    def _parse_chat(self, request: dict[str, Any]) -> None:
+        messages = _take(request, "messages", required=True)
+        if not isinstance(messages, list) or not messages:
+            raise _RequestError(
+                f"Invalid type for 'messages': expected a non-empty array of objects, but got '{json.dumps(messages)}'"
+                " instead."
+            )
+        for i, msg in enumerate(messages):
+            if not isinstance(msg, dict):
+                raise _RequestError(
+                    f"Invalid type for 'messages[{i}]': expected an object, but got '{json.dumps(msg)}' instead."
+                )
+            msg = dict(msg)
+            role = _take(msg, "role", "string", required=True)
+            if role not in ("system", "user", "assistant"):
+                raise _RequestError(
+                    f"Invalid 'messages[{i}].role': expected one of 'system', 'assistant', or 'user', but got '{role}'"
+                    " instead."
+                )
+            content = _take(msg, "content", "string", required=True)
+            if msg:
+                raise _RequestError(f"Invalid 'messages[{i}]': unrecognized key: '{next(iter(msg))}'")
+            self.messages.append(MessageType(role=role, content=content))
+        if _take(request, "logprobs", "boolean"):
+            raise _RequestError("'logprobs' is not supported")
+        if _take(request, "top_logprobs", "integer") is not None:
+            raise _RequestError("The 'top_logprobs' parameter is only allowed when 'logprobs' is enabled.")
+        for key in ("response_format", "tools", "tool_choice", "function_call", "functions"):
+            if request.pop(key, None) is not None:
+                raise _RequestError(f"'{key}' is not supported")
+
+
+class _Choice:
+    # One completion of a request, as it is generated. Text is cut off at the first stop sequence, and while
+    # streaming, text that may be the start of one is held back until it is known not to be.
+
+    def __init__(self, job: _CompletionJob, index: int):
+        self.job = job
+        self.index = index
+        self.text = ""
+        self.n_sent = 0  # the length of the text streamed so far
+        self.n_tokens = 0  # set once generation is done, since a piece of text may span several tokens
+        self.stopped = False
+
+    def feed(self, piece: str) -> bool:
+        # Returns whether to continue generating
+        job = self.job
+        if job.cancelled:
+            return False
+        old_len = len(self.text)
+        self.text += piece
+        send_end = len(self.text)
+        for stop in job.stop:
+            # the text before was checked already, so a match must end in the new piece
+            match = self.text.find(stop, max(0, old_len - len(stop) + 1))
+            if match != -1:
+                self.text = self.text[:match]
+                self.stopped = True
+        if self.stopped:
+            send_end = len(self.text)
+        else:
+            for stop in job.stop:
+                for n in range(min(len(stop) - 1, len(self.text)), 0, -1):
+                    if self.text.endswith(stop[:n]):
+                        send_end = min(send_end, len(self.text) - n)
+                        break
+        if job.stream and send_end > self.n_sent:
+            job.events.put(("text", self.index, self.text[self.n_sent:send_end]))
+            self.n_sent = send_end
+        return not self.stopped
+
+    def finish(self) -> None:
+        job = self.job
+        if job.stream and len(self.text) > self.n_sent:
+            job.events.put(("text", self.index, self.text[self.n_sent:]))
+            self.n_sent = len(self.text)
+
+    @property
+    def finish_reason(self) -> str:
+        return "length" if not self.stopped and self.n_tokens >= self.job.sampling.max_tokens else "stop"
+
+
+class _EmbeddingJob:
+    # A request to /v1/embeddings, answered with ("done", (embeddings, n_prompt_tokens)) or ("error", _RequestError)
+
+    def __init__(self, request: dict[str, Any]):
+        self.model: str = _take(request, "model", "string", required=True)
+        inputs = _take(request, "input", required=True)
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if not isinstance(inputs, list) or not inputs or not all(isinstance(t, str) for t in inputs):
+            raise _RequestError("'input' must be a string or a non-empty array of strings", param="input")
+        self.inputs: list[str] = inputs
+        self.dimensions: int | None = _take(request, "dimensions", "integer", min=1)
+        self.encoding_format: str = _take(request, "encoding_format", "string") or "float"
+        if self.encoding_format not in ("float", "base64"):
+            raise _RequestError(
+                f"Invalid 'encoding_format': expected one of 'float' or 'base64', but got '{self.encoding_format}'"
+                " instead."
+            )
+        _take(request, "user", "string")  # validate but don't use
+        _check_unrecognized(request)
+        self.events: queue.SimpleQueue[tuple[Any, ...]] = queue.SimpleQueue()
+        self.cancelled = False
+
+
+_ModelT = TypeVar("_ModelT", GPT4All, Embed4All)
+_JobT = TypeVar("_JobT", _CompletionJob, _EmbeddingJob)
+
+
+class _WorkerPool(ABC, Generic[_ModelT, _JobT]):
+    # A queue of jobs for one model, and a thread for each instance of the model that takes jobs from it in batches.
+    # The instances share the model's context, so only one of them uses it at a time.
+
+    def __init__(
+        self, name: str, instances: list[_ModelT], max_queue: int, max_batch_size: int, batch_wait: float,
+    ):
+        self.name = name
+        self.instances = instances
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.queue: queue.Queue[_JobT | None] = queue.Queue(max_queue)  # None tells a worker to stop
+        self._threads = [
+            threading.Thread(target=self._run, args=(instance,), name=f"gpt4all-server-{name}-{i}", daemon=True)
+            for i, instance in enumerate(instances)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, job: _JobT) -> None:
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            raise _RequestError(
+                "The server is overloaded, please try again later.", 503, type="server_error",
+            ) from None
+
+    def close(self) -> None:
+        # the jobs already queued are handled first
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        for instance in self.instances:
+            instance.close()
+
+    def _run(self, instance: _ModelT) -> None:
+        stopping = False
+        while not stopping:
+            job = self.queue.get()
+            if job is None:
+                return
+            # take the jobs that arrive within batch_wait of the first
+            jobs = [job]
+            deadline = time.monotonic() + self.batch_wait
+            while len(jobs) < self.max_batch_size:
+                try:
+                    job = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                jobs.append(job)
+
+            jobs = [job for job in jobs if not job.cancelled]
+            try:
+                self._process(instance, jobs)
+            except Exception as e:
+                error = _RequestError(f"{type(e).__name__}: {e}", 500, type="server_error")
+                for job in jobs:
+                    job.events.put(("error", error))
+
+    @abstractmethod
+    def _process(self, instance: _ModelT, jobs: list[_JobT]) -> None:
+        ...
+
+
+class _CompletionPool(_WorkerPool[GPT4All, _CompletionJob]):
+    def __init__(
+        self, name: str, instances: list[GPT4All], max_queue: int, max_batch_size: int, batch_wait: float,
+        renderer: _ChatRenderer | None, sampling_kwargs: dict[str, Any],
+    ):
+        super().__init__(name, instances, max_queue, max_batch_size, batch_wait)
+        self.renderer = renderer
+        self.sampling_kwargs = sampling_kwargs
+        self.max_tokens = instances[0].model.n_ctx  # no completion can be longer than the context
+
+    def check(self, job: _CompletionJob) -> None:
+        if job.sampling.max_tokens > self.max_tokens:
+            raise _RequestError(
+                f"{job.sampling.max_tokens} is greater than the maximum of {self.max_tokens} - 'max_tokens'",
+                param="max_tokens",
+            )
+
+    def render(self, job: _CompletionJob) -> None:
+        # Apply the chat template to the messages of a chat request. Templates are rendered on the request's thread.
+        if self.renderer is None:
+            raise _RequestError(f"The model '{self.name}' does not support chat completions.", param="model")
+        try:
+            job.prompt = self.renderer.render(job.messages)
+        except Exception as e:
+            raise _RequestError(f"Failed to apply the chat template: {e}", param="messages") from None
+
+    def _process(self, instance: GPT4All, jobs: list[_CompletionJob]) -> None:
+        limit = instance.model.n_ctx - 4
+        groups: dict[_SamplingKey, list[_CompletionJob]] = {}
+        for job in jobs:
+            job.prompt_tokens = instance.count_prompt_tokens(job.prompt)
+            if job.prompt_tokens > limit:
+                job.events.put(("error", _RequestError(
+                    f"Your message was too long and could not be processed ({job.prompt_tokens} > {limit}).",
+                )))
+                continue
+            groups.setdefault(job.sampling, []).append(job)
+
+        for sampling, group in groups.items():
+            choices = [_Choice(job, i) for job in group for i in range(job.n)]
+            try:
+                result = instance.generate_batch(
+                    [choice.job.prompt for choice in choices],
+                    max_tokens = sampling.max_tokens,
+                    temp       = sampling.temperature,
+                    top_p      = sampling.top_p,
+                    min_p      = sampling.min_p,
+                    callback   = lambda index, token_id, response: choices[index].feed(response),
+                    **self.sampling_kwargs,
+                )
+            except Exception as e:
+                error = _RequestError(f"{type(e).__name__}: {e}", 500, type="server_error")
+                for job in group:
+                    job.events.put(("error", error))
+                continue
+            for choice, n_tokens in zip(choices, result["n_output_tokens"]):
+                choice.n_tokens = n_tokens
+                choice.finish()
+            for job in group:
+                job.events.put(("done", [choice for choice in choices if choice.job is job]))
+
+
+class _EmbeddingPool(_WorkerPool[Embed4All, _EmbeddingJob]):
+    def _process(self, instance: Embed4All, jobs: list[_EmbeddingJob]) -> None:
+        groups: dict[int | None, list[_EmbeddingJob]] = {}
+        for job in jobs:
+            groups.setdefault(job.dimensions, []).append(job)
+        for dimensions, group in groups.items():
+            self._embed(instance, dimensions, group)
+
+    def _embed(self, instance: Embed4All, dimensions: int | None, jobs: list[_EmbeddingJob]) -> None:
+        texts = [text for job in jobs for text in job.inputs]
+        try:
+            result = instance.embed(texts, dimensionality=dimensions, return_dict=True)
+        except ValueError as e:
+            if len(jobs) > 1:
+                # find out which request is at fault
+                for job in jobs:
+                    self._embed(instance, dimensions, [job])
+                return
+            jobs[0].events.put(("error", _RequestError(str(e))))
+            return
+
+        # The model only counts the tokens of the whole batch, which are attributed to each request in proportion to
+        # the length of its inputs
+        lengths = [sum(map(len, job.inputs)) for job in jobs]
+        total_length = sum(lengths) or 1
+        n_left = result["n_prompt_tokens"]
+        start = 0
+        for i, job in enumerate(jobs):
+            n_tokens = n_left if i == len(jobs) - 1 else result["n_prompt_tokens"] * lengths[i] // total_length
+            n_left -= n_tokens
+            embeddings = result["embeddings"][start:start + len(job.inputs)]
+            start += len(job.inputs)
+            job.events.put(("done", (embeddings, n_tokens)))
+
+
+def _model_info(name: str) -> dict[str, Any]:
+    return {
+        "id"         : name,
+        "object"     : "model",
+        "created"    : 0,
+        "owned_by"   : "humanity",
+        "root"       : name,
+        "parent"     : None,
+        "permissions": [{
+            "id"                  : "placeholder",
+            "object"              : "model_permission",
+            "created"             : 0,
+            "allow_create_engine" : False,
+            "allow_sampling"      : False,
+            "allow_logprobs"      : False,
+            "allow_search_indices": False,
+            "allow_view"          : True,
+            "allow_fine_tuning"   : False,
+            "organization"        : "*",
+            "group"               : None,
+            "is_blocking"         : False,
+        }],
+    }
+
+
+def _encode_embedding(embedding: list[float], encoding_format: str) -> Any:
+    if encoding_format == "float":
+        return embedding
+    data = array("f", embedding)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return base64.b64encode(data.tobytes()).decode("ascii")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: _HTTPServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if self.server.app.verbose:
+            super().log_message(format, *args)
+
+    def _endpoint(self) -> str | None:
+        path = urlsplit(self.path).path
+        return path[len("/v1/"):].rstrip("/") if path.startswith("/v1/") else None
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json") -> None:
+        self.send_response(status)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if body:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, obj: Any) -> None:
+        self._send(status, json.dumps(obj, ensure_ascii=False).encode())
+
+    def _send_error(self, error: _RequestError) -> None:
+        self._send_json(error.status, error.body())
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_GET(self) -> None:
+        app = self.server.app
+        endpoint = self._endpoint()
+        if endpoint == "models":
+            self._send_json(200, {"object": "list", "data": [_model_info(name) for name in app.model_names]})
+        elif endpoint is not None and endpoint.startswith("models/"):
+            name = app._resolve_name(unquote(endpoint[len("models/"):]))
+            self._send_json(200, {} if name is None else _model_info(name))
+        elif endpoint in _POST_ENDPOINTS:
+            self._send_error(_RequestError("Only POST requests are accepted.", 405, code="method_not_supported"))
+        else:
+            self._send(404, b"")
+
+    def do_POST(self) -> None:
+        body = self._read_body()  # read even if unused, so the connection can be reused
+        endpoint = self._endpoint()
+        if endpoint == "models" or (endpoint is not None and endpoint.startswith("models/")):
+            pattern = "/v1/models" if endpoint == "models" else "/v1/models/*"
+            self._send_error(_RequestError(
+                f"Not allowed to POST on {pattern}. (HINT: Perhaps you meant to use a different HTTP method?)", 405,
+            ))
+            return
+        if endpoint not in _POST_ENDPOINTS:
+            self._send(404, b"")
+            return
+
+        try:
+            try:
+                request = json.loads(body) if body else None
+            except ValueError as e:
+                raise _RequestError(f"error parsing request JSON: {e}") from None
+            if body and not isinstance(request, dict):
+                raise _RequestError("error parsing request JSON: not an object")
+            if request is None:
+                raise _RequestError("error parsing request JSON: illegal value")
+            if endpoint == "embeddings":
+                self._embeddings(request)
+            else:
+                self._completions(request, chat=endpoint == "chat/completions")
+        except _RequestError as e:
+            self._send_error(e)
+
+    def _completions(self, request: dict[str, Any], chat: bool) -> None:
+        job = _CompletionJob(request, chat)
+        pool = self.server.app._completion_pool(job.model)
+        pool.check(job)
+        if chat:
+            pool.render(job)
+        pool.submit(job)
+
+        completion_id = f"{'chatcmpl' if chat else 'cmpl'}-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        def response(choices: list[dict[str, Any]], chunk: bool) -> dict[str, Any]:
+            obj = "chat.completion" if chat else "text_completion"
+            return {
+                "id"     : completion_id,
+                "object" : obj + ".chunk" if chat and chunk else obj,
+                "created": created,
+                "model"  : pool.name,
+                "choices": choices,
+            }
+
+        def choice(index: int, text: str, finish_reason: str | None, delta: dict[str, str] | None = None) -> dict:
+            if not chat:
+                text = job.prompt + text if job.echo and not job.stream else text
+                return {"text": text, "index": index, "logprobs": None, "finish_reason": finish_reason}
+            if delta is not None:
+                return {"index": index, "delta": delta, "logprobs": None, "finish_reason": finish_reason}
+            message = {"role": "assistant", "content": text}
+            return {"index": index, "message": message, "logprobs": None, "finish_reason": finish_reason}
+
+        def usage(choices: list[_Choice]) -> dict[str, int]:
+            completion_tokens = sum(c.n_tokens for c in choices)
+            return {
+                "prompt_tokens"    : job.prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens"     : job.prompt_tokens + completion_tokens,
+            }
+
+        if not job.stream:
+            while (event := job.events.get())[0] == "text":
+                pass
+            if event[0] == "error":
+                raise event[1]
+            choices: list[_Choice] = event[1]
+            body = response([choice(c.index, c.text, c.finish_reason) for c in choices], chunk=False)
+            body["usage"] = usage(choices)
+            self._send_json(200, body)
+            return
+
+        # Wait for the first event, so that an error before anything is generated gets a normal response
+        event = job.events.get()
+        if event[0] == "error":
+            raise event[1]
+        self.send_response(200)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send(obj: Any) -> None:
+            self.wfile.write(f"data: {obj if isinstance(obj, str) else json.dumps(obj, ensure_ascii=False)}\n\n"
+                             .encode())
+            self.wfile.flush()
+
+        started: set[int] = set()
+        try:
+            if not chat and job.echo:
+                for index in range(job.n):
+                    send(response([choice(index, job.prompt, None)], chunk=True))
+            while True:
+                if event[0] == "error":
+                    send(event[1].body())
+                    break
+                if event[0] == "text":
+                    _, index, text = event
+                    delta = {"content": text}
+                    if chat and index not in started:
+                        delta = {"role": "assistant", **delta}
+                        started.add(index)
+                    send(response([choice(index, text, None, delta)], chunk=True))
+                else:
+                    choices = event[1]
+                    for c in choices:
+                        delta = {} if c.index in started else {"role": "assistant", "content": ""}
+                        send(response([choice(c.index, "", c.finish_reason, delta)], chunk=True))
+                    if job.include_usage:
+                        send({**response([], chunk=True), "usage": usage(choices)})
+                    send("[DONE]")
+                    break
+                event = job.events.get()
+        except (BrokenPipeError, ConnectionResetError):
+            job.cancelled = True
+
+    def _embeddings(self, request: dict[str, Any]) -> None:
+        job = _EmbeddingJob(request)
+        pool = self.server.app._embedding_pool(job.model)
+        pool.submit(job)
+        event = job.events.get()
+        if event[0] == "error":
+            raise event[1]
+        embeddings, n_tokens = event[1]
+        self._send_json(200, {
+            "object": "list",
+            "data"  : [
+                {"object": "embedding", "embedding": _encode_embedding(e, job.encoding_format), "index": i}
+                for i, e in enumerate(embeddings)
+            ],
+            "model" : pool.name,
+            "usage" : {"prompt_tokens": n_tokens, "total_tokens": n_tokens},
+        })
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], app: InferenceServer):
+        self.app = app
+        super().__init__(address, _Handler)
+
+
+class InferenceServer:
+    """
+    An OpenAI-compatible HTTP server for GPT4All completion, chat completion, and embedding models.
+
+    Requests for each model are queued and handled by a pool of workers. The workers of a model share one copy of its
+    weights and one context, so they generate one at a time; requests that arrive together are batched instead.
+    Requests are not authenticated; bind to a public address only behind a proxy that checks them.
+    """
+
+    def __init__(
+        self,
+        host           : str                   = "127.0.0.1",
+        port           : int                   = DEFAULT_PORT,
+        *,
+        max_queue      : int                   = 64,
+        max_batch_size : int                   = 8,
+        batch_wait     : float                 = 0.0,
+        registry       : ModelRegistry | None  = None,
+        verbose        : bool                  = False,
+    ):
+        """
+        Constructor. The server is bound to its address, but does not handle requests until `serve_forever` or
+        `start` is called.
+
+        Args:
+            host: The address to listen on.
+            port: The port to listen on, or 0 to pick a free one. See `address`.
+            max_queue: The maximum number of requests waiting for each model. Further requests are answered with
+                status 503 until there is room again.
+            max_batch_size: The maximum number of requests a worker handles at once.
+            batch_wait: How long, in seconds, a worker that took a request waits for more to handle with it. The
+                default of 0 takes only the requests that are already waiting, which adds no latency.
+            registry: The registry used to share the weights of each model between its workers. Default is None, in
+                which case the server has its own.
+            verbose: If True, log each request to stderr.
+        """
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+        self.max_queue = max_queue
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.registry = ModelRegistry() if registry is None else registry
+        self.verbose = verbose
+        self._completion_pools: dict[str, _CompletionPool] = {}
+        self._embedding_pools: dict[str, _EmbeddingPool] = {}
+        self._aliases: dict[str, str] = {}  # model file names to model names
+        self._httpd = _HTTPServer((host, port), self)
+        self._thread: threading.Thread | None = None
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self, typ: type[BaseException] | None, value: BaseException | None, tb: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    @property
+    def address(self) -> tuple[str, int]:
+        """The host and port the server listens on."""
+        host, port = self._httpd.server_address[:2]
+        return str(host), int(port)
+
+    @property
+    def model_names(self) -> list[str]:
+        """The names of the models served, as listed by `/v1/models`."""
+        return [*self._completion_pools, *self._embedding_pools]
+
+    def add_model(
+        self,
+        model_name     : str,
+        *,
+        name           : str | None = None,
+        n_workers      : int        = 1,
+        chat_template  : str | None = None,
+        top_k          : int        = 40,
+        repeat_penalty : float      = 1.18,
+        repeat_last_n  : int        = 64,
+        **kwargs       : Any,
+    ) -> str:
+        """
+        Serve a model for completions and chat completions.
+
+        Args:
+            model_name: The model to load, as for `GPT4All`.
+            name: The name of the model in requests. Default is None, in which case the name of the model in the
+                model list is used if known, or else the file name. Requests may use the file name in either case.
+            n_workers: The number of workers taking requests from the queue. They share the model's context and take
+                turns generating, swapping in their own state each time, so more than one rarely helps. Default is 1.
+            chat_template: Jinja template for chat completions, or None to use the model default. If there is none,
+                chat completions are not supported by this model.
+            top_k, repeat_penalty, repeat_last_n: Sampling settings that are not part of the OpenAI API, with the same
+                meaning as for `GPT4All.generate`.
+            kwargs: Remaining keyword arguments are passed to the `GPT4All` constructor.
+
+        Returns:
+            The name of the model in requests.
+        """
+        instances = self._load(GPT4All, model_name, n_workers, kwargs)
+        config = instances[0].config
+        renderer = None
+        if chat_template is None:
+            chat_template = config.get("chatTemplate")
+        if chat_template is not None:
+            renderer = _ChatRenderer(_jinja_env().from_string(chat_template), instances[0].model.special_tokens_map)
+        name = self._register(name, config)
+        self._completion_pools[name] = _CompletionPool(
+            name, instances, self.max_queue, self.max_batch_size, self.batch_wait, renderer,
+            dict(top_k=top_k, repeat_penalty=repeat_penalty, repeat_last_n=repeat_last_n),
+        )
+        return name
+
+    def add_embedding_model(
+        self, model_name: str | None = None, *, name: str | None = None, n_workers: int = 1, **kwargs: Any,
+    ) -> str:
+        """
+        Serve a model for embeddings.
+
+        Args:
+            model_name: The model to load, as for `Embed4All`.
+            name: The name of the model in requests. See `add_model`.
+            n_workers: The number of workers taking requests from the queue. They share the model and take turns using
+                it. Default is 1.
+            kwargs: Remaining keyword arguments are passed to the `Embed4All` constructor.
+
+        Returns:
+            The name of the model in requests.
+        """
+        instances = self._load(Embed4All, model_name, n_workers, kwargs)
+        name = self._register(name, instances[0].gpt4all.config)
+        self._embedding_pools[name] = _EmbeddingPool(
+            name, instances, self.max_queue, self.max_batch_size, self.batch_wait,
+        )
+        return name
+
+    def _load(
+        self, cls: Callable[..., _ModelT], model_name: str | None, n_workers: int, kwargs: dict[str, Any],
+    ) -> list[_ModelT]:
+        if n_workers < 1:
+            raise ValueError(f"n_workers must be at least 1, got {n_workers}")
+        # the instances share the weights and the context of the model loaded by the registry
+        kwargs.setdefault("registry", self.registry)
+        instances: list[_ModelT] = []
+        try:
+            for _ in range(n_workers):
+                instances.append(cls(model_name, **kwargs))
+        except:
+            for instance in instances:
+                instance.close()
+            raise
+        return instances
+
+    def _register(self, name: str | None, config: dict[str, Any]) -> str:
+        file_name = Path(config["path"]).name
+        if name is None:
+            name = config.get("name") or file_name
+        if self._resolve_name(name) is not None:
+            raise ValueError(f"A model named {name!r} is already being served")
+        self._aliases.setdefault(file_name, name)
+        return name
+
+    def _resolve_name(self, model: str) -> str | None:
+        # the name of a served model by its name or file name
+        if model in self._completion_pools or model in self._embedding_pools:
+            return model
+        return self._aliases.get(model)
+
+    def _completion_pool(self, model: str) -> _CompletionPool:
+        name = self._resolve_name(model)
+        if name is None or name not in self._completion_pools:
+            raise self._model_not_found(model, name)
+        return self._completion_pools[name]
+
+    def _embedding_pool(self, model: str) -> _EmbeddingPool:
+        name = self._resolve_name(model)
+        if name is None or name not in self._embedding_pools:
+            raise self._model_not_found(model, name)
+        return self._embedding_pools[name]
+
+    @staticmethod
+    def _model_not_found(model: str, name: str | None) -> _RequestError:
+        if name is None:
+            return _RequestError(f"The model '{model}' does not exist", 404, code="model_not_found", param="model")
+        return _RequestError(f"The model '{model}' does not support this endpoint", param="model")
+
+    def serve_forever(self) -> None:
+        """Handle requests until `shutdown` is called from another thread."""
+        self._httpd.serve_forever()
+
+    def start(self) -> None:
+        """Handle requests on a background thread until `shutdown` is called."""
+        if self._thread is not None:
+            raise RuntimeError("The server has already been started")
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="gpt4all-server", daemon=True)
+        self._thread.start()
+
+    def shutdown(self) -> None:
+        """Stop handling new requests. Requests already queued are still answered."""
+        self._httpd.shutdown()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self) -> None:
+        """Shut the server down, and unload its models once the queued requests are answered."""
+        if self._thread is not None:
+            self.shutdown()
+        self._httpd.server_close()
+        for pool in [*self._completion_pools.values(), *self._embedding_pools.values()]:
+            pool.close()
+        self._completion_pools.clear()
+        self._embedding_pools.clear()
+        self._aliases.clear()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m gpt4all.server", description="Serve GPT4All models with an OpenAI-compatible API.",
+    )
+    parser.add_argument("-m", "--model", action="append", default=[],
+                        help="a model to serve for completions and chat completions (repeatable)")
+    parser.add_argument("-e", "--embedding-model", action="append", default=[],
+                        help="a model to serve for embeddings (repeatable)")
+    parser.add_argument("--host", default="127.0.0.1", help="the address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="the port to listen on (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="the number of workers per model, which take turns using it (default: %(default)s)")
+    parser.add_argument("--max-queue", type=int, default=64,
+                        help="the maximum number of requests waiting for each model (default: %(default)s)")
+    parser.add_argument("--max-batch-size", type=int, default=8,
+                        help="the maximum number of requests a worker handles at once (default: %(default)s)")
+    parser.add_argument("--batch-wait", type=float, default=0.0,
+                        help="seconds a worker waits for more requests to batch with one (default: %(default)s)")
+    parser.add_argument("--model-path", help="the directory containing the model files")
+    parser.add_argument("--no-download", action="store_true", help="do not download missing models")
+    parser.add_argument("--device", help="the device to run the models on, as for GPT4All")
+    parser.add_argument("--n-ctx", type=int, default=2048,
+                        help="the context size of each worker (default: %(default)s)")
+    parser.add_argument("--ngl", type=int, default=100, help="the number of GPU layers (default: %(default)s)")
+    parser.add_argument("--n-threads", type=int, help="the number of CPU threads of each model")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log each request")
+    args = parser.parse_args(argv)
+    if not args.model and not args.embedding_model:
+        parser.error("at least one --model or --embedding-model is required")
+
+    kwargs = dict(
+        model_path=args.model_path, allow_download=not args.no_download, device=args.device, n_ctx=args.n_ctx,
+        ngl=args.ngl, n_threads=args.n_threads,
+    )
+    with InferenceServer(
+        args.host, args.port, max_queue=args.max_queue, max_batch_size=args.max_batch_size,
+        batch_wait=args.batch_wait, verbose=args.verbose,
+    ) as server:
+        for model in args.model:
+            server.add_model(model, n_workers=args.workers, **kwargs)
+        for model in args.embedding_model:
+            server.add_embedding_model(model, n_workers=args.workers, **kwargs)
+        host, port = server.address
+        print(f"Serving {', '.join(server.model_names)} on http://{host}:{port}/v1", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
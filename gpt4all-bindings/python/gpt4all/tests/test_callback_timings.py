@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import ctypes
+import statistics
+import time
+
+from gpt4all import _pyllmodel
+from gpt4all._pyllmodel import LLModel, LLModelPromptContext, PromptCallback, ResponseCallback
+
+
+class StubLibrary:
+    # Stands in for the native library, calling back with a fixed response as fast as ctypes allows, so that only the
+    # Python side of each token is measured
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def llmodel_model_create2(self, model_path, backend, error):
+        return 1
+
+    def llmodel_model_foreach_special_token(self, model, callback):
+        pass
+
+    def llmodel_model_destroy(self, model):
+        pass
+
+    def llmodel_prompt(self, model, prompt, prompt_callback, response_callback, context, error):
+        prompt_callback(None, 8, False)
+        for i, token in enumerate(self.tokens):
+            if not response_callback(i, token):
+                break
+        return True
+
+
+def legacy_generate(model):
+    # the previous path through GPT4All.generate and LLModel.prompt_model: new ctypes thunks for every call, and a
+    # wrapper that builds the response by string concatenation
+    full_response = ""
+
+    def _callback_wrapper(token_id, response):
+        nonlocal full_response
+        full_response += response
+        return True
+
+    def _prompt_callback(token_ids, n_token_ids, cached):
+        return True
+
+    context = LLModelPromptContext(n_predict=4096, top_k=40, top_p=0.9, temp=0.1, n_batch=8)
+    err = ctypes.c_char_p()
+    with model._use_context():
+        _pyllmodel.llmodel.llmodel_prompt(
+            model.model, ctypes.c_char_p(b'prompt'), PromptCallback(_prompt_callback),
+            ResponseCallback(LLModel._callback_decoder(_callback_wrapper)), context, ctypes.byref(err),
+        )
+    return full_response
+
+
+def ctypes_generate(model):
+    # thunks that do nothing, for the cost of ctypes itself
+    _pyllmodel.llmodel.llmodel_prompt(model.model, None, _noop_prompt_thunk, _noop_response_thunk, None, None)
+
+
+_noop_prompt_thunk = PromptCallback(lambda token_ids, n_token_ids, cached: True)
+_noop_response_thunk = ResponseCallback(lambda token_id, response: True)
+
+
+def current_generate(model):
+    pieces = []
+    model.prompt_model('prompt', _pyllmodel.empty_response_callback, output=pieces)
+    return ''.join(pieces)
+
+
+GENERATES = [("ctypes", ctypes_generate), ("legacy", legacy_generate), ("current", current_generate)]
+
+
+def time_calls(n_tokens, number, rounds):
+    # Times number calls of each implementation in turn, rounds times, so that changes in the machine's load affect
+    # all of them alike. Returns the time of each call, in seconds, for each round.
+    _pyllmodel.llmodel = StubLibrary([b' tok'] * n_tokens)
+    model = LLModel('stub', n_ctx=2048, ngl=0, backend='cpu')
+    times = {name: [] for name, _ in GENERATES}
+    for _ in range(rounds):
+        for name, generate in GENERATES:
+            start = time.perf_counter()
+            for _ in range(number):
+                generate(model)
+            times[name].append((time.perf_counter() - start) / number)
+    return times
+
+
+if __name__ == "__main__":
+    for n_tokens, number, rounds in [(1, 1000, 100), (4097, 10, 50)]:
+        times = time_calls(n_tokens, number, rounds)
+        print(f"{n_tokens} tokens per call, {number * rounds} calls each:")
+        for name, call_times in times.items():
+            print(f"{name:>8}: median {statistics.median(call_times) * 1e6:9.2f} us/call, "
+                  f"min {min(call_times) * 1e6:9.2f} us/call, max {max(call_times) * 1e6:9.2f} us/call")
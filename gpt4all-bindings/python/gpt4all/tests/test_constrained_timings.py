@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import time
+
+from gpt4all import GPT4All, SchemaValidationError, validate_json
+
+SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string'},
+        'city': {'type': 'string'},
+        'age': {'type': 'integer', 'minimum': 0},
+    },
+    'required': ['name', 'city', 'age'],
+}
+
+TEXTS = [
+    "Maria Lopez, 34, moved to Madrid last spring to start a bakery.",
+    "The new intern is called Tom Becker. He is 22 and lives in Hamburg.",
+    "At 67, retired teacher Akira Sato still walks around Kyoto every morning.",
+    "Priya, who just turned 29, works remotely from her flat in Bangalore.",
+    "Our oldest customer, Jean Dupont from Lyon, celebrated his 91st birthday.",
+]
+
+MAX_ATTEMPTS = 3
+
+
+def extract(model, text, **kwargs):
+    # Returns whether a valid document was extracted, and the number of tokens generated, including failed attempts
+    prompt = f"Extract the person's name, city and age from this text as a JSON object.\n\n{text}\n\nJSON:"
+    attempts = 1 if kwargs else MAX_ATTEMPTS
+    n_tokens = 0
+    for _ in range(attempts):
+        output, stats = model.generate(prompt, max_tokens=128, temp=0.7, return_stats=True, **kwargs)
+        n_tokens += stats['n_generated_tokens']
+        try:
+            validate_json(output, SCHEMA)
+        except SchemaValidationError:
+            continue
+        return True, n_tokens
+    return False, n_tokens
+
+
+def time_extraction(name, model, **kwargs):
+    start_time = time.time()
+    results = [extract(model, text, **kwargs) for text in TEXTS]
+    elapsed_time = time.time() - start_time
+    n_valid = sum(ok for ok, _ in results)
+    n_tokens = sum(n for _, n in results)
+    print(f"{name:>13}: {n_valid}/{len(TEXTS)} valid, {n_tokens / len(TEXTS):6.1f} tokens/extraction, "
+          f"{elapsed_time / len(TEXTS):6.2f} seconds/extraction")
+
+
+if __name__ == "__main__":
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf', n_threads=8)
+    time_extraction("retry loop", model)
+    time_extraction("json_schema", model, json_schema=SCHEMA)
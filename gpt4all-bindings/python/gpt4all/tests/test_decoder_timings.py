@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import timeit
+
+from gpt4all._pyllmodel import LLModel
+
+
+def legacy_callback_decoder(callback):
+    # the previous per-byte implementation of LLModel._callback_decoder, for comparison
+    buffer = bytearray()
+    expecting_cont_bytes = 0
+
+    def _raw_callback(token_id, response):
+        nonlocal expecting_cont_bytes
+        decoded = []
+        for byte in response:
+            bits = "{:08b}".format(byte)
+            (high_ones, _, _) = bits.partition('0')
+            if len(high_ones) == 1:
+                buffer.append(byte)
+                expecting_cont_bytes -= 1
+            else:
+                if len(buffer) > 0:
+                    decoded.append(buffer.decode(errors='replace'))
+                    buffer.clear()
+                buffer.append(byte)
+                expecting_cont_bytes = max(0, len(high_ones) - 1)
+            if expecting_cont_bytes <= 0:
+                decoded.append(buffer.decode(errors='replace'))
+                buffer.clear()
+                expecting_cont_bytes = 0
+        if len(decoded) == 0 and expecting_cont_bytes > 0:
+            return True
+        return callback(token_id, ''.join(decoded))
+
+    return _raw_callback
+
+
+def split_tokens(text, token_size):
+    data = text.encode()
+    return [data[i:i + token_size] for i in range(0, len(data), token_size)]
+
+
+def time_decoder(name, make_decoder, tokens, number=20):
+    def run():
+        decoder = make_decoder(lambda token_id, response: True)
+        for i, token in enumerate(tokens):
+            decoder(i, token)
+
+    elapsed = min(timeit.repeat(run, number=number, repeat=5)) / number
+    print(f"{name:>8}: {elapsed / len(tokens) * 1e9:8.1f} ns/token")
+
+
+if __name__ == "__main__":
+    workloads = {
+        "ascii": split_tokens("The quick brown fox jumps over the lazy dog. " * 2000, 4),
+        "cjk": split_tokens("敏捷的棕色狐狸跳过了懒狗。" * 2000, 4),  # most tokens split a character
+        "emoji": split_tokens("hello 👋🏽 world 🌍 " * 2000, 3),
+    }
+    for workload, tokens in workloads.items():
+        print(f"{workload} ({len(tokens)} tokens)")
+        time_decoder("legacy", legacy_callback_decoder, tokens)
+        time_decoder("current", LLModel._callback_decoder, tokens)
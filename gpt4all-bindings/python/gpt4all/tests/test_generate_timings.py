@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+from gpt4all import GPT4All
+
+
+def time_generation(i, model):
+    prompt = 'foo bar ' * i
+    _, stats = model.generate(prompt, max_tokens=64, temp=0, return_stats=True)
+    assert stats['n_prompt_tokens'] >= i and 0 < stats['n_generated_tokens'] <= 64
+    assert stats['time_to_first_token'] is not None and 0 < stats['time_to_first_token'] <= stats['total_time']
+    assert stats['prompt_tokens_per_second'] > 0 and stats['decode_tokens_per_second'] >= 0
+    print(f"Time report: {stats['n_prompt_tokens']} prompt tokens ({stats['n_cached_tokens']} cached), "
+          f"TTFT {stats['time_to_first_token']:.3f}s, {stats['prompt_tokens_per_second']:.1f} prompt tokens/second, "
+          f"{stats['decode_tokens_per_second']:.1f} generated tokens/second, {stats['total_time']:.3f}s total")
+
+
+if __name__ == "__main__":
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf', n_threads=8)
+    for i in [2**n for n in range(4, 10)]:
+        time_generation(i, model)
@@ -1,8 +1,21 @@
+import asyncio
+import hashlib
+import json
+import os
+import subprocess
 import sys
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import StringIO
 from pathlib import Path
 
-from gpt4all import GPT4All, Embed4All
+from gpt4all import (DeadlineExceededError, GPT4All, Embed4All, Embed4AllPool, EmbeddingCache, KeepLastTurns,
+                     ModelRegistry, PrefixCache, Scheduler, SchemaValidationError, SlidingWindow, SummarizeOlderTurns,
+                     TokenLogprobs, json_schema_to_grammar, validate_json)
+from gpt4all import _download
+from gpt4all._pyllmodel import LLModel
+from gpt4all._speculative import _ResponseEmitter
 import time
 import pytest
 
@@ -95,6 +108,406 @@ def test_inference_mpt():
     assert len(output) > 0
 
 
+def test_save_restore_state():
+    model = GPT4All(model_name='orca-mini-3b-gguf2-q4_0.gguf')
+    model.generate('The capital of france is ', max_tokens=1, temp=0)
+    state = model.save_state()
+    assert len(state.model_state.data) > 0
+    assert len(state.model_state.input_tokens) > 0
+    assert state.history is None
+
+    output_1 = model.generate(' and the capital of germany is ', max_tokens=3, temp=0)
+    model.generate('something unrelated', max_tokens=3, temp=0)
+    model.restore_state(state)
+    output_2 = model.generate(' and the capital of germany is ', max_tokens=3, temp=0)
+    assert output_1 == output_2
+
+    with model.chat_session():
+        model.generate('hello', max_tokens=3, temp=0)
+        state = model.save_state()
+        model.generate('write me a short poem', max_tokens=3, temp=0)
+        model.restore_state(state)
+        assert model.current_chat_session == state.history
+
+    with pytest.raises(ValueError):
+        model.restore_state(state)
+
+
+def test_prefix_cache(tmp_path: Path):
+    cache = PrefixCache(tmp_path, max_bytes=2**30)
+    model = GPT4All(model_name='orca-mini-3b-gguf2-q4_0.gguf', prefix_cache=cache)
+    system_message = 'You are a helpful assistant. ' * 20
+
+    with model.chat_session(system_message):
+        output_1 = model.generate('hello', max_tokens=5, temp=0)
+    assert len(list(tmp_path.glob('*.state'))) == 1
+
+    # a new instance should find the cached prefix and produce the same output
+    model = GPT4All(model_name='orca-mini-3b-gguf2-q4_0.gguf', prefix_cache=cache)
+    with model.chat_session(system_message):
+        output_2 = model.generate('hello', max_tokens=5, temp=0)
+    assert output_1 == output_2
+    assert len(list(tmp_path.glob('*.state'))) == 1
+
+
+def test_model_registry():
+    registry = ModelRegistry(max_idle_bytes=2**40)
+    model_1 = GPT4All('orca-mini-3b-gguf2-q4_0.gguf', registry=registry)
+    model_2 = GPT4All('orca-mini-3b-gguf2-q4_0.gguf', registry=registry)
+    assert registry.n_loaded == 1
+
+    reference = GPT4All('orca-mini-3b-gguf2-q4_0.gguf')
+    with reference.chat_session():
+        reference.generate('hello', max_tokens=8, top_k=1)
+        expected = reference.generate('thank you', max_tokens=8, top_k=1)
+    reference.close()
+
+    # each instance keeps its own context state
+    with model_1.chat_session(), model_2.chat_session():
+        model_1.generate('hello', max_tokens=8, top_k=1)
+        model_2.generate('write me a short poem', max_tokens=8, top_k=1)
+        assert model_1.generate('thank you', max_tokens=8, top_k=1) == expected
+
+    model_1.close()
+    model_2.close()
+    assert registry.n_loaded == 1  # idle, but within budget
+    registry.clear()
+    assert registry.n_loaded == 0
+
+
+def test_incremental_chat_rendering():
+    from gpt4all.gpt4all import _ChatRenderer, _jinja_env
+
+    chatml = (
+        '{{ bos_token }}{% for m in messages %}<|im_start|>{{ m.role }}\n{{ m.content }}<|im_end|>\n{% endfor %}'
+        '{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}'
+    )
+    # not append-only: the system message is merged into the last user message
+    merged = (
+        '{% for m in messages %}{% if m.role == "user" %}[INST] {% if loop.last %}{{ messages[0].content }} '
+        '{% endif %}{{ m.content }} [/INST]{% elif m.role == "assistant" %}{{ m.content }}{% endif %}{% endfor %}'
+    )
+    for template, incremental in [(chatml, True), (merged, False)]:
+        renderer = _ChatRenderer(_jinja_env().from_string(template), {'bos_token': '<s>'})
+        history = [{'role': 'system', 'content': 'be brief'}]
+        for i in range(4):
+            history.append({'role': 'user', 'content': f'question {i}'})
+            prompt, _ = renderer.render_prompt(history)
+            assert prompt == renderer.render(history)
+            history.append({'role': 'assistant', 'content': f'answer {i}'})
+        assert renderer.incremental == incremental
+
+        # editing the history is detected
+        history[1]['content'] = 'edited'
+        history.append({'role': 'user', 'content': 'question 4'})
+        assert renderer.render_prompt(history)[0] == renderer.render(history)
+
+
+def test_tokenize():
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf')
+    tokens = model.tokenize('hello world')
+    assert model.detokenize(tokens).endswith('hello world')
+    assert model.count_prompt_tokens('hello world') == len(tokens)
+    n_hi = len(model.tokenize('hi'))
+    assert model.count_prompt_tokens_batch(['hello world', 'hi', 'hello world']) == [len(tokens), n_hi, len(tokens)]
+
+
+def test_prompt_tokens():
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf')
+    prompt = 'The capital of France is'
+    expected = model.generate(prompt, max_tokens=16, temp=0)
+    assert model.generate(prompt_tokens=model.tokenize(prompt), max_tokens=16, temp=0) == expected
+    assert model.generate(prompt_tokens=list(model.tokenize(prompt)), max_tokens=16, temp=0) == expected
+
+    with pytest.raises(ValueError):
+        model.generate(prompt, prompt_tokens=model.tokenize(prompt))
+    with model.chat_session(), pytest.raises(ValueError):
+        model.generate(prompt_tokens=model.tokenize(prompt))
+
+
+def test_speculative_decoding():
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf')
+    # a copy of the same model agrees with almost every token, which exercises the acceptance path
+    draft = GPT4All('orca-mini-3b-gguf2-q4_0.gguf', n_ctx=512)
+    expected = model.generate('The capital of France is', max_tokens=32, temp=0)
+    output = model.generate('The capital of France is', max_tokens=32, temp=0, draft_model=draft, n_draft=4)
+    assert output == expected
+    stats = model.speculative_stats
+    assert stats is not None and stats.n_drafted > 0
+    assert stats.acceptance_rate > 0.5
+
+    tokens = list(model.generate('The capital of France is', max_tokens=32, temp=0, draft_model=draft,
+                                 streaming=True))
+    assert ''.join(tokens) == expected
+
+
+def test_response_emitter():
+    # a stand-in for the model, where tokens 3 and 4 are special tokens
+    class StubModel:
+        pieces = {1: b'Hello', 2: b' ###', 3: b'###', 4: b'<|im_end|>', 5: b' Response'}
+
+        def detokenize_bytes(self, tokens):
+            return b''.join(self.pieces[t] for t in tokens)
+
+        def is_special_token(self, token):
+            return token in (3, 4)
+
+    def emit_all(tokens):
+        sent = []
+        emit = _ResponseEmitter(StubModel(), lambda token_id, piece: sent.append(piece) or True, 100)
+        for token in tokens:
+            if not emit(token, False):
+                break
+        return b''.join(sent)
+
+    assert emit_all([1, 2]) == b'Hello'  # the start of a stop sequence is held back
+    assert emit_all([1, 4, 1]) == b'Hello'  # a special token that is a stop sequence stops
+    # special tokens are not checked for stop sequences together with the text around them, like in the backend
+    assert emit_all([1, 3]) == b'Hello###'
+    assert emit_all([2, 3, 5]) == b' ###### Response'
+
+    # token-level generation stops the same way as prompt_model
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf')
+    for prompt in ['The capital of France is', '### Instruction:\nSay hello.\n### Response:\n']:
+        expected = []
+        output = []
+        model.model.prompt_model(prompt, lambda token_id, response: True, n_predict=32, temp=0.0, output=expected)
+        model.model.prompt_model(prompt, lambda token_id, response: True, n_predict=32, temp=0.0, output=output,
+                                 logprobs=TokenLogprobs())
+        assert ''.join(output) == ''.join(expected)
+
+
+def test_generate_n():
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf')
+    expected = model.generate('The capital of France is', max_tokens=10, temp=0)
+
+    # greedy samples are all the same as a single completion
+    completions = model.generate('The capital of France is', max_tokens=10, temp=0, n=3)
+    assert [c['text'] for c in completions] == [expected] * 3
+    assert 0 < completions[0]['n_tokens'] <= 10 and completions[0]['logprob'] < 0
+    assert completions[1]['logprob'] == pytest.approx(completions[0]['logprob'], rel=1e-3)
+
+    completions, stats = model.generate('The capital of France is', max_tokens=10, temp=1.0, n=4, return_stats=True)
+    assert len(completions) == 4 and all(c['logprob'] <= 0 for c in completions)
+    assert stats['n_generated_tokens'] == sum(c['n_tokens'] for c in completions)
+
+    with pytest.raises(ValueError):
+        model.generate('The capital of France is', n=2, streaming=True)
+
+
+def test_logprobs():
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf')
+    expected = model.generate('The capital of France is', max_tokens=10, temp=0)
+
+    logprobs = TokenLogprobs(top_n=3)
+    assert model.generate('The capital of France is', max_tokens=10, temp=0, logprobs=logprobs) == expected
+    assert len(logprobs) > 0 and len(logprobs.top_token_ids) == len(logprobs.top_logprobs) == 3 * len(logprobs)
+    # greedy decoding picks the most likely token each time
+    for i, token_id in enumerate(logprobs.token_ids):
+        (top_id, top_logprob), *_ = logprobs.top(i)
+        assert top_id == token_id and top_logprob == pytest.approx(logprobs.logprobs[i])
+    assert logprobs.perplexity >= 1.0
+
+    # the callback sees each token's logprob, and can stop when the model is unsure
+    unsure = TokenLogprobs()
+    model.generate('The capital of France is', max_tokens=10, temp=0, logprobs=unsure,
+                   callback=lambda token_id, response: unsure.logprobs[-1] > 0)
+    assert len(unsure) == 1
+
+    assert model.score('The capital of France is Paris.').perplexity < \
+        model.score('Paris capital is The France of.').perplexity
+    scored = model.score(' Paris.', prompt='The capital of France is', top_n=2)
+    assert 0 < len(scored) < 5 and len(scored.top(0)) == 2
+
+
+def test_generation_stats():
+    reported = []
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf', metrics_hook=reported.append)
+    output, stats = model.generate('The capital of France is', max_tokens=8, temp=0, return_stats=True)
+    assert output and 0 < stats['n_generated_tokens'] <= 8
+    assert stats['n_prompt_tokens'] > 0 and stats['time_to_first_token'] is not None
+    assert stats['total_time'] >= stats['time_to_first_token']
+    assert reported == [stats]
+
+    # the same prompt again is mostly reused from the context
+    _, stats = model.generate('The capital of France is', max_tokens=8, temp=0, return_stats=True)
+    assert stats['n_cached_tokens'] > 0
+
+    list(model.generate('The capital of France is', max_tokens=8, streaming=True))
+    assert len(reported) == 3
+
+    # a stream closed early is reported when it is closed
+    tokens = model.generate('The capital of France is', max_tokens=8, streaming=True)
+    next(tokens)
+    tokens.close()
+    assert len(reported) == 4 and reported[-1]['n_generated_tokens'] >= 1
+
+    result = model.generate_batch(['The capital of France is', 'The capital of Spain is'], max_tokens=8, temp=0)
+    assert len(reported) == 6
+    assert sum(stats['n_generated_tokens'] for stats in reported[-2:]) == result['n_generated_tokens']
+    with pytest.raises(ValueError):
+        model.generate('hi', streaming=True, return_stats=True)
+
+
+PERSON_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string'},
+        'age': {'type': 'integer', 'minimum': 0},
+        'languages': {'type': 'array', 'items': {'type': 'string'}, 'maxItems': 3},
+    },
+    'required': ['name', 'age'],
+}
+
+
+def test_json_schema_grammar():
+    grammar = json_schema_to_grammar(PERSON_SCHEMA)
+    assert grammar.startswith('root ::= "{" space root-name-kv "," space root-age-kv ("," space root-languages-kv)?')
+    languages = 'root-languages ::= "[" space (root-languages-item ("," space root-languages-item){0,2})? "]" space'
+    assert languages in grammar
+    with pytest.raises(ValueError):
+        json_schema_to_grammar({'allOf': [{'type': 'string'}]})
+
+    assert validate_json('{"name": "Ada", "age": 36}', PERSON_SCHEMA) == {'name': 'Ada', 'age': 36}
+    invalid = [
+        ('{"name": "Ada"', '$'),
+        ('{"name": "Ada"}', '$'),
+        ('{"name": "Ada", "age": true}', '$.age'),
+        ('{"name": "Ada", "age": -1}', '$.age'),
+        ('{"name": "Ada", "age": 1, "languages": [1]}', '$.languages[0]'),
+    ]
+    for text, path in invalid:
+        with pytest.raises(SchemaValidationError) as excinfo:
+            validate_json(text, PERSON_SCHEMA)
+        assert excinfo.value.path == path
+
+    # multiples are checked on the decimal numbers, not on the nearest floats
+    assert validate_json('0.3', {'type': 'number', 'multipleOf': 0.1}) == 0.3
+    with pytest.raises(SchemaValidationError):
+        validate_json('0.35', {'type': 'number', 'multipleOf': 0.1})
+
+
+def test_constrained_generation():
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf')
+    output = model.generate('Describe a person as JSON.', json_schema=PERSON_SCHEMA, max_tokens=100, temp=0)
+    person = validate_json(output, PERSON_SCHEMA)
+    assert isinstance(person['name'], str)
+
+    output = model.generate('Is the sky blue? Answer yes or no.', grammar='root ::= "yes" | "no"', max_tokens=10)
+    assert output in ('yes', 'no')
+
+
+def test_history_policy():
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf', n_ctx=512)
+    with model.chat_session(system_message='You are a helpful assistant.', history_policy=SlidingWindow()):
+        for i in range(16):
+            model.generate(f'tell me a fact about the number {i}', max_tokens=32, top_k=1)
+        history = model.current_chat_session
+        assert len(history) < 33
+        assert history[0]['role'] == 'system'
+        assert history[1]['role'] == 'user'
+        assert history[-2]['content'] == 'tell me a fact about the number 15'
+
+    def n_tokens(msg):
+        return len(msg['content'].split())
+
+    system = {'role': 'system', 'content': 'be brief'}
+    turns = [{'role': 'user', 'content': 'q ' * 4}, {'role': 'assistant', 'content': 'r ' * 6}]
+    new = {'role': 'user', 'content': 'new'}
+    messages = [system, *turns * 5, new]
+    assert SlidingWindow().trim(messages, n_tokens, 40) == [system, *turns, new]
+    assert SlidingWindow(target=1).trim(messages, n_tokens, 40) == [system, *turns * 3, new]
+    assert KeepLastTurns(4).trim(messages, n_tokens, 1000) == [system, *turns * 3, new]
+    assert KeepLastTurns(4).trim(messages, n_tokens, 22) == [system, *turns, new]
+
+    summaries = []
+    def summarize(msgs):
+        summaries.append(msgs)
+        return f'{len(msgs)} messages'
+
+    policy = SummarizeOlderTurns(summarize)
+    trimmed = policy.trim(messages, n_tokens, 40)
+    assert trimmed[0]['content'] == 'be brief\n\nSummary of the earlier conversation:\n8 messages'
+    assert trimmed[1:] == [*turns, new]
+    # the previous summary is summarized along with the turns dropped next
+    trimmed = policy.trim([*trimmed[:-1], *turns * 3, new], n_tokens, 40)
+    assert summaries[-1][0] == {'role': 'system', 'content': '8 messages'}
+    assert trimmed[0]['content'].endswith('\n7 messages')
+    assert trimmed[1:] == [*turns, new]
+
+
+def test_generate_batch():
+    model = GPT4All(model_name='orca-mini-3b-gguf2-q4_0.gguf')
+    prompts = ['The capital of france is ', 'The capital of germany is ', 'The capital of france is ']
+    result = model.generate_batch(prompts, max_tokens=3, temp=0)
+
+    assert len(result['outputs']) == 3
+    assert 'Paris' in result['outputs'][0]
+    assert result['outputs'][0] == result['outputs'][2]
+    assert result['outputs'][1] == model.generate(prompts[1], max_tokens=3, temp=0)
+    assert result['n_generated_tokens'] > 0
+    assert sum(result['n_output_tokens']) == result['n_generated_tokens']
+    assert all(0 < n <= 3 for n in result['n_output_tokens'])
+    assert result['tokens_per_second'] > 0
+
+
+def test_agenerate():
+    model = GPT4All(model_name='orca-mini-3b-gguf2-q4_0.gguf')
+
+    async def collect(prompt, limit=None):
+        tokens = []
+        async for token in model.agenerate(prompt, max_tokens=10, temp=0):
+            tokens.append(token)
+            if len(tokens) == limit:
+                break
+        return tokens
+
+    async def main():
+        tokens = await collect('The capital of france is ')
+        assert ''.join(tokens) == model.generate('The capital of france is ', max_tokens=10, temp=0)
+
+        # abandoning one stream must not block the next
+        assert len(await collect('hello', limit=2)) == 2
+        results = await asyncio.gather(collect('hello'), collect('hello'))
+        assert results[0] == results[1]
+
+        # concurrent calls in a chat session each see the reply to the one before
+        with model.chat_session(system_message=False):
+            await asyncio.gather(collect('hello'), collect('hi'))
+            assert [msg['role'] for msg in model.current_chat_session] == ['user', 'assistant'] * 2
+
+    asyncio.run(main())
+
+
+def test_close_on_worker():
+    # the last reference to a model may be dropped by a prompt running on its own worker thread
+    model = GPT4All(model_name='orca-mini-3b-gguf2-q4_0.gguf')
+    model.model._worker.submit(model.model.close).result()
+    assert model.model.model is None
+
+    # or by a callback of a prompt that is still running on it, which stops the prompt
+    model = GPT4All(model_name='orca-mini-3b-gguf2-q4_0.gguf')
+    llmodel = model.model
+    tokens = list(llmodel.prompt_model_streaming('hello', lambda token_id, response: llmodel.close() or True))
+    assert llmodel.model is None
+    assert len(tokens) == 1
+
+
+def test_callback_decoder():
+    responses = []
+    decoder = LLModel._callback_decoder(lambda token_id, response: responses.append(response) or True)
+
+    # a multibyte character split across tokens is sent once it is complete
+    for i, token in enumerate([b'a\xe6', b'\x95', b'\x8f', b'b', b'\xf0\x9f', b'\x91\x8bc']):
+        decoder(i, token)
+    assert responses == ['a', '\u654f', 'b', '\U0001f44bc']
+
+    # invalid bytes are replaced
+    responses.clear()
+    decoder(0, b'\x80d')
+    assert responses == ['\ufffdd']
+
+
 def test_embedding():
     text = 'The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox jumps over the lazy dog The quick brown fox'
     embedder = Embed4All()
@@ -104,6 +517,75 @@ def test_embedding():
     assert len(output) == 384
 
 
+def test_embedding_array():
+    import numpy as np
+
+    embedder = Embed4All()
+    texts = ['The quick brown fox', 'jumps over the lazy dog', 'hello']
+    output = embedder.embed_array(texts)
+    assert output.shape == (3, 384)
+    assert output.dtype == np.float32
+    assert output.flags.c_contiguous
+    assert np.allclose(output, embedder.embed(texts), atol=1e-6)
+    assert embedder.embed_array(texts[0]).shape == (384,)
+
+
+def test_embedding_iter(tmp_path: Path):
+    import numpy as np
+
+    embedder = Embed4All()
+    texts = [f'document number {i}' for i in range(10)]
+    output_path = tmp_path / 'embeddings.npy'
+    blocks = list(embedder.embed_iter(iter(texts), batch_size=4, output_path=output_path))
+
+    assert [index for index, _ in blocks] == [0, 4, 8]
+    embeddings = np.concatenate([block for _, block in blocks])
+    assert embeddings.shape == (10, 384)
+    assert np.allclose(embeddings, embedder.embed_array(texts), atol=1e-6)
+    assert np.array_equal(np.load(output_path, mmap_mode='r'), embeddings)
+
+    # a failure partway through leaves no file behind
+    def failing_texts():
+        yield from texts
+        raise RuntimeError('source failed')
+
+    partial_path = tmp_path / 'partial.npy'
+    with pytest.raises(RuntimeError):
+        list(embedder.embed_iter(failing_texts(), batch_size=4, output_path=partial_path))
+    assert list(tmp_path.iterdir()) == [output_path]
+
+
+def test_embedding_cache(tmp_path: Path):
+    texts = ['first document', 'second document', 'first document']
+    expected = Embed4All().embed(texts)
+
+    cache = EmbeddingCache(tmp_path / 'embeddings.db')
+    embedder = Embed4All(cache=cache)
+    assert embedder.embed(texts) == expected
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    result = embedder.embed(texts[:2] + ['third document'], return_dict=True)
+    assert result['embeddings'][:2] == expected[:2]
+    assert (cache.hits, cache.misses) == (2, 3)
+
+    # the persistent tier survives a new cache instance
+    cache = EmbeddingCache(tmp_path / 'embeddings.db', max_memory_entries=0)
+    result = Embed4All(cache=cache).embed(texts, return_dict=True)
+    assert result == {'embeddings': expected, 'n_prompt_tokens': 0}
+    assert (cache.hits, cache.misses) == (2, 0)
+
+
+def test_embedding_pool():
+    texts = [f'document number {i}' for i in range(10)]
+    expected = Embed4All().embed(texts)
+
+    with Embed4AllPool(processes=2, threads_per_process=1, batch_size=3) as pool:
+        embeddings = pool.embed(texts)
+        assert len(embeddings) == len(texts)
+        for output, reference in zip(embeddings, expected):
+            assert output == pytest.approx(reference, abs=1e-6)
+
+
 def test_empty_embedding():
     text = ''
     embedder = Embed4All()
@@ -121,3 +603,258 @@ def test_download_model(tmp_path: Path):
         assert model_path.stat().st_size == int(model.config['filesize'])
     finally:
         gpt4all.DEFAULT_MODEL_DIRECTORY = old_default_dir
+
+
+@contextmanager
+def serve_bytes(data: bytes):
+    # a local HTTP server with range and conditional request support, which records the requests it receives
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            server.n_requests += 1
+            if self.headers.get('If-None-Match') == '"test"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            start, end = 0, len(data) - 1
+            if (header := self.headers.get('Range')) is not None:
+                first, _, last = header[len('bytes='):].partition('-')
+                start, end = int(first), int(last)
+                server.ranges.append(start)
+            if start >= server.fail_from:
+                self.send_error(500)
+                return
+            self.send_response(206 if header is not None else 200)
+            if header is not None:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('ETag', '"test"')
+            self.end_headers()
+            self.wfile.write(data[start:end + 1])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.ranges = []
+    server.n_requests = 0
+    server.fail_from = len(data)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server, f'http://127.0.0.1:{server.server_address[1]}/model.gguf'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_download_model_segmented(tmp_path: Path, monkeypatch):
+    data = os.urandom(5 * 2**20 + 123)
+    monkeypatch.setattr(_download, '_SEGMENT_SIZE', 2**20)
+    with serve_bytes(data) as (server, url):
+        path = GPT4All.download_model(
+            'model.gguf', tmp_path, url=url, expected_size=len(data), expected_md5=hashlib.md5(data).hexdigest(),
+        )
+    assert Path(path).read_bytes() == data
+    assert sorted(server.ranges) == [0] + [i * 2**20 for i in range(6)]  # the probe, then each segment
+    assert sorted(os.listdir(tmp_path)) == ['model.gguf']
+
+
+def test_download_resume(tmp_path: Path):
+    data = os.urandom(6 * 2**20)
+    segment_size = 2**20
+    partial_path = tmp_path / 'model.gguf.part'
+    with serve_bytes(data) as (server, url):
+        remote = _download.probe_range_support(url)
+        assert remote == (len(data), '"test"')
+
+        # interrupt the download by failing the requests for the later segments
+        server.fail_from = 3 * segment_size
+        with pytest.raises(ValueError):
+            _download.download_segmented(url, partial_path, remote, 2, segment_size=segment_size)
+        assert (tmp_path / 'model.gguf.part.json').exists()
+
+        server.fail_from = len(data)
+        server.ranges.clear()
+        _download.download_segmented(
+            url, partial_path, remote, 2, expected_md5=hashlib.md5(data).hexdigest(), segment_size=segment_size,
+        )
+    assert all(start >= 3 * segment_size for start in server.ranges)
+    assert partial_path.read_bytes() == data
+    assert not (tmp_path / 'model.gguf.part.json').exists()
+
+
+def test_list_models_cache(tmp_path: Path, monkeypatch):
+    from gpt4all import gpt4all
+    models = [{'filename': 'model.gguf', 'name': 'Test Model', 'md5sum': 'abc'}]
+    (tmp_path / 'model.gguf').write_bytes(b'')
+    monkeypatch.setattr(gpt4all, 'DEFAULT_MODEL_DIRECTORY', tmp_path)
+    with serve_bytes(json.dumps(models).encode()) as (server, url):
+        monkeypatch.setattr(gpt4all, 'MODEL_LIST_URL', url)
+
+        assert GPT4All.list_models() == models
+        assert GPT4All.list_models() == models  # fresh, not requested again
+        assert server.n_requests == 1
+        assert GPT4All.list_models(max_age=0) == models  # revalidated, not modified
+        assert server.n_requests == 2
+
+        # the model file exists, so the cached list is used however old it is
+        config = GPT4All.retrieve_model('model.gguf')
+        assert config['name'] == 'Test Model'
+        assert server.n_requests == 2
+
+    # the server is gone, so a stale copy is used with a warning
+    with pytest.warns(UserWarning):
+        assert GPT4All.list_models(max_age=0) == models
+
+
+def test_lazy_import():
+    # importing gpt4all should not load the native library or the dependencies only needed by some features
+    code = (
+        'import sys, gpt4all; '
+        'print(gpt4all._pyllmodel.llmodel.is_loaded, *({"asyncio", "jinja2", "requests", "tqdm"} & set(sys.modules)))'
+    )
+    proc = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert proc.stdout.split() == ['False']
+
+
+@contextmanager
+def run_server(**kwargs):
+    from gpt4all.server import InferenceServer
+    with InferenceServer(port=0, **kwargs) as server:
+        server.start()
+        yield server, f'http://127.0.0.1:{server.address[1]}/v1/'
+
+
+def test_server_errors():
+    # the same responses as the chat application's server, checked by gpt4all-chat/tests/python/test_server_api.py
+    import requests
+    with run_server() as (server, base):
+        resp = requests.get(base + 'foobarbaz')
+        assert resp.status_code == 404 and resp.content == b''
+        assert requests.get(base + 'models').json() == {'object': 'list', 'data': []}
+        assert requests.get(base + 'models/foo').json() == {}
+
+        resp = requests.post(base + 'models/foo')
+        assert resp.status_code == 405
+        assert resp.json() == {'error': {
+            'code': None,
+            'message': 'Not allowed to POST on /v1/models/*. (HINT: Perhaps you meant to use a different HTTP method?)',
+            'param': None,
+            'type': 'invalid_request_error',
+        }}
+        for endpoint in ('completions', 'chat/completions', 'embeddings'):
+            resp = requests.get(base + endpoint)
+            assert resp.status_code == 405
+            assert resp.json()['error']['code'] == 'method_not_supported'
+
+        def error(data):
+            resp = requests.post(base + 'completions', json=data)
+            return resp.status_code, resp.json()['error']['message']
+
+        assert requests.post(base + 'completions').json()['error']['message'] == \
+            'error parsing request JSON: illegal value'
+        assert error({'prompt': 'a'}) == (400, 'you must provide a model parameter')
+        assert error({'model': 'm', 'prompt': 'a', 'max_tokens': 0}) == \
+            (400, "0 is less than the minimum of 1 - 'max_tokens'")
+        assert error({'model': 'm', 'prompt': 'a', 'temperature': 2.5}) == \
+            (400, "2.5 is greater than the maximum of 2 - 'temperature'")
+        assert error({'model': 'm', 'prompt': 'a', 'top_p': 'x'}) == (400, "'x' is not of type 'number' - 'top_p'")
+        assert error({'model': 'm', 'prompt': 'a', 'foo': 1}) == \
+            (400, 'Unrecognized request argument supplied: foo')
+        assert error({'model': 'm', 'prompt': 'a', 'n': 129}) == (400, "129 is greater than the maximum of 128 - 'n'")
+        assert error({'model': 'm', 'prompt': 'a'}) == (404, "The model 'm' does not exist")
+
+
+def test_server():
+    import requests
+    with run_server(batch_wait=0.1) as (server, base):
+        name = server.add_model('orca-mini-3b-gguf2-q4_0.gguf', n_workers=2)
+        server.add_embedding_model()
+        assert requests.get(base + 'models').json()['data'][0]['id'] == name
+
+        data = {'model': name, 'prompt': 'The quick brown fox', 'temperature': 0, 'max_tokens': 6}
+        response = requests.post(base + 'completions', json=data).json()
+        assert response['object'] == 'text_completion'
+        choice, = response['choices']
+        assert choice['finish_reason'] == 'length' and choice['logprobs'] is None and choice['text']
+        assert response['usage']['completion_tokens'] == 6
+        resp = requests.post(base + 'completions', json={**data, 'max_tokens': 1_000_000})
+        assert resp.status_code == 400 and resp.json()['error']['param'] == 'max_tokens'
+
+        # streamed text is the same as the whole response, and concurrent requests are batched
+        chunks = []
+        with requests.post(base + 'completions', json={**data, 'stream': True}, stream=True) as resp:
+            for line in resp.iter_lines():
+                if line:
+                    chunks.append(line.decode()[len('data: '):])
+        assert chunks[-1] == '[DONE]'
+        assert ''.join(json.loads(c)['choices'][0]['text'] for c in chunks[:-1]) == choice['text']
+
+        results = {}
+
+        def post(i):
+            results[i] = requests.post(base + 'completions', json=data).json()['choices'][0]['text']
+
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert set(results.values()) == {choice['text']}
+
+        messages = [{'role': 'user', 'content': 'hello'}]
+        response = requests.post(base + 'chat/completions', json={'model': name, 'messages': messages}).json()
+        assert response['choices'][0]['message']['role'] == 'assistant'
+
+        response = requests.post(base + 'embeddings', json={
+            'model': 'all-MiniLM-L6-v2.gguf2.f16.gguf', 'input': ['hello', 'world'],
+        }).json()
+        assert [len(d['embedding']) for d in response['data']] == [384, 384]
+        assert response['usage']['prompt_tokens'] > 0
+
+
+def test_scheduler():
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf')
+    prompts = ['The capital of France is', 'The capital of Germany is', 'Once upon a time']
+    expected = [model.generate(p, max_tokens=24, temp=0) for p in prompts]
+
+    # small slices make the requests take turns many times
+    with Scheduler(model, max_active=2, slice_tokens=4, prefill_chunk=4) as scheduler:
+        futures = [scheduler.submit(p, max_tokens=24, temp=0) for p in prompts]
+        assert [f.result() for f in futures] == expected
+        stats = scheduler.stats
+        assert stats['n_completed'] == 3 and stats['n_queued'] == stats['n_active'] == 0
+        assert stats['n_preemptions'] > 0
+
+        # requests from threads and coroutines, with and without deadlines
+        results = {}
+
+        def generate(i):
+            results[i] = scheduler.generate(prompts[i], max_tokens=24, temp=0, timeout=600)
+
+        threads = [threading.Thread(target=generate, args=(i,)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert [results[i] for i in range(3)] == expected
+
+        async def agenerate_all():
+            return await asyncio.gather(*(scheduler.agenerate(p, max_tokens=24, temp=0) for p in prompts))
+        assert asyncio.run(agenerate_all()) == expected
+
+        with pytest.raises(DeadlineExceededError):
+            scheduler.generate('Write a long story.', max_tokens=2000, timeout=0.5)
+        assert scheduler.stats['n_expired'] == 1
+
+        # a request that expires during chunked prefill leaves only the evaluated part of its prompt to reuse, so the
+        # next request with that prompt still evaluates the rest of it
+        long_prompt = 'Hello world, ' * 60
+        n_prompt = len(model.tokenize(long_prompt))
+        n_before = scheduler.stats['n_prompt_tokens']
+        with pytest.raises(DeadlineExceededError):
+            scheduler.generate(long_prompt, max_tokens=8, temp=0, timeout=0.2)
+        assert scheduler.stats['n_expired'] == 2
+        output = scheduler.generate(long_prompt, max_tokens=8, temp=0)
+        assert scheduler.stats['n_prompt_tokens'] - n_before >= n_prompt - 1
+        assert output == model.generate(long_prompt, max_tokens=8, temp=0)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+import subprocess
+import sys
+
+
+def import_times(module, runs=5):
+    # Import a module in fresh interpreters with `-X importtime`, and return the fastest cumulative time, in us, of
+    # each module imported because of it.
+    best = {}
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True, check=True,
+        )
+        subtree = []
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            subtree.append((name.strip(), int(cumulative)))
+            if not name.startswith('  '):  # top level, so the previous lines were imported by this module
+                if name.strip() == module:
+                    break
+                subtree.clear()
+        for name, us in subtree:
+            best[name] = min(best.get(name, float('inf')), us)
+    return best
+
+
+if __name__ == "__main__":
+    times = import_times('gpt4all')
+    print(f"import gpt4all: {times['gpt4all'] / 1000:.1f} ms")
+    for name, us in sorted(times.items(), key=lambda item: -item[1])[1:11]:
+        print(f"  {us / 1000:6.1f} ms  {name}")
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+import time
+
+from gpt4all import GPT4All, TokenLogprobs
+
+PROMPT = 'Write a short story about a lighthouse keeper.'
+
+
+def time_generate(model, **kwargs):
+    start = time.perf_counter()
+    model.generate(PROMPT, max_tokens=64, temp=0, **kwargs)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf', n_threads=8)
+    print(f"without logprobs: {time_generate(model):.2f}s")
+    for top_n in [0, 5, 20]:
+        logprobs = TokenLogprobs(top_n=top_n)
+        elapsed = time_generate(model, logprobs=logprobs)
+        print(f"logprobs, top_n={top_n}: {elapsed:.2f}s, perplexity {logprobs.perplexity:.2f}")
+
+    text = 'The quick brown fox jumps over the lazy dog. ' * 40
+    start = time.perf_counter()
+    scored = model.score(text)
+    elapsed = time.perf_counter() - start
+    print(f"score {len(scored)} tokens: {elapsed:.2f}s, {len(scored) / elapsed:.1f} tokens/second")
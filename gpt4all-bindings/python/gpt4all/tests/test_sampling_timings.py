@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+import time
+
+from gpt4all import GPT4All
+
+PROMPT = 'You are a helpful assistant that writes product descriptions. ' * 40 + '\nDescribe a red bicycle.'
+
+
+def time_best_of(model, n, use_n):
+    model.generate('Hello', max_tokens=1)  # so that the prompt is not already in the context
+    start = time.perf_counter()
+    if use_n:
+        completions = model.generate(PROMPT, max_tokens=16, temp=0.8, n=n)
+        best = max(completions, key=lambda c: c['logprob'])['text']
+    else:
+        best = [model.generate(PROMPT, max_tokens=16, temp=0.8) for _ in range(n)][0]
+    elapsed = time.perf_counter() - start
+    print(f"best of {n}, {'n=' + str(n) if use_n else 'separate calls'}: {elapsed:.2f}s ({best[:30]!r})")
+
+
+if __name__ == "__main__":
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf', n_ctx=2048, n_threads=8)
+    for n in [1, 4, 8]:
+        time_best_of(model, n, use_n=False)
+        time_best_of(model, n, use_n=True)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gpt4all import GPT4All, Scheduler
+
+PROMPT = 'Write a short poem about the sea, number {}.'
+
+
+def time_requests(generate, n_clients, label, concurrent=True):
+    # All clients send their request at the start, so time to first token includes the time spent waiting for others
+    first_token = [0.0] * n_clients
+
+    def run(i):
+        def callback(token_id, response):
+            if not first_token[i]:
+                first_token[i] = time.perf_counter() - start
+            return True
+
+        return generate(PROMPT.format(i), max_tokens=32, temp=0, callback=callback)
+
+    start = time.perf_counter()
+    if concurrent:
+        with ThreadPoolExecutor(n_clients) as pool:
+            outputs = list(pool.map(run, range(n_clients)))
+    else:
+        outputs = [run(i) for i in range(n_clients)]
+    elapsed = time.perf_counter() - start
+    print(f"{label:>16}, {n_clients} clients: {elapsed:6.2f}s, "
+          f"time to first token mean {sum(first_token) / n_clients:.2f}s, max {max(first_token):.2f}s")
+    return outputs
+
+
+if __name__ == "__main__":
+    model = GPT4All('orca-mini-3b-gguf2-q4_0.gguf', n_threads=8)
+    lock = threading.Lock()
+
+    def locked_generate(prompt, **kwargs):
+        with lock:
+            return model.generate(prompt, **kwargs)
+
+    expected = time_requests(model.generate, 8, 'serial', concurrent=False)
+    assert time_requests(locked_generate, 8, 'lock') == expected
+    # smaller slices swap the context state between requests more often
+    for slice_tokens in [4, 16, 128]:
+        with Scheduler(model, max_active=8, slice_tokens=slice_tokens) as scheduler:
+            outputs = time_requests(scheduler.generate, 8, f'scheduler/{slice_tokens}')
+        assert outputs == expected
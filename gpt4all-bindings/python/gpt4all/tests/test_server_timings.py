@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from gpt4all.server import InferenceServer
+
+SYSTEM = 'You are a helpful assistant that answers questions about geography in one short sentence. ' * 8
+
+
+def time_requests(max_batch_size, n_clients):
+    with InferenceServer(port=0, max_batch_size=max_batch_size, batch_wait=0.05) as server:
+        name = server.add_model('orca-mini-3b-gguf2-q4_0.gguf', n_threads=8)
+        server.start()
+        url = f'http://127.0.0.1:{server.address[1]}/v1/completions'
+
+        def post(i):
+            data = {'model': name, 'prompt': f'{SYSTEM}\nWhat is the capital of country number {i}?', 'max_tokens': 16}
+            return requests.post(url, json=data).json()['usage']['completion_tokens']
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(n_clients) as pool:
+            n_tokens = sum(pool.map(post, range(n_clients)))
+        elapsed = time.perf_counter() - start
+    print(f"max_batch_size {max_batch_size}, {n_clients} clients: {elapsed:.2f}s, "
+          f"{n_tokens / elapsed:.1f} generated tokens/second")
+
+
+if __name__ == "__main__":
+    for max_batch_size in [1, 8]:
+        time_requests(max_batch_size, 8)
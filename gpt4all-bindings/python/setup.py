@@ -104,6 +104,7 @@ setup(
         ],
         'dev': [
             'gpt4all[all]',
+            'numpy',
             'pytest',
             'twine',
             'wheel',